@@ -35,11 +35,45 @@ README = """\
 <li><p><strong>Plugin Configuration</strong>:</p>
 <ul>
 <li><strong>TCP/IP Port</strong> - The port used for receiving.</li>
+<li><strong>Also receive events over UDP on this port</strong> - If checked the receiver also takes events sent by Send an Event with <strong>Send over UDP</strong> checked, as single datagrams to the same port number. Such events go through the same event limit, prefix and source IP handling as the ones received over TCP, but nothing tells the sender whether they arrived. Get Server Statistics counts the datagrams, the rejected ones(bad password or format) and the replayed or too old ones.</li>
+<li><strong>Max pending connections</strong> - Connections that the receiver hasn't accepted yet are queued by the OS up to this number, which the OS may lower(on Linux to net.core.somaxconn). When the queue is full, further senders are only retried a second or more later. The receiver accepts all queued connections at once.</li>
+<li><strong>Max received line size(MB)</strong> - Connections that send a longer line, for example a huge Send Data value, are closed.</li>
+<li><strong>Max chunked value size(MB)</strong> - Connections that announce a larger chunked Send Data value, or one larger than the <strong>Max memory</strong> of the stored data, are closed before anything is received.</li>
+<li><strong>Compress values larger than(KB, 0 = never)</strong> - Encoded values, in payloads, Send Data, Request Data and its result, that are longer than this are compressed with zlib when the other side is a TCPEvents plugin that supports it. Helps with large text or JSON values over slow links. Both sides use their own setting for what they send, Get Server Statistics reports the compression ratio and time.</li>
+<li><strong>Server engine</strong> - <em>EventGhost network loop</em> receives on the asyncore loop EventGhost shares between all plugins. <em>Dedicated thread</em> receives on a thread of its own, so a busy receiver doesn't slow down other plugins, and uses epoll or poll where the OS has them to handle thousands of connections.</li>
+<li><strong>Local metrics port(0 = off)</strong> - If set, the statistics returned by Get Server Statistics are also served in the Prometheus text format to HTTP requests on this port of 127.0.0.1.</li>
 <li><strong>Password</strong> - The password must match the password used by the sender. Leave the password field blank to disable authentication. Unauthenticated operation is not supported by the Network Event Sender/Receiver plugin.</li>
+<li><strong>Reconnect without handshake for(seconds, 0 = never)</strong> - After authenticating, a TCPEvents sender gets a ticket that lets it skip the password handshake the next time it connects within this time. Each ticket can only be used once, from the address it was given to, and all tickets become invalid when the plugin restarts.</li>
 <li><strong>Default Event Prefix</strong> - The prefix to use on received events unless a prefix is specified by the sender.</li>
 <li><strong>Add source IP to the payload</strong> - If checked the sender's IP address will be included with the payload of received events.</li>
-<li><strong>Connection Timeout(seconds)</strong> - Maximum number of seconds to attempt to connect to the server before the event send fails. Any other operation in EventGhost will be blocked until the send is completed or times out so it is important to find the smallest value that still allows for reliable communication.</li>
+<li><strong>Coalescing rules (Python expr.)</strong> - A dict of event name patterns and (mode, seconds), for example {"TCP.Temperature*": ("latest", 5), "TCP.Button": ("debounce", 0.3)}, to hold back received events that come again and again. The patterns use * and ? wildcards and are matched against prefix.suffix, the longest matching pattern applies. <em>debounce</em> triggers an event once the same event(same name and payload) hasn't been received for the window. <em>throttle</em> triggers an event right away and drops the same event until the window has passed. <em>latest</em> triggers the last event received with the name, whatever its payload, at the end of a window that starts with the first one. Enduring events are never held back. Get Server Statistics counts the events each rule suppressed.</li>
+<li><strong>Connections per second(0 = no limit)</strong> - Each sender address has a token bucket for connections that refills at this rate. A connection from an address whose bucket is empty is closed right after it is accepted.</li>
+<li><strong>Connection burst</strong> - The size of the connection bucket: how many connections an address can open at once before the rate applies.</li>
+<li><strong>Events per second(0 = no limit)</strong> - The same for the events an address sends, batched events included.</li>
+<li><strong>Event burst</strong> - The size of the event bucket.</li>
+<li><strong>Over the event limit</strong> - <em>Trigger them later</em> triggers the event that went over the limit and stops reading from the sender until its bucket has refilled, so its further events are triggered at the configured rate and the sender is slowed down by TCP flow control. <em>Drop them</em> also stops reading, but drops the events that arrive over the limit. Either way a flooding sender doesn't keep the receiver from serving the others. Get Server Statistics counts the rejected connections, the dropped events and how often senders were throttled.</li>
+<li><strong>Connection Timeout(seconds)</strong> - Maximum number of seconds to attempt to connect to the server before the event send fails. Unless the action sends in the background, any other operation in EventGhost will be blocked until the send is completed or times out so it is important to find the smallest value that still allows for reliable communication.</li>
 <li><strong>Communication Timeout(seconds)</strong> - Maximum number of seconds to attempt communication with the server before the event send fails.</li>
+<li><strong>Worker threads</strong> - Number of threads that run the sends of actions with <strong>Send in the background</strong> checked.</li>
+<li><strong>Max queued sends</strong> - Maximum number of background sends waiting for a worker thread.</li>
+<li><strong>When the queue is full</strong> - Wait for room in the queue, drop the oldest queued send or reject the new send.</li>
+<li><strong>Host groups (Python expr.)</strong> - A dict of group names and lists of addresses for Broadcast an Event, for example {"lights": ["192.168.1.10", "192.168.1.11:1025"]}.</li>
+<li><strong>Trigger SendCompleted/SendFailed events</strong> - If checked a background send triggers {prefix}.SendCompleted or {prefix}.SendFailed with [address, port, result] as payload when it is done.</li>
+<li><strong>Keep unsent events on disk(MB, 0 = never)</strong> - Events of Send an Event, Broadcast an Event and Send Event Batch that can't be sent because the receiver is unreachable are written to files in TCPEvents\\outbox-{port} in the EventGhost configuration folder, and sent from a background thread, in order and in batches, once the receiver answers again. An unreachable receiver is tried again after 1 second, doubling up to 30 seconds. While events for a receiver are waiting, new events for it are added after them instead of being sent right away. The action returns None for an event that is kept. Of a Send Event Batch that fails part way only the events after the last batch the receiver confirmed are kept. The files are read back when the plugin starts, so the events also survive a restart of EventGhost. They hold the password of the receiver, like the EventGhost configuration does. Events that were being sent when EventGhost stopped may be sent twice. Once the files take more than this, new unsent events are dropped. Get Server Statistics reports the number of waiting events per receiver, and counts the sent events the receiver triggered and the ones it didn't, for example because of its event limit.</li>
+<li><strong>Drop unsent events after(seconds)</strong> - Kept events that couldn't be sent for this long are dropped.</li>
+<li><strong>Keep connections to receivers open</strong> - If checked the send actions keep their authenticated connection to a receiver open and reuse it for the next send to the same address, port and password.</li>
+<li><strong>Max idle connections per receiver</strong> - Maximum number of open connections kept for each receiver.</li>
+<li><strong>Idle connection timeout(seconds)</strong> - Connections that haven't been used for this long are closed.</li>
+<li><strong>Cache host name lookups for(seconds, 0 = never)</strong> - The addresses of a receiver's host name are kept this long, so the send actions don't wait for a name lookup every time they connect. A name that is still used after three quarters of this time is looked up again in the background. When a name has several addresses, all of them are tried at once and the first one that answers is used. Get Server Statistics reports the hit rate.</li>
+<li><strong>Cache failed lookups for(seconds)</strong> - A lookup that failed fails again right away for this long, instead of waiting for the name server each time.</li>
+<li><strong>Max memory(MB, 0 = no limit)</strong> - Once the data received by Send Data takes more memory, the least recently sent or retrieved values are dropped.</li>
+<li><strong>Expire after(seconds, 0 = never)</strong> - Received data is dropped this long after it was sent, unless the sender specifies its own lifetime.</li>
+<li><strong>Keep received data across restarts</strong> - If checked the received data is also written to TCPEvents\\receivedData-{port}.log in the EventGhost configuration folder and read back when the plugin starts.</li>
+<li><strong>Worker threads</strong> (Data Requests) - Request Data expressions are evaluated on this many threads, so a slow expression doesn't hold up other senders or the other plugins.</li>
+<li><strong>Request timeout(seconds)</strong> - If a Request Data expression takes longer, the connection to its sender is closed.</li>
+<li><strong>Max pending requests per sender</strong> - A sender whose connection has more Request Data expressions waiting to be evaluated is disconnected. Request Multiple Data senders are told this number and keep below it, the excess requests of other senders fail with a None result instead.</li>
+<li><strong>Compiled expressions to keep</strong> - Number of Request Data expressions kept compiled, so expressions polled again and again aren't parsed for every request.</li>
+<li><strong>Cached results (Python expr.)</strong> - A dict of Request Data expressions and seconds, for example {"eg.globals.temperature": 10}. The result of such an expression is sent back to every request within that many seconds instead of evaluating it again. Requests that arrive while it is being evaluated wait for that evaluation.</li>
 </ul></li>
 
 <li><p><strong>Send an Event</strong></p>
@@ -50,12 +84,27 @@ README = """\
 <li><strong>Prefix</strong> - Prefix of the sent event. If the prefix is not specified then the default prefix specified in the plugin configuration of the receiver will be used. Custom prefix is not supported by the Network Event Sender/Receiver plugin.</li>
 <li><strong>Suffix</strong> - Suffix of the sent event.</li>
 <li><strong>Payload(Python expr.)</strong> - If you want to send a plain text string write it between quotes. You can send/receive payload of various types(strings, numbers, lists, dicts, tuples, datetime, etc.).</li>
+<li><strong>Send in the background</strong> - If checked the send is queued and the action returns right away, so EventGhost isn't blocked while the event is sent. eg.result is a Future: eg.result.Result(timeout) waits for the send to finish and returns its result. Also available in Send Event Batch and Send Data.</li>
+<li><strong>Send over UDP(no delivery confirmation)</strong> - If checked the event is sent as a single datagram to a receiver with <strong>Also receive events over UDP on this port</strong> checked, without connecting or waiting for an answer. eg.result is [event, payload] once the datagram is sent, whether or not it arrives. Events with a payload that doesn't fit a datagram(about 64 KB) fail and have to be sent over TCP. Meant for frequent events where losing one now and then doesn't matter, like sensor readings.</li>
 </ul></li>
 
-<li><p><strong>Send Data</strong> - When sending data, the server won't produce any event. It will only store it with the provided name. The stored data can be retrieved at any time using the data name. This action is not supported by the Network Event Sender/Receiver plugins. See the <strong>Send an Event section</strong> for documentation of duplicate fields.</p>
+<li><p><strong>Broadcast an Event</strong> - Sends the same event to many receivers in parallel. eg.result is a dict with the success, latency(seconds) and result of each address. See the <strong>Send an Event</strong> section for documentation of duplicate fields.</p>
+<ul>
+<li><strong>Addresses or host groups</strong> - A comma separated list of addresses and host group names. An address can include a port(address:port), otherwise <strong>TCP/IP port</strong> is used.</li>
+<li><strong>Max parallel sends</strong> - Maximum number of receivers that are sent to at the same time.</li>
+</ul></li>
+
+<li><p><strong>Send Event Batch</strong> - Sends a list of events to a receiver over a single connection. Each event is a suffix, a (suffix,), (prefix, suffix) or (prefix, suffix, payload) tuple or list, or a dict with prefix, suffix and payload keys. Anything else is reported as an error and nothing is sent. A TCPEvents receiver triggers them in order and reports back which ones it triggered. The result of each event is returned as a list in eg.result. See the <strong>Send an Event</strong> section for documentation of duplicate fields.</p>
+<ul>
+<li><strong>Prefix</strong> - Prefix of the events that don't specify their own prefix.</li>
+<li><strong>Events (Python expr.)</strong> - A list of events. Each event is a suffix string, a (prefix, suffix) or (prefix, suffix, payload) tuple or a dict with "prefix", "suffix" and "payload" keys.</li>
+</ul></li>
+
+<li><p><strong>Send Data</strong> - When sending data, the server won't produce any event. It will only store it with the provided name. The stored data can be retrieved at any time using the data name. This action is not supported by the Network Event Sender/Receiver plugins. See the <strong>Send an Event section</strong> for documentation of duplicate fields. Values that encode to more than 1 MB are streamed to TCPEvents receivers in 1 MB chunks, which the receiver collects in a temporary file instead of buffering them as one line. A send in the background reports its progress as eg.result.progress, a [bytes sent, total bytes] list.</p>
 <ul>
 <li><strong>Name</strong> - The name is used to retrieve received data.</li>
 <li><strong>Data(Python expression)</strong> - Data to send.</li>
+<li><strong>Expire after(seconds, 0 = receiver default)</strong> - The receiver drops the data this long after receiving it.</li>
 </ul></li>
 
 <li><p><strong>Retrieve Received Data</strong> - The retrieved data stored under the name is returned as eg.result. This action is not supported by the Network Event Sender/Receiver plugins.</p>
@@ -63,11 +112,25 @@ README = """\
 <li><strong>Name of the data to retrieve</strong> - Use the data name specified in the Send Data action.</li>
 </ul></li>
 
+<li><p><strong>Get Server Statistics</strong> - Returns a dict with the statistics of the receiver(accepted and active connections, handshakes and handshake failures, bytes in and out, events per prefix and the time spent in each handler state), the connection pool, the queues, the received data, the Request Data caches, the rate limits and the compression.</p></li>
+
 <li><p><strong>Request Data from a remote host</strong> - The response is returned as eg.result. No event is created. This action is not supported by the Network Event Sender/Receiver plugins. See the
 <strong>Send an Event</strong> section for documentation of duplicate fields.</p>
 <ul>
+<li><strong>Addresses or host groups</strong> - One address, or replicas of the same data: a comma separated list of addresses, address:port entries and host group names. The replicas are asked in order. The next one is asked as soon as one fails, or when none answered within the hedge delay, and the first answer is returned. A replica that failed is asked last for 1 second, doubling with each failure in a row up to a minute, until it answers again. Get Server Statistics reports the hedged requests and failovers.</li>
+<li><strong>Ask the next address after(seconds)</strong> - The hedge delay. Around the usual response time of the receivers keeps a slow or stalled replica from holding up the request, without asking the others for most requests.</li>
 <li><strong>Python expression</strong> - This expression is evaluated on the receiver and the result is sent back</li>
 </ul></li>
+
+<li><p><strong>Request Multiple Data</strong> - Evaluates a list of expressions on the receiver over one connection and returns a dict of each expression and its result as eg.result, for example to fill a dashboard. A TCPEvents receiver that supports it evaluates up to 16 of them at a time and answers each one as soon as it is done, older receivers answer them one after the other. The result of an expression the receiver can't evaluate is None. It sends no more of them at a time than the receiver's <strong>Max pending requests per sender</strong>. See the <strong>Send an Event</strong> section for documentation of duplicate fields.</p>
+<ul>
+<li><strong>Python expressions (Python expr.)</strong> - A list of expressions, for example ["eg.globals.temperature", "eg.globals.humidity"].</li>
+</ul></li>
+
+<li><p><strong>Subscribe to Data</strong> - Subscribes to data stored by Send Data on another TCPEvents plugin, instead of polling it with Request Data. The receiver sends the values stored under the names right away and again whenever Send Data stores a new value, over a connection that stays open. Each value that changed is stored in the received data of this plugin, so Retrieve Received Data returns it, and triggers {prefix}.DataChanged.{name} with the value as payload. A broken connection is opened again after 1 second, doubling up to a minute, and only the values that changed meanwhile trigger events. Running the action again for the same address replaces the subscription, an empty list of names ends it. A receiver disconnects a subscriber that falls more than 1000 values behind. See the <strong>Send an Event</strong> section for documentation of duplicate fields.</p>
+<ul>
+<li><strong>Data names(comma separated, * and ? wildcards)</strong> - Data names, separated by commas. * and ? match any characters and any one character, for example sensor.*, door.</li>
+</ul></li>
 </ul>
 
 
@@ -84,6 +147,30 @@ README = """\
 <li>Security vulnerability patch</li>
 <li>Unauthenticated option</li>
 <li>Set timeouts via configuration</li>
+<li>Reuse authenticated connections to receivers</li>
+<li>Send Event Batch action</li>
+<li>Faster reception of large payloads, configurable line size limit</li>
+<li>JSON encoding of payloads and data between TCPEvents senders and receivers</li>
+<li>Optional dedicated server thread</li>
+<li>Background sending</li>
+<li>Broadcast an Event action</li>
+<li>Size limit, expiry and optional persistence of received data</li>
+<li>Chunked transfer of large Send Data values</li>
+<li>Compiled expression and result cache for Request Data</li>
+<li>Request Data expressions are evaluated on worker threads</li>
+<li>Received events are triggered without taking the plugin lock</li>
+<li>Resumption tickets for reconnecting without the password handshake</li>
+<li>Get Server Statistics action and metrics port</li>
+<li>Per sender connection and event rate limits</li>
+<li>Configurable listen backlog, all pending connections are accepted at once</li>
+<li>Negotiated zlib compression of large values</li>
+<li>Optional UDP transport for events, authenticated with HMAC-SHA256</li>
+<li>Debounce, throttle and latest-wins coalescing rules for received events</li>
+<li>Request Multiple Data action, requests with ids answered out of order on one session</li>
+<li>Subscribe to Data action, the receiver pushes changed values to subscribers</li>
+<li>Cached host name lookups, parallel connects to hosts with several addresses</li>
+<li>Request Data from replicas, hedged after a delay, with backoff for failing ones</li>
+<li>Disk outbox for events to unreachable receivers, sent again in order once they are back</li>
 </ul>
 """
 
@@ -117,16 +204,41 @@ import sys
 import wx
 import asynchat
 import asyncore
-from hashlib import md5
+import base64
+import bisect
+import collections
+import copy
+import errno
+import fnmatch
+from hashlib import md5, sha256
+import hmac
 import random
+import select
 import socket
+import tempfile
 import threading
 import time
+import timeit
 import datetime
+import heapq
+import itertools
+import json
+import os
+import Queue
+import zlib
 
 
 class Text:
     port = "TCP/IP Port: "
+    listenBacklog = "Max pending connections: "
+    udpEnabled = "Also receive events over UDP on this port: "
+    udp = "Send over UDP(no delivery confirmation): "
+    coalesceRules = "Coalescing rules (Python expr.): "
+    maxLineSize = "Max received line size(MB): "
+    maxTransferSize = "Max chunked value size(MB): "
+    compressThreshold = "Compress values larger than(KB, 0 = never): "
+    engine = "Server engine: "
+    engines = ("EventGhost network loop", "Dedicated thread (epoll/poll)")
     address = "Address: "
     password = "Password: "
     eventPrefix = "Default Event Prefix: "
@@ -141,13 +253,164 @@ class Text:
     dataToSend = "Data (python expression): "
     dataBox = "Data"
     dataToReceive = "Python expression: "
+    expressions = "Python expressions (Python expr.): "
+    dataNames = "Data names(comma separated, * and ? wildcards): "
+    events = "Events (Python expr.): "
+    background = "Send in the background: "
+    queueBox = "Background Sending"
+    queueWorkers = "Worker threads: "
+    queueDepth = "Max queued sends: "
+    queuePolicy = "When the queue is full: "
+    queuePolicies = ("Wait for room in the queue", "Drop the oldest queued send", "Reject the new send")
+    queueEvents = "Trigger SendCompleted/SendFailed events: "
+    hostGroupsBox = "Host Groups"
+    hostGroups = "Host groups (Python expr.): "
+    hosts = "Addresses or host groups: "
+    storeBox = "Received Data"
+    storeSize = "Max memory(MB, 0 = no limit): "
+    storeTTL = "Expire after(seconds, 0 = never): "
+    storePersist = "Keep received data across restarts: "
+    ttl = "Expire after(seconds, 0 = receiver default): "
+    requestBox = "Data Requests"
+    exprCacheSize = "Compiled expressions to keep: "
+    cachedResults = "Cached results (Python expr.): "
+    requestWorkers = "Worker threads: "
+    requestTimeout = "Request timeout(seconds): "
+    requestsPerClient = "Max pending requests per sender: "
+    ticketLifetime = "Reconnect without handshake for(seconds, 0 = never): "
+    metricsPort = "Local metrics port(0 = off): "
+    floodBox = "Flood Protection(per sender address)"
+    connectionRate = "Connections per second(0 = no limit): "
+    connectionBurst = "Connection burst: "
+    eventRate = "Events per second(0 = no limit): "
+    eventBurst = "Event burst: "
+    floodPolicy = "Over the event limit: "
+    floodPolicies = ("Trigger them later", "Drop them")
+    concurrency = "Max parallel sends: "
     timeoutBox = "Send Timeout Duration"
     connectionTimeout = "Connection Timeout(seconds): "
     communicationTimeout = "Communication Timeout(seconds): "
+    poolBox = "Connection Pool"
+    poolEnabled = "Keep connections to receivers open: "
+    poolSize = "Max idle connections per receiver: "
+    poolIdleTimeout = "Idle connection timeout(seconds): "
+    resolverTTL = "Cache host name lookups for(seconds, 0 = never): "
+    resolverNegativeTTL = "Cache failed lookups for(seconds): "
+    hedgeDelay = "Ask the next address after(seconds): "
+    outboxBox = "Unsent Events"
+    outboxSize = "Keep unsent events on disk(MB, 0 = never): "
+    outboxTTL = "Drop unsent events after(seconds): "
 
 
 class DefaultValues:
     defaultTimeout = 5.0
+    maxLineSize = 64
+    maxTransferSize = 1024
+    engine = 0
+    queueWorkers = 2
+    queueDepth = 1000
+    queuePolicy = 0
+    queueEvents = True
+    hostGroups = ""
+    concurrency = 16
+    storeSize = 0
+    storeTTL = 0
+    storePersist = False
+    exprCacheSize = 256
+    cachedResults = ""
+    requestWorkers = 4
+    requestTimeout = 10.0
+    requestsPerClient = 16
+    ticketLifetime = 300
+    metricsPort = 0
+    connectionRate = 0.0
+    connectionBurst = 20
+    eventRate = 0.0
+    eventBurst = 200
+    floodPolicy = 0
+    listenBacklog = 128
+    compressThreshold = 0
+    udpEnabled = False
+    coalesceRules = ""
+    poolEnabled = True
+    poolSize = 4
+    poolIdleTimeout = 30.0
+    resolverTTL = 300
+    resolverNegativeTTL = 10
+    hedgeDelay = 0.1
+    outboxSize = 0
+    outboxTTL = 86400
+
+
+# Optional protocol features. A TCPEvents sender requests them by sending
+# "TCPEvents/<cap>,<cap>" instead of "TCPEvents" in front of its MD5 digest and
+# the receiver answers " accept/<granted caps>" instead of " accept".
+# keepalive: the receiver does not close the session after data/dataRequest.
+# batch: the receiver understands "batch <n>" followed by n events and answers
+# with "batchResult [<success of each event>]".
+# json: payload, data, dataRequest and result values are sent as JsonCodec
+# instead of ReprCodec text.
+# ttl: the receiver understands "dataTTL <seconds>" in front of a data line.
+# chunked: instead of a data line the sender can send "dataChunked <n>" followed
+# by the n bytes of the encoded value, without a line terminator.
+# ticket: the receiver follows its accept with "ticket <ticket>". The sender can
+# send "resume <ticket>" instead of "quintessence" on its next connection and
+# gets " accept/<caps>" and a new ticket, or " reject" if it has to authenticate.
+# zlib: encoded payload, data, dataRequest and result values can be sent as "z"
+# followed by the base64 of their zlib compression, in both directions. Each side
+# compresses the values that are longer than its own threshold.
+# mux: the receiver understands "dataRequestId <id> <value>" and answers each
+# with "resultId <id> <value>", or "resultError <id>" if it can't evaluate it,
+# as soon as it is done, so many requests can be in flight on one session. The
+# receiver grants it as "mux,mux=<n>", n being how many it takes at a time, and
+# answers the requests beyond that with "resultError <id>".
+# subscribe: the receiver understands "subscribe <value>", a list of data names
+# or fnmatch patterns. It sends "changed <value>", a [name, value] list, for each
+# stored value that matches, then again whenever Send Data stores one.
+CAPABILITIES = ("keepalive", "batch", "json", "ttl", "chunked", "ticket", "zlib", "mux", "subscribe")
+# A receiver without a password has no handshake to ask for them in. The first
+# line of the sender is then this hello, with the requested capabilities, which
+# the receiver answers with " accept/<granted caps>". Receivers that predate it
+# take the hello for a dataRequest of a string, answer "result" and hang up.
+HELLO = "dataRequest [\"'TCPEvents/%s'\"]"
+MAX_BATCH_SIZE = 1000
+# dataRequestIds a sender keeps in flight on one session
+MAX_REQUESTS_IN_FLIGHT = 16
+# pushed values a subscriber may fall behind by before it is disconnected
+MAX_PUSH_BACKLOG = 1000
+# seconds before a broken subscription is opened again, doubling up to the maximum
+SUBSCRIBE_RETRY_MIN = 1.0
+SUBSCRIBE_RETRY_MAX = 60.0
+# cached name lookups are looked up again in the background once this part of
+# their lifetime has passed
+RESOLVER_REFRESH_AFTER = 0.75
+# host names whose lookup is cached, beyond this the cache starts over
+MAX_RESOLVED_NAMES = 1000
+# seconds a replica that failed is asked last, doubling with each failure in a row
+REPLICA_RETRY_MIN = 1.0
+REPLICA_RETRY_MAX = 60.0
+# bytes of an outbox segment file before the next one is started
+OUTBOX_SEGMENT_SIZE = 1024 * 1024
+# seconds before the unsent events are offered to a receiver again, doubling up to the maximum
+OUTBOX_RETRY_MIN = 1.0
+OUTBOX_RETRY_MAX = 30.0
+# dataRequests waiting for a worker thread, from all clients together
+MAX_QUEUED_REQUESTS = 1000
+# distinct event lines whose parsed (prefix, suffix) are kept
+MAX_CACHED_EVENT_LINES = 4096
+# values that encode to more bytes are sent chunked, in pieces of this size
+CHUNK_SIZE = 1024 * 1024
+# chunked values that are larger are received into a temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+# source addresses with a token bucket, beyond this the full buckets are forgotten
+MAX_RATE_BUCKETS = 10000
+# UDP events: the largest datagram, how old one may be(seconds) and how many are
+# read per readiness notification
+MAX_DATAGRAM_SIZE = 65507
+UDP_MAX_AGE = 30
+MAX_DATAGRAMS_PER_READ = 256
+# receive buffer of the UDP socket, for bursts of datagrams
+UDP_BUFFER_SIZE = 4 * 1024 * 1024
 
 
 DEBUG = False
@@ -158,20 +421,459 @@ else:
         pass
 
 
+class ReprCodec:
+    """
+    The original value encoding: the repr of a list holding the value, turned
+    back into the value with eval.
+    """
+
+    @staticmethod
+    def Encode(value):
+        return unicode([value]).encode("utf-8")
+
+    @staticmethod
+    def Decode(text):
+        return eval(text)[0]
+
+
+class JsonCodec:
+    """
+    Values as JSON. Types JSON doesn't have are written as single key objects:
+    {"__str__": "..."} for byte strings, JSON strings being unicode,
+    {"__tuple__": [...]}, {"__set__": [...]}, {"__datetime__": [y, m, d, H, M, S, us]},
+    {"__date__": [y, m, d]}, {"__time__": [H, M, S, us]}, {"__timedelta__": [d, s, us]},
+    {"__dict__": [[key, value], ...]} for dicts with keys that aren't byte strings and
+    {"__repr__": "..."} for anything else. The keys of JSON objects are byte
+    strings, as the keys of most Python 2 dicts are.
+    """
+
+    tags = frozenset(("__str__", "__tuple__", "__set__", "__datetime__", "__date__", "__time__", "__timedelta__", "__dict__", "__repr__"))
+    plainTypes = (unicode, int, long, float, bool, type(None))
+
+    @classmethod
+    def Encode(cls, value):
+        try:
+            return json.dumps(cls.ToJson(value), separators=(",", ":"))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            # e.g. a str that isn't UTF-8
+            return json.dumps({"__repr__": repr(value)})
+
+    @classmethod
+    def Decode(cls, text):
+        return json.loads(text, object_pairs_hook=cls.FromJson)
+
+    @classmethod
+    def ToJson(cls, value):
+        valueType = type(value)
+        if valueType in cls.plainTypes:
+            return value
+        if valueType is str:
+            return {"__str__": value}
+        toJson = cls.ToJson
+        if valueType is list:
+            return [toJson(item) for item in value]
+        if valueType is dict:
+            for key in value:
+                if type(key) is not str or key in cls.tags:
+                    return {"__dict__": [[toJson(key), toJson(item)] for key, item in value.iteritems()]}
+            return dict((key, toJson(item)) for key, item in value.iteritems())
+        if valueType is tuple:
+            return {"__tuple__": [toJson(item) for item in value]}
+        if valueType in (set, frozenset):
+            return {"__set__": [toJson(item) for item in value]}
+        if valueType is datetime.datetime and value.tzinfo is None:
+            return {"__datetime__": [value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond]}
+        if valueType is datetime.date:
+            return {"__date__": [value.year, value.month, value.day]}
+        if valueType is datetime.time and value.tzinfo is None:
+            return {"__time__": [value.hour, value.minute, value.second, value.microsecond]}
+        if valueType is datetime.timedelta:
+            return {"__timedelta__": [value.days, value.seconds, value.microseconds]}
+        return {"__repr__": repr(value)}
+
+    @classmethod
+    def FromJson(cls, pairs):
+        if len(pairs) != 1 or pairs[0][0] not in cls.tags:
+            return dict((key.encode("utf-8"), value) for key, value in pairs)
+        key, value = pairs[0]
+        if key == "__str__":
+            return value.encode("utf-8")
+        if key == "__tuple__":
+            return tuple(value)
+        if key == "__set__":
+            return set(value)
+        if key == "__datetime__":
+            return datetime.datetime(*value)
+        if key == "__date__":
+            return datetime.date(*value)
+        if key == "__time__":
+            return datetime.time(*value)
+        if key == "__timedelta__":
+            return datetime.timedelta(*value)
+        if key == "__dict__":
+            return dict((item, data) for item, data in value)
+        return eval(value)
+
+
+class DataStore(object):
+    """
+    The values received by Send Data. Least recently used values are evicted
+    once the stored values take more than maxSize bytes(0: no limit), values
+    can expire and an append only log file can keep them across restarts.
+    """
+
+    def __init__(self, maxSize=0, defaultTTL=0, path=None):
+        self.maxSize = maxSize
+        self.defaultTTL = defaultTTL
+        self.lock = threading.Lock()
+        # name -> (value, size, expires), least recently used first
+        self.entries = collections.OrderedDict()
+        self.expiries = []
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, expirations=0)
+        self.path = path
+        self.log = None
+        self.logRecords = 0
+        if path:
+            self.Load()
+
+    def Set(self, name, value, ttl=None, size=None):
+        """Store a value. size is its encoded length, ttl its lifetime in seconds(0: forever)."""
+        if size is None:
+            size = len(repr(value))
+        if ttl is None:
+            ttl = self.defaultTTL
+        expires = time.time() + ttl if ttl > 0 else 0
+        with self.lock:
+            self.Remove(name, False)
+            self.entries[name] = (value, size, expires)
+            self.size += size
+            if expires:
+                heapq.heappush(self.expiries, (expires, name))
+            self.Write(["set", name, expires, value])
+            self.Expire()
+            while self.maxSize and self.size > self.maxSize and len(self.entries) > 1:
+                self.Remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def Get(self, name, default=None):
+        with self.lock:
+            self.Expire()
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            # most recently used
+            self.entries[name] = entry
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def Delete(self, name):
+        with self.lock:
+            self.Remove(name)
+
+    def Remove(self, name, log=True):
+        """Drop a value. The caller holds the lock."""
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= entry[1]
+            if log:
+                self.Write(["del", name])
+
+    def Expire(self):
+        """Drop the values that expired. The caller holds the lock."""
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, name = heapq.heappop(self.expiries)
+            entry = self.entries.get(name)
+            if entry is not None and entry[2] == expires:
+                self.Remove(name)
+                self.stats["expirations"] += 1
+
+    def __contains__(self, name):
+        with self.lock:
+            self.Expire()
+            return name in self.entries
+
+    def __getitem__(self, name):
+        missing = object()
+        value = self.Get(name, missing)
+        if value is missing:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.Set(name, value)
+
+    def __delitem__(self, name):
+        self.Delete(name)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name, default=None):
+        return self.Get(name, default)
+
+    def keys(self):
+        with self.lock:
+            self.Expire()
+            return self.entries.keys()
+
+    def GetStats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), size=self.size, maxSize=self.maxSize)
+
+    def Load(self):
+        """Read back the log file of a previous run and open it for appending."""
+        records = collections.OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as logFile:
+                for line in logFile:
+                    try:
+                        record = JsonCodec.Decode(line)
+                    except Exception:
+                        # the last record of a crashed run may be incomplete
+                        continue
+                    records.pop(record[1], None)
+                    if record[0] == "set":
+                        records[record[1]] = record
+        now = time.time()
+        records = [record for record in records.itervalues() if not record[2] or record[2] > now]
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.Compact(records)
+        for dummyCommand, name, expires, value in records:
+            size = len(repr(value))
+            self.entries[name] = (value, size, expires)
+            self.size += size
+            if expires:
+                heapq.heappush(self.expiries, (expires, name))
+
+    def Write(self, record):
+        """Append a change to the log file. The caller holds the lock."""
+        if self.log is None:
+            return
+        self.log.write(JsonCodec.Encode(record) + "\n")
+        self.log.flush()
+        self.logRecords += 1
+        if self.logRecords > 2 * len(self.entries) + 1000:
+            self.Compact([["set", name, expires, value] for name, (value, size, expires) in self.entries.iteritems()])
+
+    def Compact(self, records):
+        """Replace the log file with one that only holds the given records."""
+        if self.log is not None:
+            self.log.close()
+        with open(self.path + ".new", "wb") as logFile:
+            for record in records:
+                logFile.write(JsonCodec.Encode(record) + "\n")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + ".new", self.path)
+        self.log = open(self.path, "ab")
+        self.logRecords = len(records)
+
+    def Close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+
+class ExpressionCache(object):
+    """
+    Compiled dataRequest expressions, least recently used first, and the
+    results of the expressions that have a result lifetime(in seconds).
+    """
+
+    def __init__(self, maxSize, resultTTLs):
+        self.maxSize = maxSize
+        self.resultTTLs = resultTTLs
+        self.lock = threading.Lock()
+        self.compiled = collections.OrderedDict()
+        # expression -> (expires, result)
+        self.results = {}
+        # expression -> Future of the evaluation whose result the other callers wait for
+        self.evaluating = {}
+        self.stats = dict(compileHits=0, compileMisses=0, resultHits=0, resultMisses=0)
+
+    def Evaluate(self, expression, globalNames, localNames):
+        ttl = self.resultTTLs.get(expression)
+        future = None
+        with self.lock:
+            if ttl:
+                expires, result = self.results.get(expression, (0, None))
+                if expires > time.time():
+                    self.stats["resultHits"] += 1
+                    return result
+                if expression in self.evaluating:
+                    # another request is evaluating it already, share its result
+                    self.stats["resultHits"] += 1
+                    future = self.evaluating[expression]
+                else:
+                    self.stats["resultMisses"] += 1
+                    self.evaluating[expression] = Future()
+        if future is not None:
+            result = future.Result()
+            if future.error is not None:
+                raise future.error
+            return result
+        if ttl:
+            try:
+                result = self.Compute(expression, globalNames, localNames)
+            except:
+                with self.lock:
+                    future = self.evaluating.pop(expression)
+                future.SetResult(None, sys.exc_info()[1])
+                raise
+            with self.lock:
+                self.results[expression] = (time.time() + ttl, result)
+                future = self.evaluating.pop(expression)
+            future.SetResult(result)
+            return result
+        return self.Compute(expression, globalNames, localNames)
+
+    def Compute(self, expression, globalNames, localNames):
+        """Evaluate an expression with the cached compilation of it."""
+        with self.lock:
+            code = self.compiled.pop(expression, None)
+            if code is None:
+                self.stats["compileMisses"] += 1
+            else:
+                self.stats["compileHits"] += 1
+        if code is None:
+            code = compile(expression, "<dataRequest>", "eval")
+        with self.lock:
+            self.compiled[expression] = code
+            while len(self.compiled) > self.maxSize:
+                self.compiled.popitem(False)
+        return eval(code, globalNames, localNames)
+
+    def GetStats(self):
+        with self.lock:
+            return dict(self.stats, compiled=len(self.compiled), maxSize=self.maxSize, results=len(self.results))
+
+
+class Compression(object):
+    """
+    zlib compression of encoded values that are longer than threshold bytes,
+    with the statistics of both directions.
+    """
+
+    def __init__(self, threshold, maxSize):
+        self.threshold = threshold
+        # decompressed values can't get larger than a received line may be
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.stats = dict(
+            compressed=0, incompressible=0, bytesBefore=0, bytesAfter=0, compressTime=0.0,
+            decompressed=0, bytesReceived=0, bytesDecompressed=0, decompressTime=0.0,
+        )
+
+    def Compress(self, text):
+        if not self.threshold or len(text) <= self.threshold:
+            return text
+        start = timeit.default_timer()
+        compressed = "z" + base64.b64encode(zlib.compress(text))
+        elapsed = timeit.default_timer() - start
+        with self.lock:
+            self.stats["compressTime"] += elapsed
+            if len(compressed) >= len(text):
+                self.stats["incompressible"] += 1
+                return text
+            self.stats["compressed"] += 1
+            self.stats["bytesBefore"] += len(text)
+            self.stats["bytesAfter"] += len(compressed)
+        return compressed
+
+    def Decompress(self, text, maxSize=None):
+        # repr and JSON encodings never start with a "z"
+        if text[:1] != "z":
+            return text
+        maxSize = maxSize or self.maxSize
+        start = timeit.default_timer()
+        decompressor = zlib.decompressobj()
+        decompressed = decompressor.decompress(base64.b64decode(text[1:]), maxSize)
+        if decompressor.unconsumed_tail:
+            raise ValueError("The compressed value is larger than " + str(maxSize) + " bytes")
+        elapsed = timeit.default_timer() - start
+        with self.lock:
+            self.stats["decompressed"] += 1
+            self.stats["bytesReceived"] += len(text)
+            self.stats["bytesDecompressed"] += len(decompressed)
+            self.stats["decompressTime"] += elapsed
+        return decompressed
+
+    def GetStats(self):
+        with self.lock:
+            stats = dict(self.stats, threshold=self.threshold)
+        # compressed size / original size of what was sent and received
+        stats["ratio"] = stats["bytesAfter"] / float(stats["bytesBefore"]) if stats["bytesBefore"] else None
+        stats["receivedRatio"] = stats["bytesReceived"] / float(stats["bytesDecompressed"]) if stats["bytesDecompressed"] else None
+        return stats
+
+
+class CompressedCodec(object):
+    """A codec whose encodings go through Compression."""
+
+    def __init__(self, codec, compression):
+        self.codec = codec
+        self.compression = compression
+
+    def Encode(self, value):
+        return self.compression.Compress(self.codec.Encode(value))
+
+    def Decode(self, text, maxSize=None):
+        return self.codec.Decode(self.compression.Decompress(text, maxSize))
+
+
+def GetCodec(capabilities, compression=None):
+    codec = JsonCodec if "json" in capabilities else ReprCodec
+    if "zlib" in capabilities and compression is not None:
+        codec = CompressedCodec(codec, compression)
+    return codec
+
+
 class TCPEvents(eg.PluginBase):
     text = Text
-    receivedData = {}
 
     def __init__(self):
         self.AddEvents()
         self.AddAction(SendEvent)
+        self.AddAction(SendEventBatch)
+        self.AddAction(BroadcastEvent)
         self.AddAction(SendData)
         self.AddAction(GetData)
         self.AddAction(RequestData)
+        self.AddAction(RequestMultipleData)
+        self.AddAction(SubscribeData)
+        self.AddAction(GetServerStatistics)
         self.server = None
-
-    def __start__(self, port, password, prefix, inclSrcIP, conTimeout=DefaultValues.defaultTimeout, comTimeout=DefaultValues.defaultTimeout):
-        self.lock = threading.Lock()
+        self.serverThread = None
+        self.pool = None
+        self.sendQueue = None
+        self.requestQueue = None
+        self.timers = None
+        self.metricsServer = None
+        self.udpServer = None
+        self.udpSender = None
+        self.subscriptions = None
+        self.resolver = None
+        self.replicas = None
+        self.outbox = None
+        self.stats = ServerStats()
+        self.receivedData = DataStore()
+        # (sender address:port, name) -> [received bytes, total bytes] of the chunked transfers in progress
+        self.transfers = {}
+
+    def __start__(self, port, password, prefix, inclSrcIP, conTimeout=DefaultValues.defaultTimeout, comTimeout=DefaultValues.defaultTimeout, poolEnabled=DefaultValues.poolEnabled, poolSize=DefaultValues.poolSize, poolIdleTimeout=DefaultValues.poolIdleTimeout, maxLineSize=DefaultValues.maxLineSize, engine=DefaultValues.engine, queueWorkers=DefaultValues.queueWorkers, queueDepth=DefaultValues.queueDepth, queuePolicy=DefaultValues.queuePolicy, queueEvents=DefaultValues.queueEvents, hostGroups=DefaultValues.hostGroups, storeSize=DefaultValues.storeSize, storeTTL=DefaultValues.storeTTL, storePersist=DefaultValues.storePersist, exprCacheSize=DefaultValues.exprCacheSize, cachedResults=DefaultValues.cachedResults, requestWorkers=DefaultValues.requestWorkers, requestTimeout=DefaultValues.requestTimeout, requestsPerClient=DefaultValues.requestsPerClient, ticketLifetime=DefaultValues.ticketLifetime, metricsPort=DefaultValues.metricsPort, connectionRate=DefaultValues.connectionRate, connectionBurst=DefaultValues.connectionBurst, eventRate=DefaultValues.eventRate, eventBurst=DefaultValues.eventBurst, floodPolicy=DefaultValues.floodPolicy, listenBacklog=DefaultValues.listenBacklog, compressThreshold=DefaultValues.compressThreshold, udpEnabled=DefaultValues.udpEnabled, coalesceRules=DefaultValues.coalesceRules, resolverTTL=DefaultValues.resolverTTL, resolverNegativeTTL=DefaultValues.resolverNegativeTTL, outboxSize=DefaultValues.outboxSize, outboxTTL=DefaultValues.outboxTTL, maxTransferSize=DefaultValues.maxTransferSize):
+        self.lock = InstrumentedLock()
+        self.eventLines = {}
+        # the ServerHandlers of the open sessions
+        self.handlers = set()
+        # the ServerHandlers with a subscription
+        self.subscribers = set()
+        self.stats = ServerStats()
         self.port = port
         self.password = password
         self.info.eventPrefix = prefix
@@ -179,48 +881,230 @@ class TCPEvents(eg.PluginBase):
         self.includeSourceIP = inclSrcIP
         self.connectionTimeout = conTimeout
         self.communicationTimeout = comTimeout
+        self.maxLineSize = maxLineSize * 1024 * 1024
+        self.maxTransferSize = maxTransferSize * 1024 * 1024
+        self.compression = Compression(compressThreshold * 1024, self.maxLineSize)
+        self.resolver = Resolver(resolverTTL, resolverNegativeTTL) if resolverTTL > 0 else None
+        self.replicas = Replicas()
+        self.pool = ConnectionPool(self, poolSize if poolEnabled else 0, poolIdleTimeout)
+        self.subscriptions = Subscriptions(self)
+        self.outbox = None
+        if outboxSize > 0:
+            path = os.path.join(eg.configDir, "TCPEvents", "outbox-%d" % port)
+            try:
+                self.outbox = Outbox(self, path, outboxSize * 1024 * 1024, outboxTTL)
+                self.outbox.start()
+            except (IOError, OSError), exc:
+                eg.PrintError("TCPEvents: Unable to keep unsent events in " + path + ": " + str(exc))
+        self.sendQueue = WorkerPool("TCPEventsSend", queueWorkers, queueDepth, queuePolicy)
+        self.sendEvents = queueEvents
+        path = os.path.join(eg.configDir, "TCPEvents", "receivedData-%d.log" % port) if storePersist else None
+        try:
+            self.receivedData = DataStore(storeSize * 1024 * 1024, storeTTL, path)
+        except (IOError, OSError), exc:
+            eg.PrintError("TCPEvents: Unable to keep received data in " + path + ": " + str(exc))
+            self.receivedData = DataStore(storeSize * 1024 * 1024, storeTTL)
+        # dataRequest expressions written for earlier versions read TCPEvents.receivedData
+        TCPEvents.receivedData = self.receivedData
+        self.hostGroups = {}
+        if hostGroups.strip() != "":
+            try:
+                self.hostGroups = dict(eval(hostGroups))
+            except:
+                eg.PrintError("Unable to evaluate the host groups. They must be a dict of group names and address lists(example: {\"lights\": [\"192.168.1.10\", \"192.168.1.11:1025\"]}).")
+        resultTTLs = {}
+        if cachedResults.strip() != "":
+            try:
+                resultTTLs = dict(eval(cachedResults))
+            except:
+                eg.PrintError("Unable to evaluate the cached results. They must be a dict of expressions and seconds(example: {\"eg.globals.temperature\": 10}).")
+        self.expressions = ExpressionCache(exprCacheSize, resultTTLs)
+        self.requestQueue = WorkerPool("TCPEventsRequest", requestWorkers, MAX_QUEUED_REQUESTS, WorkerPool.REJECT)
+        self.requestTimeout = requestTimeout
+        self.requestsPerClient = requestsPerClient
+        self.timers = Timers("TCPEventsTimers")
+        self.timers.start()
+        self.tickets = Tickets(ticketLifetime) if ticketLifetime > 0 else None
+        self.udpSender = UdpSender(self.resolver)
+        self.coalescer = None
+        if coalesceRules.strip() != "":
+            try:
+                rules = dict(eval(coalesceRules))
+            except:
+                eg.PrintError("Unable to evaluate the coalescing rules. They must be a dict of event name patterns and (\"debounce\", \"throttle\" or \"latest\", seconds)(example: {\"TCP.Temperature*\": (\"latest\", 5)}).")
+            else:
+                self.coalescer = Coalescer(rules, self.timers, self.TriggerEvent)
+        self.connectionLimit = TokenBuckets(connectionRate, connectionBurst) if connectionRate > 0 else None
+        self.eventLimit = TokenBuckets(eventRate, eventBurst) if eventRate > 0 else None
+        self.dropEvents = floodPolicy == 1
         try:
-            self.server = Server(self.port, self.password, self)
+            if engine == 1:
+                self.serverThread = ServerThread()
+                self.server = Server(self.port, self.password, self, self.serverThread.map, listenBacklog)
+                self.serverThread.start()
+            else:
+                self.server = Server(self.port, self.password, self, backlog=listenBacklog)
+            if udpEnabled:
+                # the same port number as TCP, also when the OS picked it
+                self.udpServer = UdpServer(self.server.socket.getsockname()[1], self.password, self, self.serverThread.map if self.serverThread else None)
+            if metricsPort:
+                self.metricsServer = MetricsServer(metricsPort, self, self.serverThread.map if self.serverThread else None)
         except socket.error, exc:
             eg.PrintError("Exception in TCPEvents.__start__")
             raise self.Exception(exc[1])
 
     def __stop__(self):
+        if self.serverThread:
+            self.serverThread.Stop()
+        self.serverThread = None
+        for handler in list(self.handlers):
+            # pooled senders log in again, to the restarted plugin with its new settings,
+            # and the subscribers subscribe again
+            handler.close()
         if self.server:
             self.server.close()
         self.server = None
+        if self.metricsServer:
+            self.metricsServer.close()
+        self.metricsServer = None
+        if self.udpServer:
+            self.udpServer.close()
+        self.udpServer = None
+        if self.udpSender:
+            self.udpSender.Close()
+        self.udpSender = None
+        if self.subscriptions:
+            self.subscriptions.Close()
+        self.subscriptions = None
+        if self.outbox:
+            self.outbox.Stop()
+        self.outbox = None
+        if self.sendQueue:
+            self.sendQueue.Close()
+        self.sendQueue = None
+        if self.pool:
+            self.pool.Close()
+        self.pool = None
+        if self.requestQueue:
+            self.requestQueue.Close()
+        self.requestQueue = None
+        if self.timers:
+            self.timers.Stop()
+        self.timers = None
+        self.receivedData.Close()
 
     def __close__(self):
-        if self.server:
-            self.server.close()
-        self.server = None
+        # __stop__ leaves nothing behind, running it again is harmless
+        self.__stop__()
 
-    def Configure(self, port=1024, password="", prefix="TCP", inclSrcIP=True, conTimeout=DefaultValues.defaultTimeout, comTimeout=DefaultValues.defaultTimeout):
+    def Configure(self, port=1024, password="", prefix="TCP", inclSrcIP=True, conTimeout=DefaultValues.defaultTimeout, comTimeout=DefaultValues.defaultTimeout, poolEnabled=DefaultValues.poolEnabled, poolSize=DefaultValues.poolSize, poolIdleTimeout=DefaultValues.poolIdleTimeout, maxLineSize=DefaultValues.maxLineSize, engine=DefaultValues.engine, queueWorkers=DefaultValues.queueWorkers, queueDepth=DefaultValues.queueDepth, queuePolicy=DefaultValues.queuePolicy, queueEvents=DefaultValues.queueEvents, hostGroups=DefaultValues.hostGroups, storeSize=DefaultValues.storeSize, storeTTL=DefaultValues.storeTTL, storePersist=DefaultValues.storePersist, exprCacheSize=DefaultValues.exprCacheSize, cachedResults=DefaultValues.cachedResults, requestWorkers=DefaultValues.requestWorkers, requestTimeout=DefaultValues.requestTimeout, requestsPerClient=DefaultValues.requestsPerClient, ticketLifetime=DefaultValues.ticketLifetime, metricsPort=DefaultValues.metricsPort, connectionRate=DefaultValues.connectionRate, connectionBurst=DefaultValues.connectionBurst, eventRate=DefaultValues.eventRate, eventBurst=DefaultValues.eventBurst, floodPolicy=DefaultValues.floodPolicy, listenBacklog=DefaultValues.listenBacklog, compressThreshold=DefaultValues.compressThreshold, udpEnabled=DefaultValues.udpEnabled, coalesceRules=DefaultValues.coalesceRules, resolverTTL=DefaultValues.resolverTTL, resolverNegativeTTL=DefaultValues.resolverNegativeTTL, outboxSize=DefaultValues.outboxSize, outboxTTL=DefaultValues.outboxTTL, maxTransferSize=DefaultValues.maxTransferSize):
         text = self.text
         panel = eg.ConfigPanel()
 
         portCtrl = panel.SpinIntCtrl(port, max=65535)
+        maxLineSizeCtrl = panel.SpinIntCtrl(maxLineSize, min=1, max=2048)
+        maxTransferSizeCtrl = panel.SpinIntCtrl(maxTransferSize, min=1, max=65536)
+        engineCtrl = panel.Choice(engine, text.engines)
         passwordCtrl = panel.TextCtrl(password, style=wx.TE_PASSWORD)
         eventPrefixCtrl = panel.TextCtrl(prefix)
         sourceIPCtrl = panel.CheckBox(inclSrcIP)
         connectionTimeoutCtrl = panel.SpinNumCtrl(conTimeout, integerWidth=2, increment=0.01)
         communicationTimeoutCtrl = panel.SpinNumCtrl(comTimeout, integerWidth=2, increment=0.01)
+        poolEnabledCtrl = panel.CheckBox(poolEnabled)
+        poolSizeCtrl = panel.SpinIntCtrl(poolSize, min=1, max=64)
+        poolIdleTimeoutCtrl = panel.SpinNumCtrl(poolIdleTimeout, integerWidth=4, increment=1)
+        resolverTTLCtrl = panel.SpinIntCtrl(resolverTTL, min=0, max=86400)
+        resolverNegativeTTLCtrl = panel.SpinIntCtrl(resolverNegativeTTL, min=0, max=3600)
+        outboxSizeCtrl = panel.SpinIntCtrl(outboxSize, min=0, max=65536)
+        outboxTTLCtrl = panel.SpinIntCtrl(outboxTTL, min=1, max=100000000)
+        queueWorkersCtrl = panel.SpinIntCtrl(queueWorkers, min=1, max=64)
+        queueDepthCtrl = panel.SpinIntCtrl(queueDepth, min=1, max=1000000)
+        queuePolicyCtrl = panel.Choice(queuePolicy, text.queuePolicies)
+        queueEventsCtrl = panel.CheckBox(queueEvents)
+        hostGroupsCtrl = panel.TextCtrl(hostGroups)
+        storeSizeCtrl = panel.SpinIntCtrl(storeSize, min=0, max=65536)
+        storeTTLCtrl = panel.SpinIntCtrl(storeTTL, min=0, max=100000000)
+        storePersistCtrl = panel.CheckBox(storePersist)
+        exprCacheSizeCtrl = panel.SpinIntCtrl(exprCacheSize, min=0, max=100000)
+        cachedResultsCtrl = panel.TextCtrl(cachedResults)
+        requestWorkersCtrl = panel.SpinIntCtrl(requestWorkers, min=1, max=64)
+        requestTimeoutCtrl = panel.SpinNumCtrl(requestTimeout, min=0.1, max=3600)
+        requestsPerClientCtrl = panel.SpinIntCtrl(requestsPerClient, min=1, max=1000)
+        ticketLifetimeCtrl = panel.SpinIntCtrl(ticketLifetime, min=0, max=86400)
+        metricsPortCtrl = panel.SpinIntCtrl(metricsPort, min=0, max=65535)
+        listenBacklogCtrl = panel.SpinIntCtrl(listenBacklog, min=1, max=65535)
+        compressThresholdCtrl = panel.SpinIntCtrl(compressThreshold, min=0, max=1048576)
+        udpEnabledCtrl = panel.CheckBox(udpEnabled)
+        coalesceRulesCtrl = panel.TextCtrl(coalesceRules)
+        connectionRateCtrl = panel.SpinNumCtrl(connectionRate, min=0, max=100000, integerWidth=6)
+        connectionBurstCtrl = panel.SpinIntCtrl(connectionBurst, min=1, max=100000)
+        eventRateCtrl = panel.SpinNumCtrl(eventRate, min=0, max=1000000, integerWidth=7)
+        eventBurstCtrl = panel.SpinIntCtrl(eventBurst, min=1, max=1000000)
+        floodPolicyCtrl = panel.Choice(floodPolicy, text.floodPolicies)
         st1 = panel.StaticText(text.port)
         st2 = panel.StaticText(text.password)
         st3 = panel.StaticText(text.eventPrefix)
         st4 = panel.StaticText(text.sourceIP)
         st5 = panel.StaticText(text.connectionTimeout)
         st6 = panel.StaticText(text.communicationTimeout)
-        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6))
-        box1 = panel.BoxedGroup(text.tcpBox, (st1, portCtrl))
-        box2 = panel.BoxedGroup(text.securityBox, (st2, passwordCtrl))
-        box3 = panel.BoxedGroup(text.eventGenerationBox, (st3, eventPrefixCtrl), (st4, sourceIPCtrl))
+        st7 = panel.StaticText(text.poolEnabled)
+        st8 = panel.StaticText(text.poolSize)
+        st9 = panel.StaticText(text.poolIdleTimeout)
+        st10 = panel.StaticText(text.maxLineSize)
+        st11 = panel.StaticText(text.engine)
+        st12 = panel.StaticText(text.queueWorkers)
+        st13 = panel.StaticText(text.queueDepth)
+        st14 = panel.StaticText(text.queuePolicy)
+        st15 = panel.StaticText(text.queueEvents)
+        st16 = panel.StaticText(text.hostGroups)
+        st17 = panel.StaticText(text.storeSize)
+        st18 = panel.StaticText(text.storeTTL)
+        st19 = panel.StaticText(text.storePersist)
+        st20 = panel.StaticText(text.exprCacheSize)
+        st21 = panel.StaticText(text.cachedResults)
+        st22 = panel.StaticText(text.requestWorkers)
+        st23 = panel.StaticText(text.requestTimeout)
+        st24 = panel.StaticText(text.requestsPerClient)
+        st25 = panel.StaticText(text.ticketLifetime)
+        st26 = panel.StaticText(text.metricsPort)
+        st27 = panel.StaticText(text.connectionRate)
+        st28 = panel.StaticText(text.connectionBurst)
+        st29 = panel.StaticText(text.eventRate)
+        st30 = panel.StaticText(text.eventBurst)
+        st31 = panel.StaticText(text.floodPolicy)
+        st32 = panel.StaticText(text.listenBacklog)
+        st33 = panel.StaticText(text.compressThreshold)
+        st34 = panel.StaticText(text.udpEnabled)
+        st35 = panel.StaticText(text.coalesceRules)
+        st36 = panel.StaticText(text.resolverTTL)
+        st37 = panel.StaticText(text.resolverNegativeTTL)
+        st38 = panel.StaticText(text.outboxSize)
+        st39 = panel.StaticText(text.outboxTTL)
+        st40 = panel.StaticText(text.maxTransferSize)
+        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6, st7, st8, st9, st10, st11, st12, st13, st14, st15, st16, st17, st18, st19, st20, st21, st22, st23, st24, st25, st26, st27, st28, st29, st30, st31, st32, st33, st34, st35, st36, st37, st38, st39, st40))
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, portCtrl), (st34, udpEnabledCtrl), (st32, listenBacklogCtrl), (st10, maxLineSizeCtrl), (st40, maxTransferSizeCtrl), (st33, compressThresholdCtrl), (st11, engineCtrl), (st26, metricsPortCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st2, passwordCtrl), (st25, ticketLifetimeCtrl))
+        box3 = panel.BoxedGroup(text.eventGenerationBox, (st3, eventPrefixCtrl), (st4, sourceIPCtrl), (st35, coalesceRulesCtrl))
+        box10 = panel.BoxedGroup(text.floodBox, (st27, connectionRateCtrl), (st28, connectionBurstCtrl), (st29, eventRateCtrl), (st30, eventBurstCtrl), (st31, floodPolicyCtrl))
         box4 = panel.BoxedGroup(text.timeoutBox, (st5, connectionTimeoutCtrl), (st6, communicationTimeoutCtrl))
+        box5 = panel.BoxedGroup(text.poolBox, (st7, poolEnabledCtrl), (st8, poolSizeCtrl), (st9, poolIdleTimeoutCtrl), (st36, resolverTTLCtrl), (st37, resolverNegativeTTLCtrl))
+        box6 = panel.BoxedGroup(text.queueBox, (st12, queueWorkersCtrl), (st13, queueDepthCtrl), (st14, queuePolicyCtrl), (st15, queueEventsCtrl))
+        box11 = panel.BoxedGroup(text.outboxBox, (st38, outboxSizeCtrl), (st39, outboxTTLCtrl))
+        box7 = panel.BoxedGroup(text.hostGroupsBox, (st16, hostGroupsCtrl))
+        box8 = panel.BoxedGroup(text.storeBox, (st17, storeSizeCtrl), (st18, storeTTLCtrl), (st19, storePersistCtrl))
+        box9 = panel.BoxedGroup(text.requestBox, (st22, requestWorkersCtrl), (st23, requestTimeoutCtrl), (st24, requestsPerClientCtrl), (st20, exprCacheSizeCtrl), (st21, cachedResultsCtrl))
         panel.sizer.AddMany([
             (box1, 0, wx.EXPAND),
             (box2, 0, wx.EXPAND | wx.TOP, 10),
             (box3, 0, wx.EXPAND | wx.TOP, 10),
+            (box10, 0, wx.EXPAND | wx.TOP, 10),
             (box4, 0, wx.EXPAND | wx.TOP, 10),
+            (box5, 0, wx.EXPAND | wx.TOP, 10),
+            (box6, 0, wx.EXPAND | wx.TOP, 10),
+            (box11, 0, wx.EXPAND | wx.TOP, 10),
+            (box7, 0, wx.EXPAND | wx.TOP, 10),
+            (box8, 0, wx.EXPAND | wx.TOP, 10),
+            (box9, 0, wx.EXPAND | wx.TOP, 10),
         ])
 
         while panel.Affirmed():
@@ -230,26 +1114,164 @@ class TCPEvents(eg.PluginBase):
                 eventPrefixCtrl.GetValue(),
                 sourceIPCtrl.GetValue(),
                 connectionTimeoutCtrl.GetValue(),
-                communicationTimeoutCtrl.GetValue()
+                communicationTimeoutCtrl.GetValue(),
+                poolEnabledCtrl.GetValue(),
+                poolSizeCtrl.GetValue(),
+                poolIdleTimeoutCtrl.GetValue(),
+                maxLineSizeCtrl.GetValue(),
+                engineCtrl.GetValue(),
+                queueWorkersCtrl.GetValue(),
+                queueDepthCtrl.GetValue(),
+                queuePolicyCtrl.GetValue(),
+                queueEventsCtrl.GetValue(),
+                hostGroupsCtrl.GetValue(),
+                storeSizeCtrl.GetValue(),
+                storeTTLCtrl.GetValue(),
+                storePersistCtrl.GetValue(),
+                exprCacheSizeCtrl.GetValue(),
+                cachedResultsCtrl.GetValue(),
+                requestWorkersCtrl.GetValue(),
+                requestTimeoutCtrl.GetValue(),
+                requestsPerClientCtrl.GetValue(),
+                ticketLifetimeCtrl.GetValue(),
+                metricsPortCtrl.GetValue(),
+                connectionRateCtrl.GetValue(),
+                connectionBurstCtrl.GetValue(),
+                eventRateCtrl.GetValue(),
+                eventBurstCtrl.GetValue(),
+                floodPolicyCtrl.GetValue(),
+                listenBacklogCtrl.GetValue(),
+                compressThresholdCtrl.GetValue(),
+                udpEnabledCtrl.GetValue(),
+                coalesceRulesCtrl.GetValue(),
+                resolverTTLCtrl.GetValue(),
+                resolverNegativeTTLCtrl.GetValue(),
+                outboxSizeCtrl.GetValue(),
+                outboxTTLCtrl.GetValue(),
+                maxTransferSizeCtrl.GetValue()
             )
 
+    def GetStatistics(self):
+        """The statistics of the receiver and of the parts of the plugin that keep any."""
+        statistics = dict(
+            server=self.stats.GetStats(),
+            lock=self.lock.GetStats(),
+            receivedData=self.receivedData.GetStats(),
+        )
+        for name in ("pool", "sendQueue", "requestQueue", "expressions", "connectionLimit", "eventLimit", "compression", "coalescer", "subscriptions", "resolver", "replicas", "outbox"):
+            part = getattr(self, name, None)
+            if part is not None:
+                statistics[name] = part.GetStats()
+        return statistics
+
+    def PublishData(self, name, value):
+        """Push a value stored by Send Data to the sessions that subscribed to its name."""
+        encoded = {}
+        for handler in list(self.subscribers):
+            if not handler.Subscribed(name):
+                continue
+            if len(handler.producer_fifo) > MAX_PUSH_BACKLOG:
+                eg.PrintError("TCPEvents: The subscriber " + handler.ip + " doesn't keep up with the changes. Closing the socket.")
+                self.stats.Count("subscribersDropped")
+                handler.close()
+                continue
+            codec = handler.codec
+            if codec not in encoded:
+                encoded[codec] = "changed " + codec.Encode([name, value]) + "\n"
+            handler.push(encoded[codec])
+            self.stats.Count("dataPushed")
+
+    def TriggerLine(self, line, payload):
+        """Trigger the event of an event line received over TCP or UDP, with the list of its payload values."""
+        enduring = len(payload) > 0 and payload[-1] == "withoutRelease"
+        if enduring:
+            payload.remove("withoutRelease")
+        eventLines = self.eventLines
+        parsed = eventLines.get(line)
+        if parsed is None:
+            if len(eventLines) >= MAX_CACHED_EVENT_LINES:
+                eventLines.clear()
+            parsed = eventLines[line] = ParseEventLine(line)
+        prefix, suffix = parsed
+        prefix = prefix or self.prefix
+        self.stats.CountEvent(prefix)
+
+        if len(payload) == 0:
+            payload = None
+        elif len(payload) == 1:
+            payload = payload[0]
+        if not enduring and self.coalescer is not None and self.coalescer.Coalesce(prefix, suffix, payload):
+            return
+        # the prefix goes with the event, info.eventPrefix is shared by all connections
+        if enduring:
+            # the plugin has one enduring event at a time
+            with self.lock:
+                self.TriggerEnduringEvent(suffix, payload, prefix=prefix)
+        else:
+            self.TriggerEvent(suffix, payload, prefix=prefix)
+
+    def QueueSend(self, action):
+        """Run action.Send() on a background worker and return its Future."""
+        # the action object is reused by the next call, the worker needs its own copy
+        job = copy.copy(action)
+        job.progress = [0, 0]
+        future = self.sendQueue.Submit(job.Send)
+        future.progress = job.progress
+        if self.sendEvents:
+            future.AddDoneCallback(lambda future: self.SendDone(job, future))
+        return future
+
+    def ResolveHosts(self, hosts, defaultPort):
+        """
+        Turn a comma separated list of addresses, "address:port" entries and
+        host group names into a list of (address, port) tuples.
+        """
+        resolved = []
+        for entry in hosts.replace(";", ",").split(","):
+            entry = entry.strip()
+            if entry == "":
+                continue
+            for host in self.hostGroups.get(entry, [entry]):
+                host, port = str(host).strip(), defaultPort
+                if host.count(":") == 1:
+                    host, port = host.split(":")
+                    port = int(port)
+                if (host, port) not in resolved:
+                    resolved.append((host, port))
+        return resolved
+
+    def SendDone(self, job, future):
+        if future.result is None or future.result is False:
+            self.TriggerEvent("SendFailed", [job.host, job.port, future.error], prefix=self.prefix)
+        else:
+            self.TriggerEvent("SendCompleted", [job.host, job.port, future.result], prefix=self.prefix)
+
 
 class ServerHandler(asynchat.async_chat):
     """Telnet engine class. Implements command line user interface."""
 
+    # read large payloads in bigger pieces than asynchat's default of 4 KB
+    ac_in_buffer_size = 65536
+
     def __init__(self, sock, addr, password, plugin, server):
         log("Server Handler inited")
         self.plugin = plugin
+        self.active = True
+        plugin.stats.Count("connectionsOpened")
 
-        # Call constructor of the parent class
-        asynchat.async_chat.__init__(self, sock)
+        # Call constructor of the parent class, on the same asyncore map as the server
+        asynchat.async_chat.__init__(self, sock, server._map)
+        self.waker = server.waker
+        plugin.handlers.add(self)
 
         # Set up input line terminator
         self.set_terminator('\n')
 
         # Initialize input data buffer
-        self.data = ''
+        self.data = []
+        self.dataSize = 0
         self.ip = addr[0]
+        self.peer = self.ip + ":" + str(addr[1])
         self.payload = [self.ip] if self.plugin.includeSourceIP else []
         if (password != ""):
             self.state = self.state1
@@ -259,36 +1281,110 @@ class ServerHandler(asynchat.async_chat):
         else:
             self.clientType = "TCPEvents"
             self.state = self.state3
+        # the first line of a session without a password may be a hello
+        self.hello = password == ""
+        self.capabilities = frozenset()
+        self.codec = ReprCodec
         self.receivedDataName = ""
+        self.receivedDataTTL = None
+        self.transferFile = None
+        # [received bytes, total bytes] of the chunked transfer, also listed in plugin.transfers
+        self.transfer = None
+        self.batch = None
+        self.batchSize = 0
+        # Futures of the dataRequests being evaluated, their results are sent back in this order
+        self.pending = collections.deque()
+        self.closeRequested = False
+        # data names and patterns the sender subscribed to
+        self.subscribed = None
+        # the sender went over the event limit, the rest of what it sent waits here
+        # and its socket isn't read until the bucket refills
+        self.throttled = False
+        self.deferred = ""
+        self.replaying = False
 
     def handle_close(self):
         self.plugin.EndLastEvent()
+        self.AbortTransfer()
+        self.DropRequests()
         asynchat.async_chat.handle_close(self)
 
+    def close(self):
+        if self.active:
+            self.active = False
+            self.plugin.stats.Count("connectionsClosed")
+        self.plugin.handlers.discard(self)
+        self.plugin.subscribers.discard(self)
+        asynchat.async_chat.close(self)
+
+    def recv(self, bufferSize):
+        if self.replaying:
+            # Unthrottle hands asynchat the deferred data instead
+            return ""
+        data = asynchat.async_chat.recv(self, bufferSize)
+        self.plugin.stats.Count("bytesIn", len(data))
+        return data
+
+    def readable(self):
+        return not self.throttled
+
+    def send(self, data):
+        sent = asynchat.async_chat.send(self, data)
+        self.plugin.stats.Count("bytesOut", sent or 0)
+        return sent
+
     def collect_incoming_data(self, data):
         """Put data read from socket to a buffer"""
-        # Collect data in input buffer
+        # Collect data in input buffer. The chunks are only joined once the
+        # line is complete, appending to a string would copy it every time.
         log("<<" + repr(data))
-        self.data = self.data + data
+        if self.transferFile is not None:
+            # part of a chunked value, asynchat counts down the bytes left
+            self.transferFile.write(data)
+            self.transfer[0] += len(data)
+            return
+        if self.dataSize < 0:
+            # the rest of an oversized line, already rejected
+            return
+        self.dataSize += len(data)
+        if self.dataSize > self.plugin.maxLineSize:
+            eg.PrintError("TCPEvents: Line from " + self.ip + " exceeds " + str(self.plugin.maxLineSize) + " bytes. Closing the socket.")
+            self.data = []
+            self.dataSize = -1
+            self.initiate_close()
+            return
+        self.data.append(data)
 
-    if DEBUG:
-        def push(self, data):
+    def push(self, data):
+        if DEBUG:
             log(">>", repr(data))
-            asynchat.async_chat.push(self, data)
+        asynchat.async_chat.push(self, data)
+        # pushes from the handlers of other sockets or from the Waker change what this one waits for
+        Touch(self)
 
     def found_terminator(self):
         """
         This method is called by asynchronous engine when it finds
         command terminator in the input stream
         """
+        if self.transferFile is not None:
+            self.FinishTransfer()
+            return
+        if self.dataSize < 0:
+            return
+
         # Take the complete line
-        line = self.data
+        line = "".join(self.data)
 
         # Reset input buffer
-        self.data = ''
+        self.data = []
+        self.dataSize = 0
 
         # call state handler
-        self.state(line)
+        state = self.state
+        start = timeit.default_timer()
+        state(line)
+        self.plugin.stats.Observe(state.__name__, timeit.default_timer() - start)
 
     def initiate_close(self):
         try:
@@ -298,6 +1394,8 @@ class ServerHandler(asynchat.async_chat):
             eg.PrintError("Error in ServerHandler.initiate_close(push/close_when_done): " + str(sys.exc_info()))
         # asynchat.async_chat.handle_close(self)
         self.plugin.EndLastEvent()
+        self.AbortTransfer()
+        self.DropRequests()
         self.state = self.state1
         try:
             self.close()
@@ -305,11 +1403,22 @@ class ServerHandler(asynchat.async_chat):
             eg.PrintError("Error in ServerHandler.initiate_close (close)" + str(sys.exc_info()))
 
     def state1(self, line):
-        """get keyword "quintessence\n" and send cookie"""
+        """get keyword "quintessence\n" and send cookie, or a resumption ticket"""
         if line == "quintessence":
             self.state = self.state2
             self.push(self.cookie + "\n")
+        elif line[:7] == "resume " and self.plugin.tickets is not None:
+            capabilities = self.plugin.tickets.Redeem(self.ip, line[7:])
+            if capabilities is None:
+                # expired, replayed or from before a restart, the sender authenticates as usual
+                self.plugin.stats.Count("ticketsRejected")
+                self.push(" reject\n")
+            else:
+                self.plugin.stats.Count("ticketsRedeemed")
+                self.clientType = "TCPEvents"
+                self.Accept(capabilities)
         else:
+            self.plugin.stats.Count("handshakeFailures")
             self.initiate_close()
 
     def state2(self, line):
@@ -319,25 +1428,65 @@ class ServerHandler(asynchat.async_chat):
         if digest == "":
             pass
         elif digest.upper() == self.hex_md5:
+            capabilities = None
             if len(line) > 32:
-                self.clientType = "TCPEvents" if line[:-32] == "TCPEvents" else "Network Event Sender"
+                tag = line[:-32]
+                if tag == "TCPEvents":
+                    self.clientType = "TCPEvents"
+                elif tag.startswith("TCPEvents/"):
+                    # the sender asked for optional protocol features
+                    self.clientType = "TCPEvents"
+                    capabilities = frozenset(tag[10:].split(","))
+                else:
+                    self.clientType = "Network Event Sender"
             else:
                 self.clientType = "Network Event Sender"
             # print "From Server: clientType = " + self.clientType
-            self.push(" accept\n")
-            self.state = self.state3
+            self.Accept(capabilities)
         else:
             eg.PrintError("NetworkReceiver MD5 error")
+            self.plugin.stats.Count("handshakeFailures")
             self.initiate_close()
 
+    def Accept(self, capabilities):
+        """Let an authenticated sender in, granting the capabilities it asked for that we know."""
+        self.plugin.stats.Count("handshakes")
+        if capabilities is None:
+            self.push(" accept\n")
+        else:
+            self.capabilities = capabilities.intersection(CAPABILITIES)
+            if self.plugin.tickets is None or self.plugin.password == "":
+                self.capabilities -= frozenset(["ticket"])
+            self.codec = GetCodec(self.capabilities, self.plugin.compression)
+            if "mux" in self.capabilities:
+                # results go out one by one as they are done, don't let Nagle hold them for the sender's delayed ACK
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            granted = sorted(self.capabilities)
+            if "mux" in self.capabilities:
+                granted.append("mux=%d" % self.plugin.requestsPerClient)
+            self.push(" accept/" + ",".join(granted) + "\n")
+            if "ticket" in self.capabilities:
+                self.push("ticket " + self.plugin.tickets.Issue(self.ip, self.capabilities) + "\n")
+        self.state = self.state3
+
     def state3(self, line):
         line = line.decode(eg.systemEncoding)
+        if self.hello:
+            self.hello = False
+            prefix, suffix = HELLO.split("%s")
+            if line.startswith(prefix) and line.endswith(suffix):
+                self.Accept(frozenset(str(line[len(prefix):-len(suffix)]).split(",")))
+                return
         if line == "close":
-            self.initiate_close()
+            if self.pending:
+                # answer the dataRequests first
+                self.closeRequested = True
+            else:
+                self.initiate_close()
         elif line[:8] == "payload ":
             if self.clientType == "TCPEvents":
                 try:
-                    self.payload.append(eval(line[8:])[0])
+                    self.payload.append(self.codec.Decode(line[8:]))
                 except:
                     eg.PrintError("Unable to eval the payload, receiving the full string")
                     self.payload.append(line[8:])
@@ -345,92 +1494,308 @@ class ServerHandler(asynchat.async_chat):
                 self.payload.append(line[8:])
         elif self.clientType == "TCPEvents" and line[:12] == "dataRequest ":
             dataRequest = line[12:]
-            try:
-                result = []
-                result.append(eval(str(eval(dataRequest)[0])))
-            except:
-                eg.PrintError("Unable to respond to dataRequest: " + dataRequest + ". Closing the socket.")
-                result = None
-                self.initiate_close()
-            if result is not None:
-                self.push("result " + str(result) + "\n")
-                self.initiate_close()
+            self.QueueRequest(dataRequest, locals())
+        elif "subscribe" in self.capabilities and line[:10] == "subscribe ":
+            self.Subscribe(line[10:])
+        elif "mux" in self.capabilities and line[:14] == "dataRequestId ":
+            requestId, dummySeparator, dataRequest = line[14:].partition(" ")
+            self.QueueRequest(dataRequest, locals(), str(requestId))
         elif self.clientType == "TCPEvents" and line[:9] == "dataName ":
             self.receivedDataName = str(line[9:])
+        elif self.clientType == "TCPEvents" and line[:8] == "dataTTL ":
+            try:
+                self.receivedDataTTL = float(line[8:])
+            except ValueError:
+                eg.PrintError("Invalid dataTTL: " + line[8:])
         elif self.clientType == "TCPEvents" and line[:5] == "data ":
             if self.receivedDataName != "":
-                receivedData = eval(line[5:])[0]
-                self.plugin.receivedData[self.receivedDataName] = receivedData
+                self.StoreData(self.codec.Decode(line[5:]), len(line) - 5)
             else:
                 eg.PrintError("Data received before dataName. Closing the socket.")
-            self.initiate_close()
+                self.initiate_close()
+        elif self.clientType == "TCPEvents" and line[:12] == "dataChunked ":
+            self.StartTransfer(line[12:])
+        elif "batch" in self.capabilities and line[:6] == "batch ":
+            try:
+                size = int(line[6:])
+            except ValueError:
+                size = 0
+            if 0 < size <= MAX_BATCH_SIZE:
+                self.batch = []
+                self.batchSize = size
+            else:
+                eg.PrintError("Invalid batch size: " + line[6:] + ". Closing the socket.")
+                self.initiate_close()
         else:
-            if line == "ButtonReleased":
+            if self.batch is not None:
+                # every line counts towards the batch size, ButtonReleased too
+                self.batch.append((line, self.payload))
+                if len(self.batch) == self.batchSize:
+                    self.DispatchBatch()
+            elif line == "ButtonReleased":
                 self.plugin.EndLastEvent()
             else:
-                if len(self.payload) > 0 and self.payload[-1] == "withoutRelease":
-                    self.payload.remove("withoutRelease")
-
-                    self.plugin.lock.acquire()
-                    try:
-                        if line.find(".") == 0:
-                            line = line[1:]
-                        if line.find(".") == len(line) - 1:
-                            line = line[:-1]
-                        if line.find(".") > 0:
-                            self.plugin.info.eventPrefix = line[:line.find(".")]
-                            line = line[line.find(".") + 1:]
-                        else:
-                            self.plugin.info.eventPrefix = self.plugin.prefix
-
-                        if len(self.payload) == 0:
-                            self.plugin.TriggerEnduringEvent(line, None)
-                        elif len(self.payload) == 1:
-                            self.plugin.TriggerEnduringEvent(line, self.payload[0])
-                        else:
-                            self.plugin.TriggerEnduringEvent(line, self.payload)
-                    finally:
-                        self.plugin.lock.release()
-                else:
-                    self.plugin.lock.acquire()
-                    try:
-                        if line.find(".") == 0:
-                            line = line[1:]
-                        if line.find(".") == len(line) - 1:
-                            line = line[:-1]
-                        if line.find(".") > 0:
-                            self.plugin.info.eventPrefix = line[:line.find(".")]
-                            line = line[line.find(".") + 1:]
-                        else:
-                            self.plugin.info.eventPrefix = self.plugin.prefix
-
-                        if len(self.payload) == 0:
-                            self.plugin.TriggerEvent(line, None)
-                        elif len(self.payload) == 1:
-                            self.plugin.TriggerEvent(line, self.payload[0])
-                        else:
-                            self.plugin.TriggerEvent(line, self.payload)
-                    finally:
-                        self.plugin.lock.release()
+                self.TriggerLine(line, self.payload)
 
             self.payload = [self.ip] if self.plugin.includeSourceIP else []
 
+    def QueueRequest(self, dataRequest, namespace, requestId=None):
+        """
+        Evaluate a dataRequest on a worker thread, so a slow expression doesn't
+        stall the receiver. The result of a request with an id is sent back as
+        soon as it is done, the others in the order they were received.
+        """
+        if len(self.pending) >= self.plugin.requestsPerClient:
+            if requestId is not None:
+                # the sender doesn't respect our mux=<n>, it gets no answer for this one
+                self.push("resultError " + requestId + "\n")
+                return
+            eg.PrintError("Too many pending dataRequests from " + self.ip + ". Closing the socket.")
+            self.initiate_close()
+            return
+        future = self.plugin.requestQueue.Submit(self.Evaluate, dataRequest, namespace)
+        future.requestId = requestId
+        future.timer = self.plugin.timers.Schedule(self.plugin.requestTimeout, self.waker.Call, self.ExpireRequest, future)
+        self.pending.append(future)
+        future.AddDoneCallback(lambda future: self.waker.Call(self.FlushResults))
+
+    def Evaluate(self, dataRequest, namespace):
+        """Return the encoded result of a dataRequest, or None if it can't be evaluated. Runs on a worker thread."""
+        try:
+            expression = str(self.codec.Decode(dataRequest))
+            return self.codec.Encode(self.plugin.expressions.Evaluate(expression, globals(), namespace))
+        except:
+            eg.PrintError("Unable to respond to dataRequest: " + dataRequest)
+            return None
+
+    def FlushResults(self):
+        """Send back the results of the dataRequests that are done, those without an id in the order they were received."""
+        blocked = False
+        for future in list(self.pending):
+            if future.requestId is not None:
+                if future.Done():
+                    self.pending.remove(future)
+                    self.plugin.timers.Cancel(future.timer)
+                    if future.result is None:
+                        # one bad expression doesn't cost the sender its other requests
+                        self.push("resultError " + future.requestId + "\n")
+                    else:
+                        self.push("resultId " + future.requestId + " " + future.result + "\n")
+                continue
+            if blocked or not future.Done():
+                blocked = True
+                continue
+            self.pending.remove(future)
+            self.plugin.timers.Cancel(future.timer)
+            if future.result is None:
+                if future.error is not None:
+                    eg.PrintError("Unable to respond to a dataRequest from " + self.ip + "(" + str(future.error) + "). Closing the socket.")
+                self.initiate_close()
+                return
+            self.push("result " + future.result + "\n")
+            if "keepalive" not in self.capabilities:
+                self.initiate_close()
+                return
+        if self.closeRequested and not self.pending:
+            self.initiate_close()
+
+    def ExpireRequest(self, future):
+        if future in self.pending and not future.Done() and future.requestId is not None:
+            eg.PrintError("A dataRequest from " + self.ip + " took longer than " + str(self.plugin.requestTimeout) + " seconds.")
+            self.pending.remove(future)
+            self.push("resultError " + future.requestId + "\n")
+            if self.closeRequested and not self.pending:
+                self.initiate_close()
+        elif future in self.pending and not future.Done():
+            eg.PrintError("A dataRequest from " + self.ip + " took longer than " + str(self.plugin.requestTimeout) + " seconds. Closing the socket.")
+            self.initiate_close()
+
+    def DropRequests(self):
+        for future in self.pending:
+            self.plugin.timers.Cancel(future.timer)
+        self.pending.clear()
+
+    def Subscribe(self, value):
+        """Push the stored values whose names match the subscribed names or patterns, and their later changes."""
+        try:
+            patterns = self.codec.Decode(value)
+        except:
+            patterns = None
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        if not isinstance(patterns, list) or not all(isinstance(pattern, basestring) for pattern in patterns):
+            # Subscribed runs in the Send Data of other senders, it can't take anything but strings
+            eg.PrintError("Invalid subscription from " + self.ip + ". Closing the socket.")
+            self.initiate_close()
+            return
+        self.subscribed = patterns
+        self.plugin.subscribers.add(self)
+        self.plugin.stats.Count("subscriptions")
+        missing = object()
+        for name in self.plugin.receivedData.keys():
+            if self.Subscribed(name):
+                value = self.plugin.receivedData.Get(name, missing)
+                if value is not missing:
+                    self.push("changed " + self.codec.Encode([name, value]) + "\n")
+                    self.plugin.stats.Count("dataPushed")
+
+    def Subscribed(self, name):
+        for pattern in self.subscribed:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def StoreData(self, value, size):
+        self.plugin.receivedData.Set(self.receivedDataName, value, self.receivedDataTTL, size)
+        if self.plugin.subscribers:
+            self.plugin.PublishData(self.receivedDataName, value)
+        self.receivedDataName = ""
+        self.receivedDataTTL = None
+        if "keepalive" not in self.capabilities:
+            self.initiate_close()
+
+    def StartTransfer(self, size):
+        """Receive the next size bytes as the encoded value of a chunked transfer."""
+        try:
+            size = int(size)
+        except ValueError:
+            size = -1
+        maxSize = self.plugin.receivedData.maxSize
+        if self.receivedDataName == "" or size < 0:
+            eg.PrintError("Invalid chunked data from " + self.ip + ". Closing the socket.")
+            self.initiate_close()
+            return
+        if size > self.plugin.maxTransferSize or (maxSize and size > maxSize):
+            eg.PrintError("TCPEvents: Chunked data " + self.receivedDataName + " of " + str(size) + " bytes from " + self.ip + " is too large. Closing the socket.")
+            self.initiate_close()
+            return
+        self.transferFile = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        self.transfer = [0, size]
+        self.plugin.transfers[(self.peer, self.receivedDataName)] = self.transfer
+        if size == 0:
+            self.FinishTransfer()
+        else:
+            self.set_terminator(size)
+
+    def FinishTransfer(self):
+        self.set_terminator("\n")
+        transferFile, self.transferFile = self.transferFile, None
+        self.plugin.transfers.pop((self.peer, self.receivedDataName), None)
+        self.transfer = None
+        transferFile.seek(0)
+        data = transferFile.read()
+        transferFile.close()
+        try:
+            if isinstance(self.codec, CompressedCodec):
+                # a chunked value may decompress to as much as a chunked transfer can take
+                value = self.codec.Decode(data, self.plugin.maxTransferSize)
+            else:
+                value = self.codec.Decode(data)
+        except:
+            eg.PrintError("Unable to decode the chunked data " + self.receivedDataName + ". Closing the socket.")
+            self.initiate_close()
+            return
+        self.StoreData(value, len(data))
+
+    def AbortTransfer(self):
+        if self.transferFile is not None:
+            self.transferFile.close()
+            self.transferFile = None
+            self.transfer = None
+            self.plugin.transfers.pop((self.peer, self.receivedDataName), None)
+
+    def DispatchBatch(self):
+        """Trigger the events of a completed batch in order and report the outcome of each one."""
+        batch = self.batch
+        self.batch = None
+        results = []
+        for line, payload in batch:
+            try:
+                results.append(self.TriggerLine(line, payload))
+            except:
+                eg.PrintError("Unable to trigger batched event " + line + ": " + str(sys.exc_info()))
+                results.append(False)
+        self.push("batchResult " + self.codec.Encode(results) + "\n")
+
+    def TriggerLine(self, line, payload):
+        """Trigger the event of a received event line. Returns False if the sender is over the event limit."""
+        if self.plugin.eventLimit is not None and not self.Admit():
+            return False
+        self.plugin.TriggerLine(line, payload)
+        return True
+
+    def Admit(self):
+        """
+        Take a token from the event bucket of the sender's address. Without
+        one the event is dropped or triggered on credit, depending on the
+        policy, and the rest of the received data waits, with the socket
+        unread, until the bucket has tokens again. TCP flow control then
+        slows the sender down to the limit, instead of the receiver spending
+        its time on the flood.
+        """
+        drop = self.plugin.dropEvents
+        wait = self.plugin.eventLimit.Take(self.ip, borrow=not drop)
+        if not wait:
+            return True
+        if not self.throttled:
+            self.throttled = True
+            # asynchat stops splitting lines when its buffer is empty
+            self.deferred = self.ac_in_buffer
+            self.ac_in_buffer = ""
+            self.plugin.stats.Count("throttled")
+            self.plugin.timers.Schedule(wait, self.waker.Call, self.Unthrottle)
+        if drop:
+            self.plugin.stats.Count("eventsDropped")
+            return False
+        return True
+
+    def Unthrottle(self):
+        self.throttled = False
+        Touch(self)
+        if self.deferred and self.active:
+            self.ac_in_buffer = self.deferred
+            self.deferred = ""
+            self.replaying = True
+            try:
+                self.handle_read()
+            finally:
+                self.replaying = False
+
+
+def ParseEventLine(line):
+    """Split a received event line into its prefix(None if it has none) and suffix."""
+    dot = line.find(".")
+    if dot == 0:
+        line = line[1:]
+        dot = line.find(".")
+    if dot == len(line) - 1:
+        line = line[:-1]
+        dot = line.find(".")
+    if dot > 0:
+        return line[:dot], line[dot + 1:]
+    return None, line
+
 
 class Server(asyncore.dispatcher):
 
-    def __init__(self, port, password, handler):
+    def __init__(self, port, password, handler, map=None, backlog=DefaultValues.listenBacklog):
         try:
             self.handler = handler
             self.password = password
+            self.backlog = backlog
 
             # Call parent class constructor explicitly
-            asyncore.dispatcher.__init__(self)
+            asyncore.dispatcher.__init__(self, map=map)
+
+            # lets other threads hand work to the thread that runs this map
+            self.waker = Waker(map)
 
             # Create socket of requested type
             self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
 
             # restart the asyncore loop, so it notices the new socket
-            eg.RestartAsyncore()
+            if map is None:
+                eg.RestartAsyncore()
 
             # Set it to re-use address
             # self.set_reuse_addr()
@@ -439,17 +1804,42 @@ class Server(asyncore.dispatcher):
             # Bind to all interfaces of this host at specified port
             self.bind(('', port))
 
-            # Start listening for incoming requests. The parameter is the maximum number of queued connections.
-            self.listen(5)
+            # Start listening for incoming requests. The parameter is the maximum number of queued
+            # connections, the OS caps it(somaxconn on Linux). When the queue is full, new connections
+            # are only retried after a second or more.
+            self.listen(backlog)
         except:
             eg.PrintError("TCPEvents: Error in Server.__init__: " + str(sys.exc_info()))
 
     def handle_accept(self):
-        """Called by asyncore engine when new connection arrives"""
-        # Accept new connection
+        """Called by asyncore engine when new connections arrive"""
+        # Accept all the queued connections, not one per loop iteration, so
+        # the queue doesn't overflow during a burst. Bounded by the backlog,
+        # connections that keep arriving meanwhile wait for the next round.
         log("handle_accept")
+        for dummyIndex in xrange(self.backlog):
+            try:
+                accepted = self.accept()
+            except socket.error:
+                # out of file descriptors for example, the connection stays queued
+                eg.PrintError("TCPEvents: Error in handle accept: " + str(sys.exc_info()))
+                return
+            if accepted is None:
+                # the queue is empty
+                return
+            self.Accept(*accepted)
+
+    def Accept(self, sock, addr):
         try:
-            (sock, addr) = self.accept()
+            self.handler.stats.Count("accepts")
+            limit = self.handler.connectionLimit
+            if limit is not None and limit.Take(addr[0]):
+                # over the connection limit, hang up before spending anything on it
+                self.handler.stats.Count("connectionsRejected")
+                sock.close()
+                return
+            # pooled senders keep their session open, let TCP notice peers that vanish
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             ServerHandler(
                 sock,
                 addr,
@@ -460,204 +1850,2043 @@ class Server(asyncore.dispatcher):
         except:
             eg.PrintError("TCPEvents: Error in handle accept: " + str(sys.exc_info()))
 
+    def close(self):
+        self.waker.close()
+        asyncore.dispatcher.close(self)
 
-class SendEvent(eg.ActionBase):
 
-    name = "Send an Event"
+class TokenBuckets(object):
+    """
+    A token bucket per key(the sender's address): it holds up to burst tokens
+    and refills at rate tokens per second.
+    """
 
-    def __call__(self, destIP, destPort, passwd, evtPref, evtSuf, evtPayloadStr, evtPayload):
-        if destIP == "":
-            eg.PrintError("Destination address field left blank.")
-        self.host = eg.ParseString(destIP)
-        self.port = destPort
-        self.password = eg.ParseString(passwd)
-        self.eventPrefix = eg.ParseString(evtPref)
-        self.eventSuffix = eg.ParseString(evtSuf)
-        if (evtPayloadStr is not None) and (evtPayloadStr != ""):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.lock = threading.Lock()
+        # key -> [tokens, time they were counted]
+        self.buckets = {}
+
+    def Take(self, key, count=1, borrow=False):
+        """
+        Take count tokens from the bucket of key. Returns 0 if there were
+        enough, else the seconds until there will be. If borrow is True the
+        tokens are taken anyway and the bucket goes into debt.
+        """
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_RATE_BUCKETS:
+                    self.Prune(now)
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= count:
+                bucket[0] -= count
+                return 0
+            if borrow:
+                bucket[0] -= count
+                return -bucket[0] / self.rate
+            return (count - bucket[0]) / self.rate
+
+    def Prune(self, now):
+        """Forget the buckets that are full by now, they are the same as new ones. The caller holds the lock."""
+        for key, (tokens, counted) in self.buckets.items():
+            if tokens + (now - counted) * self.rate >= self.burst:
+                del self.buckets[key]
+
+    def GetStats(self):
+        with self.lock:
+            return dict(rate=self.rate, burst=self.burst, senders=len(self.buckets))
+
+
+class Coalescer(object):
+    """
+    Holds back repeats of received events, by rules of an event name pattern
+    (fnmatch style, matched against "prefix.suffix"), a mode and a window in
+    seconds. The longest matching pattern applies.
+    - debounce: an event is triggered once the same event(same name and
+      payload) hasn't been received for the window.
+    - throttle: an event is triggered right away, the same event is dropped
+      until the window has passed.
+    - latest: the first event opens the window, when it closes the last
+      event received with the name is triggered, whatever its payload.
+    The held back events are triggered from the timers thread.
+    """
+
+    MODES = ("debounce", "throttle", "latest")
+
+    def __init__(self, rules, timers, trigger):
+        self.rules = []
+        for pattern, rule in rules.iteritems():
+            try:
+                mode, window = rule
+                window = float(window)
+            except (TypeError, ValueError):
+                mode, window = None, 0
+            if mode not in self.MODES or window <= 0:
+                eg.PrintError("TCPEvents: Ignoring the coalescing rule for " + pattern + ", it must be (\"debounce\", \"throttle\" or \"latest\", seconds).")
+                continue
+            self.rules.append((pattern, mode, window))
+        self.rules.sort(key=lambda rule: -len(rule[0]))
+        self.timers = timers
+        self.trigger = trigger
+        self.lock = threading.Lock()
+        # event name -> the rule that applies to it, None if none does
+        self.matches = {}
+        # key -> [rule, prefix, suffix, payload, time of the last event]
+        self.pending = {}
+        self.suppressed = dict((pattern, 0) for pattern, dummyMode, dummyWindow in self.rules)
+
+    def Match(self, name):
+        rule = self.matches.get(name, False)
+        if rule is False:
+            rule = None
+            for candidate in self.rules:
+                if fnmatch.fnmatchcase(name, candidate[0]):
+                    rule = candidate
+                    break
+            if len(self.matches) >= MAX_CACHED_EVENT_LINES:
+                self.matches.clear()
+            self.matches[name] = rule
+        return rule
+
+    def Coalesce(self, prefix, suffix, payload):
+        """Return True if the event is held back or dropped, False if it is to be triggered now."""
+        rule = self.Match(prefix + "." + suffix)
+        if rule is None:
+            return False
+        pattern, mode, window = rule
+        # repr, as payloads can be lists and dicts
+        key = (prefix, suffix) if mode == "latest" else (prefix, suffix, repr(payload))
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[3] = payload
+                entry[4] = now
+                self.suppressed[pattern] += 1
+                return True
+            self.pending[key] = [rule, prefix, suffix, payload, now]
+        self.timers.Schedule(window, self.Expire, key)
+        if mode == "throttle":
+            return False
+        return True
+
+    def Expire(self, key):
+        with self.lock:
+            entry = self.pending[key]
+            (dummyPattern, mode, window), prefix, suffix, payload, last = entry
+            if mode == "debounce":
+                remaining = last + window - time.time()
+                if remaining > 0:
+                    # the event came again, wait until it has been quiet for the window
+                    self.timers.Schedule(remaining, self.Expire, key)
+                    return
+            del self.pending[key]
+        if mode != "throttle":
+            self.trigger(suffix, payload, prefix=prefix)
+
+    def GetStats(self):
+        with self.lock:
+            return dict(
+                rules=len(self.rules),
+                pending=len(self.pending),
+                suppressed=sum(self.suppressed.itervalues()),
+                suppressedPerRule=dict(self.suppressed),
+            )
+
+
+class UdpServer(asyncore.dispatcher):
+    """
+    Receives events sent as single datagrams by Send an Event with Send over
+    UDP checked. A datagram is the header line
+    "TCPEvents/udp <sender> <sequence> <timestamp> <signature>" followed by the
+    lines of the event as they are sent over TCP, with the payload as JSON.
+    The signature is the HMAC-SHA256, keyed with the password, of everything
+    but the tag and itself. Datagrams older than UDP_MAX_AGE and sequence
+    numbers of a sender that were seen before are rejected.
+    """
+
+    def __init__(self, port, password, plugin, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.plugin = plugin
+        # keyed once, each datagram works on a copy
+        self.mac = hmac.new(PasswordKey(password), None, sha256)
+        self.replays = ReplayWindow(UDP_MAX_AGE)
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if map is None:
+            eg.RestartAsyncore()
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_BUFFER_SIZE)
+        except socket.error:
+            pass
+        self.bind(("", port))
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        for dummyIndex in xrange(MAX_DATAGRAMS_PER_READ):
             try:
-                self.eventPayload = eval(evtPayloadStr)
+                datagram, addr = self.socket.recvfrom(65536)
+            except socket.error, exc:
+                if exc.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                # Windows reports an ICMP port unreachable for an earlier datagram as an error
+                continue
+            try:
+                self.Receive(datagram, addr[0])
             except:
-                eg.PrintError("Unable to evaluate the payload. Payload must be a valid python expression(example: \"some\\\"Text\\\"\"). Your string will be sent unevaluated.")
-                self.eventPayload = evtPayloadStr
+                eg.PrintError("TCPEvents: Error in UDP receive: " + str(sys.exc_info()))
+
+    def Receive(self, datagram, ip):
+        stats = self.plugin.stats
+        stats.Count("datagrams")
+        stats.Count("bytesIn", len(datagram))
+        header, dummySeparator, body = datagram.partition("\n")
+        fields = header.split(" ")
+        if len(fields) != 5 or fields[0] != "TCPEvents/udp" or body[-1:] != "\n":
+            stats.Count("datagramsRejected")
+            return
+        mac = self.mac.copy()
+        mac.update(" ".join(fields[1:4]) + "\n" + body)
+        if not hmac.compare_digest(fields[4], mac.hexdigest()):
+            stats.Count("datagramsRejected")
+            return
+        now = time.time()
+        try:
+            sequence = int(fields[2])
+            timestamp = float(fields[3])
+        except ValueError:
+            stats.Count("datagramsRejected")
+            return
+        if abs(now - timestamp) > UDP_MAX_AGE or not self.replays.Check(fields[1], sequence, now):
+            stats.Count("datagramsReplayed")
+            return
+        lines = body[:-1].split("\n")
+        payload = [ip] if self.plugin.includeSourceIP else []
+        for line in lines[:-1]:
+            if line[:8] != "payload ":
+                stats.Count("datagramsRejected")
+                return
+            payload.append(JsonCodec.Decode(line[8:]))
+        limit = self.plugin.eventLimit
+        if limit is not None and limit.Take(ip):
+            # there is no slowing down a UDP sender
+            stats.Count("eventsDropped")
+            return
+        self.plugin.TriggerLine(lines[-1].decode("utf-8"), payload)
+
+
+class ReplayWindow(object):
+    """
+    The sequence numbers seen from each UDP sender, like the anti-replay window
+    of IPsec: the highest one and a bitmap of the ones before it. Senders not
+    heard from for maxAge seconds are forgotten, their datagrams would be too
+    old anyway.
+    """
+
+    SIZE = 64
+    MASK = (1 << SIZE) - 1
+
+    def __init__(self, maxAge):
+        self.maxAge = maxAge
+        # sender -> [highest sequence, bitmap, last seen]
+        self.senders = {}
+        self.pruned = time.time()
+
+    def Check(self, sender, sequence, now):
+        """Return True the first time a sequence number of the sender is seen, False for replays and stragglers."""
+        if now - self.pruned > self.maxAge:
+            for key, (dummyHighest, dummyBitmap, seen) in self.senders.items():
+                if now - seen > self.maxAge:
+                    del self.senders[key]
+            self.pruned = now
+        state = self.senders.get(sender)
+        if state is None:
+            self.senders[sender] = [sequence, 1, now]
+            return True
+        highest, bitmap = state[0], state[1]
+        if sequence > highest:
+            shift = sequence - highest
+            state[0] = sequence
+            state[1] = ((bitmap << shift) | 1) & self.MASK if shift < self.SIZE else 1
         else:
-            self.eventPayload = evtPayload
-        return self.Send()
+            offset = highest - sequence
+            if offset >= self.SIZE or (bitmap >> offset) & 1:
+                return False
+            state[1] = bitmap | (1 << offset)
+        state[2] = now
+        return True
 
-    def Configure(self, destIP="", destPort=1024, passwd="", evtPref="", evtSuf="{eg.result}", evtPayloadStr="", evtPayload=None):
-        text = Text
-        panel = eg.ConfigPanel()
-
-        # if evtPref == "":
-        #    evtPref = self.plugin.prefix
 
-        addrCtrl = panel.TextCtrl(destIP)
-        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
-        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
-        evtPrefCtrl = panel.TextCtrl(evtPref)
-        evtSufCtrl = panel.TextCtrl(evtSuf)
-        evtPldCtrl = panel.TextCtrl(evtPayloadStr)
+class UdpSender(object):
+    """Sends events as datagrams for UdpServer. Looks like a connection to a TCPEvents receiver to FormatEvent."""
 
-        st1 = panel.StaticText(text.address)
-        st2 = panel.StaticText(text.port)
-        st3 = panel.StaticText(text.password)
-        st4 = panel.StaticText(text.prefix)
-        st5 = panel.StaticText(text.suffix)
-        st6 = panel.StaticText(text.payload)
+    serverType = "TCPEvents"
+    codec = JsonCodec
 
-        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6))
+    def __init__(self, resolver=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.resolver = resolver
+        # random, so the receiver can tell the sequence numbers of this run from earlier ones
+        self.sender = os.urandom(8).encode("hex")
+        self.sequence = itertools.count(1)
 
-        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl))
-        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
-        box3 = panel.BoxedGroup(
-            text.eventGenerationBox,
-            (st4, evtPrefCtrl),
-            (st5, evtSufCtrl),
-            (st6, evtPldCtrl)
-        )
+    def Send(self, host, port, password, body):
+        header = "%s %d %.6f" % (self.sender, next(self.sequence), time.time())
+        signature = hmac.new(PasswordKey(password), header + "\n" + body, sha256).hexdigest()
+        datagram = "TCPEvents/udp %s %s\n%s" % (header, signature, body)
+        if len(datagram) > MAX_DATAGRAM_SIZE:
+            raise ValueError("The event is too large for a datagram(" + str(len(datagram)) + " bytes), send it over TCP")
+        self.socket.sendto(datagram, self.resolver.Resolve(host, port)[0] if self.resolver else (host, port))
 
-        panel.sizer.AddMany([
-            (box1, 0, wx.EXPAND),
-            (box2, 0, wx.EXPAND | wx.TOP, 10),
-            (box3, 0, wx.EXPAND | wx.TOP, 10),
-        ])
+    def Close(self):
+        self.socket.close()
 
-        while panel.Affirmed():
-            panel.SetResult(
-                addrCtrl.GetValue(),
-                portCtrl.GetValue(),
-                passwordCtrl.GetValue(),
-                evtPrefCtrl.GetValue(),
-                evtSufCtrl.GetValue(),
-                evtPldCtrl.GetValue(),
-                None
-            )
 
-    def Send(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(self.plugin.connectionTimeout)
-        try:
-            sock.connect((self.host, self.port))
-            sock.settimeout(self.plugin.communicationTimeout)
-            # First wake up the server, for security reasons it does not
-            # respond by itself it needs this string, why this odd word ?
-            # well if someone is scanning ports "connect" would be very
-            # obvious this one you'd never guess :-)
-            serverType = "TCPEvents"
-            if (self.password != ""):
-                sock.sendall("quintessence\n\r")
-                # The server now returns a cookie, the protocol works like the
-                # APOP protocol. The server gives you a cookie you add :<password>
-                # calculate the MD5 digest out of this and send it back
-                # if the digests match you are in.
-                # We do this so that no one can listen in on our password exchange
-                # much safer than plain text.
+def PasswordKey(password):
+    return password.encode("utf-8") if isinstance(password, unicode) else password
 
-                cookie = sock.recv(128)
 
-                # Trim all enters and whitespaces off
-                cookie = cookie.strip()
+class Histogram(object):
+    """Counts of observed values per bucket, with their sum and maximum."""
 
-                # Combine the token <cookie>:<password>
-                token = cookie + ":" + self.password
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.max = 0.0
 
-                # Calculate the digest
-                digest = md5(token).hexdigest()
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
 
-                # add the enters
-                digest = digest + "\n"
+    def GetStats(self):
+        """The count of values up to each bound, like a Prometheus histogram."""
+        buckets = collections.OrderedDict()
+        total = 0
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return dict(count=total, sum=self.sum, max=self.max, buckets=buckets)
 
-                # Send it to the server
-                sock.sendall("TCPEvents" + digest)
 
-                # Get the answer
-                answer = sock.recv(512)
+class ServerStats(object):
+    """Counters of the receiver, the events triggered per prefix and the time spent in each handler state."""
 
-                # If the password was correct and you are allowed to connect
-                # to the server, you'll get "accept"
-                if (answer.strip() != "accept"):
-                    sock.close()
-                    return False
-                elif (answer.strip("\n") == " accept"):
-                    serverType = "TCPEvents"
-                else:
-                    serverType = "Network Event Receiver"
-                # print "From Client: Server Type = " + serverType
+    LATENCY_BOUNDS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
 
-            # now just pipe those commands to the server
-            if (self.eventPrefix is not None) and (len(self.eventPrefix) > 0) and (serverType == "TCPEvents"):
-                eventString = self.eventPrefix + "." + self.eventSuffix
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys((
+            "accepts", "connectionsOpened", "connectionsClosed", "handshakes", "handshakeFailures",
+            "ticketsRedeemed", "ticketsRejected", "bytesIn", "bytesOut", "events",
+            "connectionsRejected", "eventsDropped", "throttled",
+            "datagrams", "datagramsRejected", "datagramsReplayed",
+            "subscriptions", "dataPushed", "subscribersDropped",
+        ), 0)
+        self.events = collections.Counter()
+        self.states = {}
+
+    def Count(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def CountEvent(self, prefix):
+        with self.lock:
+            self.counters["events"] += 1
+            self.events[prefix] += 1
+
+    def Observe(self, state, seconds):
+        with self.lock:
+            histogram = self.states.get(state)
+            if histogram is None:
+                histogram = self.states[state] = Histogram(self.LATENCY_BOUNDS)
+            histogram.Observe(seconds)
+
+    def GetStats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["activeConnections"] = stats["connectionsOpened"] - stats["connectionsClosed"]
+            stats["eventsPerPrefix"] = dict(self.events)
+            stats["stateLatency"] = dict((state, histogram.GetStats()) for state, histogram in self.states.iteritems())
+        return stats
+
+
+# labels of the metrics whose dict keys aren't part of the metric name
+METRIC_LABELS = {"eventsPerPrefix": "prefix", "buckets": "le", "suppressedPerRule": "rule", "depthPerDestination": "destination"}
+
+
+def FormatMetrics(stats, name="tcpevents"):
+    """The numbers in a (nested) statistics dict, in the Prometheus text format."""
+    lines = []
+    for key, value in sorted(stats.iteritems()):
+        if isinstance(value, dict):
+            if key in METRIC_LABELS:
+                for labelValue, number in value.iteritems():
+                    lines.append('%s_%s{%s="%s"} %s' % (name, key, METRIC_LABELS[key], str(labelValue).replace('"', '\\"'), FormatNumber(number)))
             else:
-                eventString = self.eventSuffix
-
-            if (self.eventPayload is not None):
-                # payload will be passed to eval by the server so that we can get back the exact same object(s) we have here
-                srcData = self.eventPayload
-                if serverType == "TCPEvents":
-                    srcDataLst = []
-                    srcDataLst.append(srcData)
-                    srcDataStr = unicode(srcDataLst)
-                else:
-                    srcDataStr = str(srcData)
-                sock.sendall(
-                    (u'payload ' + srcDataStr + u'\n').encode("utf-8")
-                )
-
-            if serverType != "TCPEvents":
-                sock.sendall("payload withoutRelease\n")
-            sock.sendall((eventString + "\n").encode("utf-8"))
-            # tell the server that we are done nicely.
-            sock.sendall("close\n")
-            sock.close()
-            return [eventString, srcData if (self.eventPayload is not None) else None]
-        except:
-            if eg.debugLevel:
-                eg.PrintTraceback()
-            sock.close()
-            self.PrintError("An error occurred while sending your event")
-            return None
+                lines.extend(FormatMetrics(value, name + "_" + key))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            lines.append("%s_%s %s" % (name, key, FormatNumber(value)))
+    return lines
 
 
-class SendData(eg.ActionBase):
-    name = "Send Data"
+def FormatNumber(number):
+    # repr keeps the precision of floats, str doesn't add an L to longs
+    return repr(number) if isinstance(number, float) else str(number)
 
-    def __call__(self, destIP, destPort, passwd, dataName, dataToEval, data):
-        if destIP == "":
-            eg.PrintError("Destination address field is blank")
-        self.host = eg.ParseString(destIP)
-        self.port = destPort
-        self.password = eg.ParseString(passwd)
-        self.dataName = eg.ParseString(dataName)
-        if (dataToEval is not None) and (dataToEval != ""):
-            try:
-                self.data = eval(dataToEval)
-            except:
-                eg.PrintError("Error evaluating " + str(dataToEval) + ". Sending None to the server.")
-                self.data = None
-        else:
-            self.data = data
-        return self.Send()
 
-    def Configure(self, destIP="", destPort=1024, passwd="", dataName="data1", dataToEval="", data=None):
-        text = Text
-        panel = eg.ConfigPanel()
+class MetricsHandler(asynchat.async_chat):
+    """Answers an HTTP request with the statistics of the plugin."""
 
-        addrCtrl = panel.TextCtrl(destIP)
-        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
-        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
-        dataNameCtrl = panel.TextCtrl(dataName)
-        dataCtrl = panel.TextCtrl(dataToEval)
+    def __init__(self, sock, plugin, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.plugin = plugin
+        self.set_terminator("\r\n\r\n")
 
-        st1 = panel.StaticText(text.address)
-        st2 = panel.StaticText(text.port)
-        st3 = panel.StaticText(text.password)
-        st4 = panel.StaticText(text.dataName)
-        st5 = panel.StaticText(text.dataToSend)
-        eg.EqualizeWidths((st1, st2, st3, st4, st5))
+    def collect_incoming_data(self, data):
+        pass
 
-        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl))
-        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
-        box3 = panel.BoxedGroup(text.dataBox, (st4, dataNameCtrl), (st5, dataCtrl))
+    def found_terminator(self):
+        body = "\n".join(FormatMetrics(self.plugin.GetStatistics())) + "\n"
+        self.push("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        self.close_when_done()
+
+
+class MetricsServer(asyncore.dispatcher):
+    """Serves the statistics of the plugin on a local port, for monitoring tools to scrape."""
+
+    def __init__(self, port, plugin, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.plugin = plugin
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        if map is None:
+            eg.RestartAsyncore()
+        self.bind(("127.0.0.1", port))
+        self.listen(5)
+
+    def handle_accept(self):
+        try:
+            sock, dummyAddr = self.accept()
+            MetricsHandler(sock, self.plugin, self._map)
+        except:
+            eg.PrintError("TCPEvents: Error in MetricsServer.handle_accept: " + str(sys.exc_info()))
+
+
+class EpollMap(dict):
+    """
+    An asyncore map that tells its EpollPoller about the sockets that come
+    and go. Together with Touch it spares the poller from asking every
+    socket whether it is readable or writable before every wait.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.poller = None
+        # file descriptors whose readable() or writable() may have changed
+        self.dirty = set()
+
+    def __setitem__(self, fd, obj):
+        dict.__setitem__(self, fd, obj)
+        self.dirty.add(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.dirty.discard(fd)
+        if self.poller is not None:
+            # before the socket is closed and its file descriptor reused
+            self.poller.Forget(fd)
+
+
+def Touch(dispatcher):
+    """Tell the EpollPoller of a dispatcher's map that it may want to read or write something else."""
+    dirty = getattr(dispatcher._map, "dirty", None)
+    if dirty is not None:
+        dirty.add(dispatcher._fileno)
+
+
+class EpollPoller(object):
+    """
+    asyncore.poll2 for an EpollMap, using epoll instead of poll. A socket's
+    readable() and writable() are only asked again after it had an event,
+    after something was pushed to it and when it was added, so a wakeup
+    costs in the number of busy sockets, not in the number of connections.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        map.poller = self
+        self.epoll = select.epoll()
+        # fd -> the flags it is registered with
+        self.registered = {}
+
+    def Update(self, fd):
+        obj = self.map.get(fd)
+        if obj is None:
+            return
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        if flags:
+            # Only check for exceptions if object was either readable
+            # or writable.
+            flags |= select.EPOLLERR | select.EPOLLHUP
+        registered = self.registered.get(fd)
+        if registered is None:
+            self.epoll.register(fd, flags)
+        elif registered != flags:
+            self.epoll.modify(fd, flags)
+        self.registered[fd] = flags
+
+    def Forget(self, fd):
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def Poll(self, timeout):
+        map = self.map
+        dirty = map.dirty
+        while dirty:
+            self.Update(dirty.pop())
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, OSError, select.error), exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            asyncore.readwrite(obj, flags)
+            # handling the event may have changed what it waits for
+            if fd in map:
+                dirty.add(fd)
+
+    def Close(self):
+        self.epoll.close()
+
+
+class ServerThread(threading.Thread):
+    """
+    Runs the receiver on its own asyncore map and thread instead of
+    EventGhost's shared asyncore loop. Uses epoll where it is available
+    and poll or select otherwise.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="TCPEventsServer")
+        self.setDaemon(True)
+        self.map = {}
+        self.stopEvent = threading.Event()
+        self.poller = None
+        if hasattr(select, "epoll"):
+            self.map = EpollMap()
+            self.poller = EpollPoller(self.map)
+            self.Poll = self.poller.Poll
+        elif hasattr(select, "poll"):
+            self.Poll = lambda timeout: asyncore.poll2(timeout, self.map)
+        else:
+            self.Poll = lambda timeout: asyncore.poll(timeout, self.map)
+
+    def run(self):
+        while not self.stopEvent.isSet():
+            try:
+                self.Poll(0.5)
+            except:
+                eg.PrintError("TCPEvents: Error in the server thread: " + str(sys.exc_info()))
+                time.sleep(0.5)
+
+    def Stop(self):
+        self.stopEvent.set()
+        if self.isAlive():
+            self.join()
+        asyncore.close_all(self.map)
+        if self.poller:
+            self.poller.Close()
+
+
+class Waker(asyncore.dispatcher):
+    """
+    Runs functions on the thread of an asyncore map on behalf of other
+    threads. Call() queues the function and wakes the loop up by sending a
+    byte over a loopback connection that the map is watching.
+    """
+
+    def __init__(self, map=None):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(1)
+            self.sender = socket.create_connection(listener.getsockname())
+            sock, dummyAddr = listener.accept()
+        finally:
+            listener.close()
+        self.sender.setblocking(0)
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+
+    def Call(self, func, *args):
+        self.calls.append((func, args))
+        with self.lock:
+            try:
+                self.sender.send("x")
+            except socket.error:
+                # closed, or so many wakeups are pending that the buffer is full
+                pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.calls:
+            func, args = self.calls.popleft()
+            try:
+                func(*args)
+            except:
+                eg.PrintTraceback()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.sender.close()
+
+
+class Tickets(object):
+    """
+    Resumption tickets: proof, signed with a key that only lives as long as
+    the plugin runs, that a sender authenticated recently. A ticket is only
+    valid from the address it was issued to, until it expires, and once.
+    """
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.key = os.urandom(32)
+        self.lock = threading.Lock()
+        # nonce -> expiry of the redeemed tickets that haven't expired yet
+        self.redeemed = {}
+
+    def Sign(self, ip, body):
+        return hmac.new(self.key, ip + " " + body, sha256).hexdigest()
+
+    def Issue(self, ip, capabilities):
+        body = "%d:%s:%s" % (time.time() + self.lifetime, os.urandom(8).encode("hex"), ",".join(sorted(capabilities)))
+        return body + ":" + self.Sign(ip, body)
+
+    def Redeem(self, ip, ticket):
+        """Return the capabilities granted with a valid ticket, None if it isn't valid."""
+        body, dummySeparator, signature = ticket.strip().rpartition(":")
+        try:
+            expires, nonce, capabilities = body.split(":")
+            expires = int(expires)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(str(signature), self.Sign(ip, str(body))):
+            return None
+        now = time.time()
+        with self.lock:
+            for used, usedExpires in self.redeemed.items():
+                if usedExpires < now:
+                    del self.redeemed[used]
+            if expires < now or nonce in self.redeemed:
+                return None
+            self.redeemed[nonce] = expires
+        return frozenset(capabilities.split(","))
+
+
+class Resolver(object):
+    """
+    Cached host name lookups for the senders. A lookup is kept for ttl
+    seconds and a failed one for negativeTTL seconds. A name that is still
+    used late in its lifetime is looked up again in the background, so busy
+    receivers never wait for a lookup. IP addresses aren't cached, there is
+    nothing to look up.
+    """
+
+    def __init__(self, ttl, negativeTTL):
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.lock = threading.Lock()
+        # host -> [addresses or the lookup error, expires, refreshing]
+        self.entries = {}
+        self.stats = dict(hits=0, misses=0, negativeHits=0, refreshes=0, failures=0)
+
+    def Resolve(self, host, port):
+        """Return the (address, port) of each IPv4 address of the host. Raises socket.gaierror if it has none."""
+        if IsIPAddress(host):
+            return [(host, port)]
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry[1] > now:
+                result = entry[0]
+                if isinstance(result, Exception):
+                    self.stats["negativeHits"] += 1
+                    raise result
+                self.stats["hits"] += 1
+                if not entry[2] and entry[1] - now < self.ttl * (1 - RESOLVER_REFRESH_AFTER):
+                    entry[2] = True
+                    self.stats["refreshes"] += 1
+                    refresher = threading.Thread(target=self.Lookup, args=(host,), name="TCPEventsResolver")
+                    refresher.setDaemon(True)
+                    refresher.start()
+                return [(address, port) for address in result]
+            self.stats["misses"] += 1
+        result = self.Lookup(host)
+        if isinstance(result, Exception):
+            raise result
+        return [(address, port) for address in result]
+
+    def Lookup(self, host):
+        """Look the host up and cache the addresses, or the error."""
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+            # in the order of the resolver, without duplicates
+            result = []
+            for info in infos:
+                if info[4][0] not in result:
+                    result.append(info[4][0])
+            expires = time.time() + self.ttl
+        except socket.error, exc:
+            result = exc
+            expires = time.time() + self.negativeTTL
+        with self.lock:
+            if isinstance(result, Exception):
+                self.stats["failures"] += 1
+                entry = self.entries.get(host)
+                if entry is not None and entry[2] and entry[1] > time.time():
+                    # a background lookup failed, keep the addresses until they expire
+                    entry[2] = False
+                    return result
+            if len(self.entries) >= MAX_RESOLVED_NAMES and host not in self.entries:
+                self.entries.clear()
+            self.entries[host] = [result, expires, False]
+        return result
+
+    def GetStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["names"] = len(self.entries)
+        lookups = stats["hits"] + stats["negativeHits"] + stats["misses"]
+        stats["hitRate"] = (stats["hits"] + stats["negativeHits"]) / float(lookups) if lookups else 0.0
+        return stats
+
+
+def IsIPAddress(host):
+    try:
+        socket.inet_aton(host)
+    except (socket.error, TypeError, UnicodeError):
+        return False
+    # inet_aton also takes abbreviations such as "1"
+    return host.count(".") == 3
+
+
+def IsClosedSession(exc):
+    """Whether a socket error means the receiver had closed the connection, unlike a timeout."""
+    return not isinstance(exc, socket.timeout) and exc.args[:1] in ((errno.ECONNRESET,), (errno.EPIPE,), (errno.ECONNABORTED,))
+
+
+def ConnectFirst(addresses, timeout):
+    """
+    Connect to the first of the addresses that answers. With more than one
+    address they are all tried at once, so an address that is down doesn't
+    cost a connection timeout.
+    """
+    if len(addresses) == 1:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(addresses[0])
+        except:
+            sock.close()
+            raise
+        return sock
+    pending = []
+    error = None
+    for address in addresses:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(0)
+        code = sock.connect_ex(address)
+        if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending.append(sock)
+        else:
+            sock.close()
+            error = socket.error(code, os.strerror(code))
+    winner = None
+    deadline = time.time() + timeout
+    try:
+        while pending and winner is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            dummyReadable, writable, failed = select.select([], pending, pending, remaining)
+            for sock in set(writable + failed):
+                # Windows reports failed connects as exceptional, the others as writable with an error
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                pending.remove(sock)
+                if code == 0 and winner is None:
+                    winner = sock
+                else:
+                    sock.close()
+                    if code != 0:
+                        error = socket.error(code, os.strerror(code))
+    finally:
+        for sock in pending:
+            sock.close()
+    if winner is None:
+        raise error or socket.timeout("timed out")
+    winner.settimeout(timeout)
+    return winner
+
+
+class Connection(object):
+    """A session with a receiver, authenticated and ready for commands."""
+
+    def __init__(self, host, port, password, compression=None, resolver=None):
+        self.key = (host, port, password)
+        self.compression = compression
+        self.resolver = resolver
+        self.sock = None
+        self.buffer = ""
+        self.serverType = "TCPEvents"
+        self.capabilities = frozenset()
+        self.codec = ReprCodec
+        # dataRequestIds the receiver takes at a time, receivers that predate mux=<n> take the default
+        self.requestsInFlight = MAX_REQUESTS_IN_FLIGHT
+        self.reused = False
+        # the receiver sent something since the current transaction started
+        self.replied = False
+        self.lastUsed = time.time()
+        # resumption ticket for the next connection to the receiver
+        self.ticket = None
+
+    def Open(self, connectionTimeout, communicationTimeout, capabilities=(), ticket=None):
+        """
+        Connect and authenticate, with a resumption ticket if there is one.
+        Returns False if the receiver refused the password and None if it
+        doesn't understand the requested capabilities, in which case the
+        connection must be opened again without them.
+        """
+        host, port, password = self.key
+        addresses = self.resolver.Resolve(host, port) if self.resolver else [(host, port)]
+        sock = ConnectFirst(addresses, connectionTimeout)
+        self.sock = sock
+        sock.settimeout(communicationTimeout)
+        if (password == "") and capabilities:
+            sock.sendall(HELLO % ",".join(capabilities) + "\n")
+            try:
+                answer = self.ReadLine()
+            except socket.timeout:
+                raise
+            except socket.error:
+                # hung up on the hello
+                answer = ""
+            if answer.startswith(" accept/"):
+                self.Accepted(answer[8:], capabilities)
+                return True
+            # an older TCPEvents receiver answered the hello as a dataRequest
+            self.Close(False)
+            return None
+        if (password != "") and (ticket is not None):
+            sock.sendall("resume " + ticket + "\n")
+            answer = self.ReadLine()
+            if answer.startswith(" accept/"):
+                self.Accepted(answer[8:], capabilities)
+                return True
+            elif answer != " reject":
+                raise socket.error("The receiver doesn't take resumption tickets anymore")
+        if (password != ""):
+            # First wake up the server, for security reasons it does not
+            # respond by itself it needs this string, why this odd word ?
+            # well if someone is scanning ports "connect" would be very
+            # obvious this one you'd never guess :-)
+            sock.sendall("quintessence\n\r")
+
+            # The server now returns a cookie, the protocol works like the
+            # APOP protocol. The server gives you a cookie you add :<password>
+            # calculate the MD5 digest out of this and send it back
+            # if the digests match you are in.
+            # We do this so that no one can listen in on our password exchange
+            # much safer than plain text.
+            cookie = sock.recv(128)
+
+            # Trim all enters and whitespaces off
+            cookie = cookie.strip()
+
+            # Combine the token <cookie>:<password> and calculate the digest
+            digest = md5(cookie + ":" + password).hexdigest()
+
+            # Send it to the server, asking for the optional features we'd like to use
+            tag = "TCPEvents"
+            if capabilities:
+                tag += "/" + ",".join(capabilities)
+            sock.sendall(tag + digest + "\n")
+
+            # Get the answer
+            answer = sock.recv(512)
+            if "\n" in answer:
+                # a ticket may follow the answer
+                answer, self.buffer = answer.split("\n", 1)
+
+            # If the password was correct and you are allowed to connect
+            # to the server, you'll get "accept"
+            if answer.strip().startswith("accept/"):
+                self.Accepted(answer.strip()[7:], capabilities)
+            elif (answer.strip() != "accept"):
+                self.Close(False)
+                return False
+            elif (answer.strip("\n") == " accept"):
+                if capabilities:
+                    # an older TCPEvents receiver took us for a Network Event Sender
+                    self.Close(False)
+                    return None
+            else:
+                self.serverType = "Network Event Receiver"
+            # print "From Client: Server Type = " + self.serverType
+        return True
+
+    def Accepted(self, granted, capabilities):
+        granted = granted.split(",")
+        self.capabilities = frozenset(granted).intersection(capabilities)
+        for capability in granted:
+            if capability[:4] == "mux=" and capability[4:].isdigit():
+                self.requestsInFlight = max(1, min(int(capability[4:]), MAX_REQUESTS_IN_FLIGHT))
+        self.codec = GetCodec(self.capabilities, self.compression)
+        if "mux" in self.capabilities:
+            # requests go out as the answers come in, in small writes
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if "ticket" in self.capabilities:
+            answer = self.ReadLine()
+            if answer[:7] == "ticket ":
+                self.ticket = answer[7:]
+
+    def Send(self, data):
+        self.sock.sendall(data)
+
+    def ReadLine(self):
+        """Return the next line sent by the receiver, without its terminator."""
+        while "\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error(errno.ECONNRESET, "Connection closed by the receiver")
+            self.replied = True
+            self.buffer += data
+        line, self.buffer = self.buffer.split("\n", 1)
+        return line
+
+    def IsAlive(self):
+        """
+        Check an idle session before it is reused. An idle receiver has nothing
+        to say, so anything readable means it closed the connection.
+        """
+        try:
+            readable = select.select([self.sock], [], [], 0)[0]
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def Close(self, polite=True):
+        if self.sock is None:
+            return
+        try:
+            if polite:
+                # tell the server that we are done nicely.
+                self.sock.sendall("close\n")
+        except socket.error:
+            pass
+        finally:
+            self.sock.close()
+            self.sock = None
+
+
+class ConnectionPool(object):
+    """
+    Authenticated sessions kept open per (host, port, password) so that the
+    send actions don't pay for a connection and handshake every time.
+    """
+
+    def __init__(self, plugin, maxIdle, idleTimeout):
+        self.plugin = plugin
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        # receivers that predate the capability negotiation
+        self.legacy = set()
+        # the last resumption ticket of each receiver
+        self.tickets = {}
+        self.stopEvent = threading.Event()
+        self.reaper = None
+        if maxIdle > 0:
+            self.reaper = threading.Thread(target=self.Reap, name="TCPEventsPoolReaper")
+            self.reaper.setDaemon(True)
+            self.reaper.start()
+
+    def Acquire(self, host, port, password):
+        """
+        Return a healthy idle session, or open a new one. Returns None if the
+        receiver refused the password.
+        """
+        key = (host, port, password)
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                conn = connections.pop()
+                if conn.IsAlive():
+                    conn.reused = True
+                    return conn
+                conn.Close(False)
+            # a ticket is only good for one connection
+            ticket = self.tickets.pop(key, None)
+        capabilities = () if key in self.legacy else CAPABILITIES
+        while True:
+            conn = Connection(host, port, password, self.plugin.compression, self.plugin.resolver)
+            try:
+                opened = conn.Open(self.plugin.connectionTimeout, self.plugin.communicationTimeout, capabilities, ticket)
+            except:
+                conn.Close(False)
+                if ticket is None:
+                    raise
+                # try again with the full handshake
+                ticket = None
+                continue
+            if opened is None:
+                with self.lock:
+                    self.legacy.add(key)
+                eg.PrintError("TCPEvents: " + host + ":" + str(port) + " doesn't support the optional protocol features, connections to it aren't kept open and batches, JSON, compression, Request Multiple Data and subscriptions fall back or are unavailable.")
+                capabilities = ()
+                continue
+            if conn.ticket is not None:
+                with self.lock:
+                    self.tickets[key] = conn.ticket
+            return conn if opened else None
+
+    def Release(self, conn, reusable=True):
+        """Give a session back to the pool, or close it if it can't be reused."""
+        if reusable and self.maxIdle > 0 and not self.stopEvent.isSet():
+            conn.lastUsed = time.time()
+            with self.lock:
+                connections = self.idle.setdefault(conn.key, [])
+                if len(connections) < self.maxIdle:
+                    connections.append(conn)
+                    return
+        conn.Close()
+
+    def Transact(self, host, port, password, func):
+        """
+        Call func(connection) on a session with the receiver. func returns a
+        (result, reusable) tuple. A pooled session that the receiver closed
+        before answering anything is replaced by a fresh one. Returns False if
+        the receiver refused the password.
+        """
+        while True:
+            conn = self.Acquire(host, port, password)
+            if conn is None:
+                return False
+            conn.replied = False
+            try:
+                result, reusable = func(conn)
+            except socket.error, exc:
+                conn.Close(False)
+                if conn.reused and not conn.replied and IsClosedSession(exc):
+                    continue
+                # the receiver may have taken what was sent, sending it again could repeat it
+                raise
+            except:
+                conn.Close(False)
+                raise
+            self.Release(conn, reusable)
+            return result
+
+    def GetStats(self):
+        with self.lock:
+            idle = sum(len(connections) for connections in self.idle.itervalues())
+            return dict(idle=idle, receivers=len(self.idle), legacy=len(self.legacy), tickets=len(self.tickets))
+
+    def Evict(self):
+        """Close the sessions that have been idle for longer than idleTimeout."""
+        deadline = time.time() - self.idleTimeout
+        expired = []
+        with self.lock:
+            for key, connections in self.idle.items():
+                expired.extend(conn for conn in connections if conn.lastUsed < deadline)
+                connections[:] = [conn for conn in connections if conn.lastUsed >= deadline]
+                if not connections:
+                    del self.idle[key]
+        for conn in expired:
+            conn.Close()
+
+    def Reap(self):
+        while not self.stopEvent.isSet():
+            self.stopEvent.wait(max(self.idleTimeout / 2.0, 0.5))
+            self.Evict()
+
+    def Close(self):
+        self.stopEvent.set()
+        if self.reaper:
+            self.reaper.join()
+        with self.lock:
+            connections = [conn for conns in self.idle.values() for conn in conns]
+            self.idle.clear()
+        for conn in connections:
+            conn.Close()
+
+
+class Replicas(object):
+    """
+    The health of the receivers Request Data asks in turn for the same data.
+    A receiver that fails is asked last for REPLICA_RETRY_MIN seconds,
+    doubling with each failure in a row up to REPLICA_RETRY_MAX, until it
+    answers again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (host, port) -> [failures in a row, asked last until]
+        self.failing = {}
+        self.stats = dict(requests=0, hedges=0, failovers=0, failures=0, skipped=0)
+
+    def Order(self, replicas):
+        """The replicas in the order to ask them: the healthy ones as listed, then the others by the end of their backoff."""
+        now = time.time()
+        with self.lock:
+            healthy = []
+            backingOff = []
+            for index, replica in enumerate(replicas):
+                entry = self.failing.get(replica)
+                if entry is None or entry[1] <= now:
+                    healthy.append(replica)
+                else:
+                    backingOff.append((entry[1], index, replica))
+            self.stats["skipped"] += len(backingOff)
+        backingOff.sort()
+        return healthy + [replica for dummyUntil, dummyIndex, replica in backingOff]
+
+    def Succeeded(self, replica):
+        with self.lock:
+            self.failing.pop(replica, None)
+
+    def Failed(self, replica):
+        with self.lock:
+            failures = self.failing.get(replica, (0, 0))[0] + 1
+            delay = min(REPLICA_RETRY_MIN * 2 ** min(failures - 1, 32), REPLICA_RETRY_MAX)
+            self.failing[replica] = [failures, time.time() + delay]
+            self.stats["failures"] += 1
+
+    def Count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def GetStats(self):
+        now = time.time()
+        with self.lock:
+            stats = dict(self.stats)
+            stats["backingOff"] = sum(1 for dummyFailures, until in self.failing.itervalues() if until > now)
+        return stats
+
+
+class InstrumentedLock(object):
+    """A threading.Lock that keeps track of how long it is waited for and held."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.stats = dict(acquisitions=0, contended=0, waitTime=0.0, holdTime=0.0, maxHoldTime=0.0)
+
+    def acquire(self, blocking=True):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            start = time.time()
+            self.lock.acquire()
+            self.stats["contended"] += 1
+            self.stats["waitTime"] += time.time() - start
+        self.stats["acquisitions"] += 1
+        self.acquired = time.time()
+        return True
+
+    def release(self):
+        held = time.time() - self.acquired
+        self.stats["holdTime"] += held
+        self.stats["maxHoldTime"] = max(self.stats["maxHoldTime"], held)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *dummyExcInfo):
+        self.release()
+
+    def GetStats(self):
+        return dict(self.stats)
+
+
+class Future(object):
+    """The outcome of a job that runs on a WorkerPool."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.done = False
+        self.result = None
+        # why the job has no result: an exception, "dropped", "rejected" or "stopped"
+        self.error = None
+        # [done, total] of jobs that report their progress
+        self.progress = None
+        self.callbacks = []
+
+    def Done(self):
+        return self.done
+
+    def Result(self, timeout=None):
+        """Wait for the job to finish and return its result. Returns None on timeout."""
+        with self.condition:
+            if not self.done:
+                self.condition.wait(timeout)
+            return self.result
+
+    def AddDoneCallback(self, callback):
+        """Call callback(future) once the job finished, right away if it already did."""
+        with self.condition:
+            if not self.done:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def SetResult(self, result, error=None):
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notifyAll()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                eg.PrintTraceback()
+
+
+class WorkerPool(object):
+    """
+    A bounded queue of jobs drained by a fixed number of worker threads. When
+    the queue is full Submit waits for room, drops the oldest queued job or
+    rejects the new one, depending on the overflow policy.
+    """
+
+    BLOCK, DROP_OLDEST, REJECT = range(3)
+
+    def __init__(self, name, workers, maxDepth, policy=BLOCK):
+        self.maxDepth = maxDepth
+        self.policy = policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.active = 0
+        self.stats = dict(submitted=0, completed=0, errors=0, dropped=0, rejected=0, maxDepth=0)
+        for index in range(workers):
+            thread = threading.Thread(target=self.Work, name="%s%d" % (name, index))
+            thread.setDaemon(True)
+            thread.start()
+
+    def Submit(self, func, *args):
+        """Queue func(*args) and return the Future of its result."""
+        future = Future()
+        overflow = []
+        with self.condition:
+            while len(self.queue) >= self.maxDepth and not self.stopped:
+                if self.policy == self.BLOCK:
+                    self.condition.wait()
+                elif self.policy == self.DROP_OLDEST:
+                    overflow.append((self.queue.popleft()[0], "dropped"))
+                    self.stats["dropped"] += 1
+                else:
+                    overflow.append((future, "rejected"))
+                    self.stats["rejected"] += 1
+                    break
+            if self.stopped:
+                overflow.append((future, "stopped"))
+            elif not overflow or overflow[-1][0] is not future:
+                self.queue.append((future, func, args))
+                self.stats["submitted"] += 1
+                self.stats["maxDepth"] = max(self.stats["maxDepth"], len(self.queue))
+                self.condition.notifyAll()
+        for lost, reason in overflow:
+            lost.SetResult(None, reason)
+        return future
+
+    def Work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                future, func, args = self.queue.popleft()
+                self.active += 1
+                self.condition.notifyAll()
+            error = None
+            try:
+                result = func(*args)
+            except Exception, exc:
+                eg.PrintTraceback()
+                result = None
+                error = exc
+            with self.condition:
+                self.active -= 1
+                self.stats["completed"] += 1
+                if error is not None:
+                    self.stats["errors"] += 1
+            future.SetResult(result, error)
+
+    def GetStats(self):
+        with self.condition:
+            stats = dict(self.stats, depth=len(self.queue), active=self.active)
+        return stats
+
+    def Close(self):
+        """Stop the workers. Jobs that are still queued don't run."""
+        with self.condition:
+            self.stopped = True
+            lost = [future for future, func, args in self.queue]
+            self.queue.clear()
+            self.condition.notifyAll()
+        for future in lost:
+            future.SetResult(None, "stopped")
+
+
+class Subscriptions(object):
+    """The subscriptions of the plugin to received data on other TCPEvents plugins, one per receiver."""
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.lock = threading.Lock()
+        # (host, port) -> Subscription
+        self.subscriptions = {}
+
+    def Subscribe(self, host, port, password, patterns):
+        """Replace the subscription to the receiver, an empty list of patterns just ends it."""
+        subscription = None
+        if patterns:
+            subscription = Subscription(self.plugin, host, port, password, patterns)
+        with self.lock:
+            previous = self.subscriptions.pop((host, port), None)
+            if subscription is not None:
+                self.subscriptions[(host, port)] = subscription
+        if previous is not None:
+            previous.Stop()
+        if subscription is not None:
+            subscription.start()
+
+    def Close(self):
+        with self.lock:
+            subscriptions = self.subscriptions.values()
+            self.subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.Stop()
+
+    def GetStats(self):
+        with self.lock:
+            subscriptions = self.subscriptions.values()
+        return dict(
+            receivers=len(subscriptions),
+            connected=sum(1 for subscription in subscriptions if subscription.conn is not None),
+            changes=sum(subscription.changes for subscription in subscriptions),
+        )
+
+
+class Subscription(threading.Thread):
+    """
+    A session that subscribed to received data on another TCPEvents plugin.
+    The values it pushes are stored in the plugin's own received data and
+    trigger {prefix}.DataChanged.{name}. A broken session is opened again
+    after SUBSCRIBE_RETRY_MIN seconds, doubling up to SUBSCRIBE_RETRY_MAX.
+    """
+
+    def __init__(self, plugin, host, port, password, patterns):
+        threading.Thread.__init__(self, name="TCPEventsSubscription")
+        self.setDaemon(True)
+        self.plugin = plugin
+        self.host = host
+        self.port = port
+        self.password = password
+        self.patterns = list(patterns)
+        self.stopEvent = threading.Event()
+        self.conn = None
+        self.changes = 0
+        # the last value of each name, after subscribing again only the values that changed meanwhile trigger events
+        self.values = {}
+
+    def run(self):
+        address = self.host + ":" + str(self.port)
+        delay = SUBSCRIBE_RETRY_MIN
+        while not self.stopEvent.isSet():
+            try:
+                conn = self.plugin.pool.Acquire(self.host, self.port, self.password)
+                if conn is None:
+                    eg.PrintError("TCPEvents: " + address + " refused the password, the subscription ends.")
+                    return
+                if "subscribe" not in conn.capabilities:
+                    conn.Close()
+                    eg.PrintError("TCPEvents: " + address + " doesn't support subscriptions, the subscription ends.")
+                    return
+                self.conn = conn
+                if self.stopEvent.isSet():
+                    break
+                conn.Send("subscribe " + conn.codec.Encode(self.patterns) + "\n")
+                # wait for the changes as long as it takes, TCP keepalive notices a receiver that is gone
+                conn.sock.settimeout(None)
+                conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                delay = SUBSCRIBE_RETRY_MIN
+                while True:
+                    line = conn.ReadLine()
+                    if line[:8] == "changed ":
+                        name, value = conn.codec.Decode(line[8:])
+                        self.Changed(str(name), value)
+            except Exception, exc:
+                if not self.stopEvent.isSet():
+                    eg.PrintError("TCPEvents: The subscription to " + address + " broke(" + str(exc) + "), subscribing again in " + str(delay) + " seconds.")
+            finally:
+                if self.conn is not None:
+                    self.conn.Close(False)
+                self.conn = None
+            self.stopEvent.wait(delay)
+            delay = min(delay * 2, SUBSCRIBE_RETRY_MAX)
+
+    def Changed(self, name, value):
+        if name in self.values and self.values[name] == value:
+            return
+        self.values[name] = value
+        self.changes += 1
+        self.plugin.receivedData.Set(name, value)
+        self.plugin.TriggerEvent("DataChanged." + name, value, prefix=self.plugin.prefix)
+
+    def Stop(self):
+        self.stopEvent.set()
+        conn = self.conn
+        if conn is not None and conn.sock is not None:
+            try:
+                # wakes up the blocked ReadLine
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.join()
+
+
+class OutboxQueue(object):
+    """The unsent events of one receiver."""
+
+    def __init__(self, host, port, password, prefix):
+        self.host = host
+        self.port = port
+        self.password = password
+        # segment files are prefix-<number>.log
+        self.prefix = prefix
+        self.nextSegment = 0
+        # [path, unsent records, bytes, expiry of the newest record] of each segment file, oldest first
+        self.segments = []
+        # where the next record of the first segment starts, 0: before its header
+        self.offset = 0
+        # the last segment, while it is open for appending
+        self.writer = None
+        self.depth = 0
+        self.retryAt = 0
+        self.delay = OUTBOX_RETRY_MIN
+
+
+class Outbox(threading.Thread):
+    """
+    Events that couldn't be sent because their receiver was unreachable. They
+    are appended to segment files per receiver, which survive a restart, and
+    sent again in order and in batches from this thread once the receiver
+    answers. Events are dropped after ttl seconds and new ones aren't kept
+    while the files take more than maxSize bytes. A segment file is deleted
+    once all of its events are sent, the events of a segment that was being
+    sent when EventGhost stopped may be sent twice.
+    """
+
+    def __init__(self, plugin, directory, maxSize, ttl):
+        threading.Thread.__init__(self, name="TCPEventsOutbox")
+        self.setDaemon(True)
+        self.plugin = plugin
+        self.directory = directory
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.condition = threading.Condition()
+        # (host, port) -> OutboxQueue
+        self.queues = {}
+        self.size = 0
+        self.stopped = False
+        self.stats = dict(kept=0, sent=0, undispatched=0, expired=0, rejected=0, batches=0, failures=0)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.Load()
+
+    def Queue(self, host, port, password):
+        """The queue of a receiver. The caller holds the lock."""
+        queue = self.queues.get((host, port))
+        if queue is None:
+            name = "".join(char if char.isalnum() or char in ".-" else "_" for char in host)
+            queue = self.queues[(host, port)] = OutboxQueue(host, port, password, os.path.join(self.directory, "%s-%d" % (name, port)))
+        return queue
+
+    def Pending(self, host, port):
+        """True while events for the receiver wait to be sent, a new one has to go after them."""
+        queue = self.queues.get((host, port))
+        return queue is not None and queue.depth > 0
+
+    def Add(self, host, port, password, events, failed=False):
+        """
+        Keep (prefix, suffix, payload) events for a receiver. failed tells that
+        sending to it just failed. Returns False if the outbox is full.
+        """
+        expires = time.time() + self.ttl
+        records = "".join(JsonCodec.Encode([expires, prefix, suffix, payload]) + "\n" for prefix, suffix, payload in events)
+        with self.condition:
+            if self.maxSize and self.size + len(records) > self.maxSize:
+                self.stats["rejected"] += len(events)
+                return False
+            queue = self.Queue(host, port, password)
+            queue.password = password
+            if failed and queue.depth == 0:
+                queue.retryAt = time.time() + queue.delay
+            try:
+                if queue.writer is None or queue.segments[-1][2] >= OUTBOX_SEGMENT_SIZE:
+                    if queue.writer is not None:
+                        queue.writer.close()
+                        queue.writer = None
+                    path = "%s-%08d.log" % (queue.prefix, queue.nextSegment)
+                    queue.nextSegment += 1
+                    # the segment files are all it takes to send the events after a restart
+                    header = JsonCodec.Encode(["outbox", host, port, password]) + "\n"
+                    writer = open(path, "ab")
+                    writer.write(header)
+                    queue.writer = writer
+                    queue.segments.append([path, 0, len(header), 0])
+                    self.size += len(header)
+                queue.writer.write(records)
+                queue.writer.flush()
+            except (IOError, OSError), exc:
+                eg.PrintError("TCPEvents: Unable to keep unsent events in " + self.directory + ": " + str(exc))
+                self.stats["rejected"] += len(events)
+                return False
+            segment = queue.segments[-1]
+            segment[1] += len(events)
+            segment[2] += len(records)
+            segment[3] = expires
+            queue.depth += len(events)
+            self.size += len(records)
+            self.stats["kept"] += len(events)
+            self.condition.notify()
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                due = []
+                while not self.stopped:
+                    now = time.time()
+                    due = [queue for queue in self.queues.values() if queue.segments and queue.retryAt <= now]
+                    if due:
+                        break
+                    waiting = [queue.retryAt for queue in self.queues.itervalues() if queue.segments]
+                    self.condition.wait(min(waiting) - now if waiting else None)
+                if self.stopped:
+                    return
+            for queue in due:
+                self.Replay(queue)
+
+    def Replay(self, queue):
+        """Send the events of a receiver in batches until they are all sent or sending fails."""
+        address = queue.host + ":" + str(queue.port)
+        while not self.stopped:
+            with self.condition:
+                if not queue.segments:
+                    if queue.writer is None:
+                        del self.queues[(queue.host, queue.port)]
+                    return
+                offset = queue.offset
+                events, nextOffset, read, expired = self.Next(queue)
+            results = []
+            if events:
+                try:
+                    sent = self.plugin.pool.Transact(queue.host, queue.port, queue.password, lambda conn: (ExchangeEvents(conn, events, results), conn.serverType == "TCPEvents"))
+                    if sent is False:
+                        raise socket.error("The receiver refused the password")
+                except Exception, exc:
+                    with self.condition:
+                        self.stats["failures"] += 1
+                        queue.retryAt = time.time() + queue.delay
+                        if not self.stopped:
+                            eg.PrintError("TCPEvents: Unable to send the unsent events to " + address + "(" + str(exc) + "), trying again in " + str(queue.delay) + " seconds.")
+                        queue.delay = min(queue.delay * 2, OUTBOX_RETRY_MAX)
+                    return
+            with self.condition:
+                queue.retryAt = 0
+                queue.delay = OUTBOX_RETRY_MIN
+                self.Commit(queue, nextOffset, read, expired, results)
+                if not events and nextOffset == offset and queue.segments and queue.offset == offset:
+                    # caught up with the events that are being added
+                    return
+
+    def Next(self, queue):
+        """
+        Read the next batch of events of a receiver. Returns the events, the
+        offset after them and the number of records read and expired. The
+        caller holds the lock.
+        """
+        now = time.time()
+        while queue.segments and queue.segments[0][3] and queue.segments[0][3] <= now:
+            # everything in the segment expired
+            self.stats["expired"] += queue.segments[0][1]
+            self.DropSegment(queue)
+        if not queue.segments:
+            return [], 0, 0, 0
+        events = []
+        read = expired = 0
+        with open(queue.segments[0][0], "rb") as segment:
+            segment.seek(queue.offset)
+            if queue.offset == 0:
+                segment.readline()
+            while len(events) < MAX_BATCH_SIZE:
+                line = segment.readline()
+                if line == "":
+                    break
+                try:
+                    record = JsonCodec.Decode(line)
+                except Exception:
+                    # the last record of a crashed run may be incomplete
+                    continue
+                read += 1
+                if record[0] <= now:
+                    expired += 1
+                else:
+                    events.append(tuple(record[1:]))
+            offset = segment.tell()
+        return events, offset, read, expired
+
+    def Commit(self, queue, offset, read, expired, results):
+        """
+        Forget the records that were read from the first segment, counting the
+        sent events the receiver triggered or didn't by their results. The
+        caller holds the lock.
+        """
+        if not queue.segments:
+            return
+        queue.offset = offset
+        queue.segments[0][1] -= read
+        queue.depth -= read
+        self.stats["expired"] += expired
+        if results:
+            sent = len([result for result in results if result is not None])
+            self.stats["sent"] += sent
+            self.stats["undispatched"] += len(results) - sent
+            self.stats["batches"] += 1
+        if queue.offset >= queue.segments[0][2]:
+            self.DropSegment(queue)
+
+    def DropSegment(self, queue):
+        """Delete the first segment of a receiver with its unsent events. The caller holds the lock."""
+        path, records, size, dummyExpires = queue.segments.pop(0)
+        if not queue.segments and queue.writer is not None:
+            queue.writer.close()
+            queue.writer = None
+        try:
+            os.remove(path)
+        except OSError, exc:
+            eg.PrintError("TCPEvents: Unable to delete " + path + ": " + str(exc))
+        queue.offset = 0
+        queue.depth -= records
+        self.size -= size
+
+    def Load(self):
+        """Pick up the segment files of a previous run, new events go to new segments."""
+        for fileName in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, fileName)
+            if not fileName.endswith(".log"):
+                continue
+            records = 0
+            expires = 0
+            try:
+                with open(path, "rb") as segment:
+                    dummyTag, host, port, password = JsonCodec.Decode(segment.readline())
+                    for line in segment:
+                        try:
+                            expires = JsonCodec.Decode(line)[0]
+                        except Exception:
+                            continue
+                        records += 1
+                number = int(fileName[:-4].rsplit("-", 1)[1])
+            except Exception:
+                eg.PrintError("TCPEvents: " + path + " isn't an outbox segment, it is left alone.")
+                continue
+            size = os.path.getsize(path)
+            queue = self.Queue(str(host), port, password)
+            queue.password = password
+            queue.segments.append([path, records, size, expires])
+            queue.nextSegment = max(queue.nextSegment, number + 1)
+            queue.depth += records
+            self.size += size
+
+    def Stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join()
+        for queue in self.queues.values():
+            if queue.writer is not None:
+                queue.writer.close()
+                queue.writer = None
+
+    def GetStats(self):
+        with self.condition:
+            stats = dict(self.stats, size=self.size, maxSize=self.maxSize)
+            stats["depth"] = sum(queue.depth for queue in self.queues.itervalues())
+            stats["depthPerDestination"] = dict(
+                ("%s:%d" % key, queue.depth) for key, queue in self.queues.iteritems() if queue.depth
+            )
+        return stats
+
+
+class Timers(threading.Thread):
+    """Calls functions after a delay, all of them from one thread."""
+
+    def __init__(self, name):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.stopped = False
+
+    def Schedule(self, delay, func, *args):
+        """Call func(*args) in delay seconds. Returns the timer, for Cancel."""
+        timer = [time.time() + delay, next(self.counter), func, args]
+        with self.condition:
+            heapq.heappush(self.heap, timer)
+            self.condition.notify()
+        return timer
+
+    def Cancel(self, timer):
+        timer[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time.time()):
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if self.stopped:
+                    return
+                dummyTime, dummyCount, func, args = heapq.heappop(self.heap)
+            if func is not None:
+                try:
+                    func(*args)
+                except:
+                    eg.PrintTraceback()
+
+    def Stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join()
+
+
+class SendEvent(eg.ActionBase):
+
+    name = "Send an Event"
+
+    def __call__(self, destIP, destPort, passwd, evtPref, evtSuf, evtPayloadStr, evtPayload, background=False, udp=False):
+        if destIP == "":
+            eg.PrintError("Destination address field left blank.")
+        self.host = eg.ParseString(destIP)
+        self.port = destPort
+        self.password = eg.ParseString(passwd)
+        self.eventPrefix = eg.ParseString(evtPref)
+        self.eventSuffix = eg.ParseString(evtSuf)
+        self.eventPayload = self.EvalPayload(evtPayloadStr, evtPayload)
+        if udp:
+            # nothing to wait for, there is no point in sending in the background
+            return self.SendDatagram()
+        if background:
+            return self.plugin.QueueSend(self)
+        return self.Send()
+
+    @staticmethod
+    def EvalPayload(evtPayloadStr, evtPayload):
+        if (evtPayloadStr is not None) and (evtPayloadStr != ""):
+            try:
+                return eval(evtPayloadStr)
+            except:
+                eg.PrintError("Unable to evaluate the payload. Payload must be a valid python expression(example: \"some\\\"Text\\\"\"). Your string will be sent unevaluated.")
+                return evtPayloadStr
+        return evtPayload
+
+    def Configure(self, destIP="", destPort=1024, passwd="", evtPref="", evtSuf="{eg.result}", evtPayloadStr="", evtPayload=None, background=False, udp=False):
+        text = Text
+        panel = eg.ConfigPanel()
+
+        # if evtPref == "":
+        #    evtPref = self.plugin.prefix
+
+        addrCtrl = panel.TextCtrl(destIP)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        evtPrefCtrl = panel.TextCtrl(evtPref)
+        evtSufCtrl = panel.TextCtrl(evtSuf)
+        evtPldCtrl = panel.TextCtrl(evtPayloadStr)
+        backgroundCtrl = panel.CheckBox(background)
+        udpCtrl = panel.CheckBox(udp)
+
+        st1 = panel.StaticText(text.address)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.prefix)
+        st5 = panel.StaticText(text.suffix)
+        st6 = panel.StaticText(text.payload)
+        st7 = panel.StaticText(text.background)
+        st8 = panel.StaticText(text.udp)
+
+        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6, st7, st8))
+
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl), (st7, backgroundCtrl), (st8, udpCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(
+            text.eventGenerationBox,
+            (st4, evtPrefCtrl),
+            (st5, evtSufCtrl),
+            (st6, evtPldCtrl)
+        )
+
+        panel.sizer.AddMany([
+            (box1, 0, wx.EXPAND),
+            (box2, 0, wx.EXPAND | wx.TOP, 10),
+            (box3, 0, wx.EXPAND | wx.TOP, 10),
+        ])
+
+        while panel.Affirmed():
+            panel.SetResult(
+                addrCtrl.GetValue(),
+                portCtrl.GetValue(),
+                passwordCtrl.GetValue(),
+                evtPrefCtrl.GetValue(),
+                evtSufCtrl.GetValue(),
+                evtPldCtrl.GetValue(),
+                None,
+                backgroundCtrl.GetValue(),
+                udpCtrl.GetValue()
+            )
+
+    def Send(self):
+        outbox = self.plugin.outbox
+        events = [(self.eventPrefix, self.eventSuffix, self.eventPayload)]
+        if outbox is not None and outbox.Pending(self.host, self.port):
+            # the event goes after the ones still waiting for the receiver
+            if not outbox.Add(self.host, self.port, self.password, events):
+                self.PrintError("The outbox is full, your event is dropped")
+            return None
+        try:
+            return self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange)
+        except socket.error:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            if outbox is not None and outbox.Add(self.host, self.port, self.password, events, True):
+                self.PrintError("An error occurred while sending your event, it is sent once the receiver is reachable")
+            else:
+                self.PrintError("An error occurred while sending your event")
+            return None
+        except:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            self.PrintError("An error occurred while sending your event")
+            return None
+
+    def SendDatagram(self):
+        sender = self.plugin.udpSender
+        try:
+            data, eventString = FormatEvent(sender, self.eventPrefix, self.eventSuffix, self.eventPayload)
+            sender.Send(self.host, self.port, self.password, data)
+            return [eventString, self.eventPayload]
+        except:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            self.PrintError("An error occurred while sending your event")
+            return None
+
+    def Exchange(self, conn):
+        # now just pipe those commands to the server
+        data, eventString = FormatEvent(conn, self.eventPrefix, self.eventSuffix, self.eventPayload)
+        conn.Send(data)
+        # a TCPEvents receiver keeps the session open after an event
+        return [eventString, self.eventPayload], conn.serverType == "TCPEvents"
+
+
+class BroadcastEvent(SendEvent):
+    name = "Broadcast an Event"
+    description = (
+        "Sends the same event to many receivers in parallel. Returns a dict with "
+        "success, latency and result for each address."
+    )
+
+    def __call__(self, hosts, destPort, passwd, evtPref, evtSuf, evtPayloadStr, evtPayload=None, concurrency=DefaultValues.concurrency):
+        self.password = eg.ParseString(passwd)
+        self.eventPrefix = eg.ParseString(evtPref)
+        self.eventSuffix = eg.ParseString(evtSuf)
+        self.eventPayload = self.EvalPayload(evtPayloadStr, evtPayload)
+        destinations = self.plugin.ResolveHosts(eg.ParseString(hosts), destPort)
+        if not destinations:
+            eg.PrintError("Addresses field left blank.")
+            return {}
+        workers = WorkerPool("TCPEventsBroadcast", min(concurrency, len(destinations)), len(destinations))
+        try:
+            futures = [(host, port, workers.Submit(self.SendTo, host, port)) for host, port in destinations]
+            results = {}
+            for host, port, future in futures:
+                key = host if port == destPort else "%s:%d" % (host, port)
+                results[key] = future.Result()
+            return results
+        finally:
+            workers.Close()
+
+    def SendTo(self, host, port):
+        job = copy.copy(self)
+        job.host = host
+        job.port = port
+        start = time.time()
+        result = job.Send()
+        return dict(success=result is not None and result is not False, latency=time.time() - start, result=result)
+
+    def Configure(self, hosts="", destPort=1024, passwd="", evtPref="", evtSuf="{eg.result}", evtPayloadStr="", evtPayload=None, concurrency=DefaultValues.concurrency):
+        text = Text
+        panel = eg.ConfigPanel()
+
+        hostsCtrl = panel.TextCtrl(hosts)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        concurrencyCtrl = panel.SpinIntCtrl(concurrency, min=1, max=256)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        evtPrefCtrl = panel.TextCtrl(evtPref)
+        evtSufCtrl = panel.TextCtrl(evtSuf)
+        evtPldCtrl = panel.TextCtrl(evtPayloadStr)
+
+        st1 = panel.StaticText(text.hosts)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.prefix)
+        st5 = panel.StaticText(text.suffix)
+        st6 = panel.StaticText(text.payload)
+        st7 = panel.StaticText(text.concurrency)
+
+        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6, st7))
+
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, hostsCtrl), (st2, portCtrl), (st7, concurrencyCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(
+            text.eventGenerationBox,
+            (st4, evtPrefCtrl),
+            (st5, evtSufCtrl),
+            (st6, evtPldCtrl)
+        )
+
+        panel.sizer.AddMany([
+            (box1, 0, wx.EXPAND),
+            (box2, 0, wx.EXPAND | wx.TOP, 10),
+            (box3, 0, wx.EXPAND | wx.TOP, 10),
+        ])
+
+        while panel.Affirmed():
+            panel.SetResult(
+                hostsCtrl.GetValue(),
+                portCtrl.GetValue(),
+                passwordCtrl.GetValue(),
+                evtPrefCtrl.GetValue(),
+                evtSufCtrl.GetValue(),
+                evtPldCtrl.GetValue(),
+                None,
+                concurrencyCtrl.GetValue()
+            )
+
+
+class SendEventBatch(eg.ActionBase):
+    name = "Send Event Batch"
+    description = (
+        "Sends a list of events over a single connection. Each event is a suffix string, "
+        "a (prefix, suffix) or (prefix, suffix, payload) tuple or a dict with prefix, suffix "
+        "and payload keys. Returns a list with the result of Send an Event for each event."
+    )
+
+    def __call__(self, destIP, destPort, passwd, evtPref, eventsStr, events=None, background=False):
+        if destIP == "":
+            eg.PrintError("Destination address field left blank.")
+        self.host = eg.ParseString(destIP)
+        self.port = destPort
+        self.password = eg.ParseString(passwd)
+        self.eventPrefix = eg.ParseString(evtPref)
+        if (eventsStr is not None) and (eventsStr != ""):
+            try:
+                events = eval(eventsStr)
+            except:
+                eg.PrintError("Unable to evaluate the events. Events must be a valid python expression(example: [\"Suffix1\", (\"Prefix\", \"Suffix2\", 42)]).")
+                return None
+        try:
+            if events is not None and not isinstance(events, (list, tuple)):
+                raise TypeError("The events aren't a list")
+            self.events = [self.ParseEvent(event) for event in (events or [])]
+        except TypeError:
+            eg.PrintError("Unable to read the events. Events must be a list of suffixes, (prefix, suffix, payload) tuples or dicts(example: [\"Suffix1\", (\"Prefix\", \"Suffix2\", 42)]).")
+            return None
+        if background:
+            return self.plugin.QueueSend(self)
+        return self.Send()
+
+    def ParseEvent(self, event):
+        if isinstance(event, basestring):
+            return self.eventPrefix, event, None
+        if isinstance(event, dict):
+            return event.get("prefix", self.eventPrefix), event.get("suffix", ""), event.get("payload")
+        if not isinstance(event, (list, tuple)) or not 1 <= len(event) <= 3:
+            raise TypeError("Not an event: " + repr(event))
+        event = tuple(event)
+        if len(event) == 1:
+            return self.eventPrefix, event[0], None
+        return event[0], event[1], event[2] if len(event) > 2 else None
+
+    def Configure(self, destIP="", destPort=1024, passwd="", evtPref="", eventsStr="", events=None, background=False):
+        text = Text
+        panel = eg.ConfigPanel()
+
+        addrCtrl = panel.TextCtrl(destIP)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        evtPrefCtrl = panel.TextCtrl(evtPref)
+        eventsCtrl = panel.TextCtrl(eventsStr)
+        backgroundCtrl = panel.CheckBox(background)
+
+        st1 = panel.StaticText(text.address)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.prefix)
+        st5 = panel.StaticText(text.events)
+        st6 = panel.StaticText(text.background)
+
+        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6))
+
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl), (st6, backgroundCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(text.eventGenerationBox, (st4, evtPrefCtrl), (st5, eventsCtrl))
 
         panel.sizer.AddMany([
             (box1, 0, wx.EXPAND),
@@ -670,98 +3899,201 @@ class SendData(eg.ActionBase):
                 addrCtrl.GetValue(),
                 portCtrl.GetValue(),
                 passwordCtrl.GetValue(),
-                dataNameCtrl.GetValue(),
-                dataCtrl.GetValue(),
-                None
+                evtPrefCtrl.GetValue(),
+                eventsCtrl.GetValue(),
+                None,
+                backgroundCtrl.GetValue()
             )
 
     def Send(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket = sock
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(self.plugin.connectionTimeout)
+        outbox = self.plugin.outbox
+        if outbox is not None and outbox.Pending(self.host, self.port):
+            # the events go after the ones still waiting for the receiver
+            if not outbox.Add(self.host, self.port, self.password, self.events):
+                self.PrintError("The outbox is full, your events are dropped")
+            return None
+        # results of the events the receiver took, a retry goes on after them
+        self.results = []
         try:
-            sock.connect((self.host, self.port))
-            sock.settimeout(self.plugin.communicationTimeout)
-            # First wake up the server, for security reasons it does not
-            # respond by itself it needs this string, why this odd word ?
-            # well if someone is scanning ports "connect" would be very
-            # obvious this one you'd never guess :-)
-            serverType = "TCPEvents"
-            if (self.password != ""):
-                sock.sendall("quintessence\n\r")
+            return self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange)
+        except socket.error:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            unsent = self.events[len(self.results):]
+            if outbox is not None and outbox.Add(self.host, self.port, self.password, unsent, True):
+                self.PrintError("An error occurred while sending your events, the " + str(len(unsent)) + " unsent ones are sent once the receiver is reachable")
+            else:
+                self.PrintError("An error occurred while sending your events")
+            return None
+        except:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            self.PrintError("An error occurred while sending your events")
+            return None
+
+    def Exchange(self, conn):
+        return ExchangeEvents(conn, self.events, self.results), conn.serverType == "TCPEvents"
+
+
+def ExchangeEvents(conn, events, results=None):
+    """
+    Send (prefix, suffix, payload) events over a connection, in batches if the
+    receiver takes them. The result of each event is appended to results. The
+    events that already have one are skipped, so an exchange that failed is
+    picked up again after the last event the receiver took.
+    """
+    if results is None:
+        results = []
+    while len(results) < len(events):
+        batch = events[len(results):len(results) + MAX_BATCH_SIZE]
+        frames = [FormatEvent(conn, *event) for event in batch]
+        if "batch" in conn.capabilities:
+            conn.Send("batch %d\n" % len(frames) + "".join(data for data, eventString in frames))
+            answer = conn.ReadLine().strip()
+            if answer[:12] != "batchResult ":
+                raise socket.error("Unexpected answer to a batch: " + answer)
+            dispatched = conn.codec.Decode(answer[12:])
+            for (data, eventString), event, success in zip(frames, batch, dispatched):
+                results.append([eventString, event[2]] if success else None)
+        else:
+            # the receiver doesn't know batches, the events still share the connection
+            for (data, eventString), event in zip(frames, batch):
+                conn.Send(data)
+                results.append([eventString, event[2]])
+    return results
+
+
+def FormatEvent(conn, prefix, suffix, payload):
+    """Return the lines that send an event over a connection and the sent event string."""
+    serverType = conn.serverType
+    if (prefix is not None) and (len(prefix) > 0) and (serverType == "TCPEvents"):
+        eventString = prefix + "." + suffix
+    else:
+        eventString = suffix
+
+    data = ""
+    if (payload is not None):
+        # payload will be decoded by the server so that we can get back the exact same object(s) we have here
+        if serverType == "TCPEvents":
+            data += "payload " + conn.codec.Encode(payload) + "\n"
+        else:
+            data += (u'payload ' + str(payload) + u'\n').encode("utf-8")
 
-                # The server now returns a cookie, the protocol works like the
-                # APOP protocol. The server gives you a cookie you add :<password>
-                # calculate the MD5 digest out of this and send it back
-                # if the digests match you are in.
-                # We do this so that no one can listen in on our password exchange
-                # much safer than plain text.
+    if serverType != "TCPEvents":
+        data += "payload withoutRelease\n"
+    data += (eventString + "\n").encode("utf-8")
+    return data, eventString
 
-                cookie = sock.recv(128)
 
-                # Trim all enters and whitespaces off
-                cookie = cookie.strip()
+class SendData(eg.ActionBase):
+    name = "Send Data"
+
+    def __call__(self, destIP, destPort, passwd, dataName, dataToEval, data, background=False, ttl=0):
+        if destIP == "":
+            eg.PrintError("Destination address field is blank")
+        self.host = eg.ParseString(destIP)
+        self.port = destPort
+        self.password = eg.ParseString(passwd)
+        self.dataName = eg.ParseString(dataName)
+        self.ttl = ttl
+        self.progress = [0, 0]
+        if (dataToEval is not None) and (dataToEval != ""):
+            try:
+                self.data = eval(dataToEval)
+            except:
+                eg.PrintError("Error evaluating " + str(dataToEval) + ". Sending None to the server.")
+                self.data = None
+        else:
+            self.data = data
+        if background:
+            return self.plugin.QueueSend(self)
+        return self.Send()
 
-                # Combine the token <cookie>:<password>
-                token = cookie + ":" + self.password
+    def Configure(self, destIP="", destPort=1024, passwd="", dataName="data1", dataToEval="", data=None, background=False, ttl=0):
+        text = Text
+        panel = eg.ConfigPanel()
 
-                # Calculate the digest
-                digest = md5(token).hexdigest()
+        addrCtrl = panel.TextCtrl(destIP)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        dataNameCtrl = panel.TextCtrl(dataName)
+        dataCtrl = panel.TextCtrl(dataToEval)
+        ttlCtrl = panel.SpinIntCtrl(ttl, min=0, max=100000000)
+        backgroundCtrl = panel.CheckBox(background)
 
-                # add the enters
-                digest = digest + "\n"
+        st1 = panel.StaticText(text.address)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.dataName)
+        st5 = panel.StaticText(text.dataToSend)
+        st6 = panel.StaticText(text.background)
+        st7 = panel.StaticText(text.ttl)
+        eg.EqualizeWidths((st1, st2, st3, st4, st5, st6, st7))
 
-                # Send it to the server
-                sock.sendall("TCPEvents" + digest)
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl), (st6, backgroundCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(text.dataBox, (st4, dataNameCtrl), (st5, dataCtrl), (st7, ttlCtrl))
 
-                # Get the answer
-                answer = sock.recv(512)
+        panel.sizer.AddMany([
+            (box1, 0, wx.EXPAND),
+            (box2, 0, wx.EXPAND | wx.TOP, 10),
+            (box3, 0, wx.EXPAND | wx.TOP, 10),
+        ])
 
-                # If the password was correct and you are allowed to connect
-                # to the server, you'll get "accept"
-                if (answer.strip() != "accept"):
-                    sock.close()
-                    return False
-                elif (answer.strip("\n") == " accept"):
-                    serverType = "TCPEvents"
-                else:
-                    serverType = "Network Event Receiver"
-
-            if serverType == "TCPEvents":
-                sock.sendall("dataName %s\n" % self.dataName)
-                srcData = self.data
-                srcDataList = []
-                srcDataList.append(self.data)
-                srcDataStr = str(srcDataList)
-                sock.sendall("data " + srcDataStr + "\n")
-                sock.sendall("close\n")
-                sock.close()
-            else:
-                eg.PrintError("The server isn't a TCPEvents server(is it a Network Event Receiver?). Your data will be sent in the payload.")
-                sock.sendall("payload %s\n" % self.dataName.encode(eg.systemEncoding))
-                sock.sendall("payload %s\n" % str(self.data).encode(eg.systemEncoding))
-                sock.sendall("payload withoutRelease\n")
-                sock.sendall("SendData".encode(eg.systemEncoding) + "\n")
-                # tell the server that we are done nicely.
-                sock.sendall("close\n")
-                sock.close()
-                return True
+        while panel.Affirmed():
+            panel.SetResult(
+                addrCtrl.GetValue(),
+                portCtrl.GetValue(),
+                passwordCtrl.GetValue(),
+                dataNameCtrl.GetValue(),
+                dataCtrl.GetValue(),
+                None,
+                backgroundCtrl.GetValue(),
+                ttlCtrl.GetValue()
+            )
+
+    def Send(self):
+        try:
+            return self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange)
         except:
             if eg.debugLevel:
                 eg.PrintTraceback()
-            sock.close()
             self.PrintError("NetworkSender failed")
             return None
 
+    def Exchange(self, conn):
+        if conn.serverType == "TCPEvents":
+            conn.Send("dataName %s\n" % self.dataName)
+            if self.ttl and "ttl" in conn.capabilities:
+                conn.Send("dataTTL %d\n" % self.ttl)
+            data = conn.codec.Encode(self.data)
+            self.progress[:] = [0, len(data)]
+            if len(data) > CHUNK_SIZE and "chunked" in conn.capabilities:
+                # stream the encoded value as it is, without building another copy of it
+                conn.Send("dataChunked %d\n" % len(data))
+                for start in range(0, len(data), CHUNK_SIZE):
+                    conn.Send(buffer(data, start, CHUNK_SIZE))
+                    self.progress[0] = min(start + CHUNK_SIZE, len(data))
+            else:
+                conn.Send("data " + data + "\n")
+                self.progress[0] = len(data)
+            return True, "keepalive" in conn.capabilities
+        else:
+            eg.PrintError("The server isn't a TCPEvents server(is it a Network Event Receiver?). Your data will be sent in the payload.")
+            conn.Send("payload %s\n" % self.dataName.encode(eg.systemEncoding))
+            conn.Send("payload %s\n" % str(self.data).encode(eg.systemEncoding))
+            conn.Send("payload withoutRelease\n")
+            conn.Send("SendData".encode(eg.systemEncoding) + "\n")
+            return True, False
+
 
 class GetData(eg.ActionBase):
     name = "Retrieve Received Data"
 
     def __call__(self, dataName):
-        if dataName in self.plugin.receivedData:
-            result = self.plugin.receivedData[dataName]
-        else:
+        missing = object()
+        result = self.plugin.receivedData.Get(dataName, missing)
+        if result is missing:
             eg.PrintError(str(dataName) + " not found. Check the Data Name and make sure this data has been remotely set. Returning None.")
             result = None
         return result
@@ -783,17 +4115,24 @@ class GetData(eg.ActionBase):
 
 class RequestData(eg.ActionBase):
     name = "Request Data from a remote host"
+    description = (
+        "Evaluates a Python expression on a remote host and returns the result. Given "
+        "several addresses, the next one is asked whenever one fails or doesn't answer "
+        "in time, and the first answer wins."
+    )
 
-    def __call__(self, destIP, destPort, passwd, data):
+    def __call__(self, destIP, destPort, passwd, data, hedgeDelay=DefaultValues.hedgeDelay):
         if destIP == "":
             eg.PrintError("Destination address field is blank")
-        self.host = eg.ParseString(destIP)
-        self.port = destPort
         self.password = eg.ParseString(passwd)
         self.data = data
+        replicas = self.plugin.ResolveHosts(eg.ParseString(destIP), destPort)
+        if len(replicas) > 1:
+            return self.SendHedged(replicas, hedgeDelay)
+        self.host, self.port = replicas[0] if replicas else (eg.ParseString(destIP), destPort)
         return self.Send()
 
-    def Configure(self, destIP="", destPort=1024, passwd="", data=""):
+    def Configure(self, destIP="", destPort=1024, passwd="", data="", hedgeDelay=DefaultValues.hedgeDelay):
         text = Text
         panel = eg.ConfigPanel()
 
@@ -801,14 +4140,16 @@ class RequestData(eg.ActionBase):
         portCtrl = panel.SpinIntCtrl(destPort, max=65535)
         passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
         dataCtrl = panel.TextCtrl(data)
+        hedgeDelayCtrl = panel.SpinNumCtrl(hedgeDelay, integerWidth=2, increment=0.01)
 
-        st1 = panel.StaticText(text.address)
+        st1 = panel.StaticText(text.hosts)
         st2 = panel.StaticText(text.port)
         st3 = panel.StaticText(text.password)
         st4 = panel.StaticText(text.dataToReceive)
-        eg.EqualizeWidths((st1, st2, st3, st4))
+        st5 = panel.StaticText(text.hedgeDelay)
+        eg.EqualizeWidths((st1, st2, st3, st4, st5))
 
-        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl))
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl), (st5, hedgeDelayCtrl))
         box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
         box3 = panel.BoxedGroup(text.dataBox, (st4, dataCtrl))
 
@@ -824,104 +4165,286 @@ class RequestData(eg.ActionBase):
                 portCtrl.GetValue(),
                 passwordCtrl.GetValue(),
                 dataCtrl.GetValue(),
+                hedgeDelayCtrl.GetValue(),
             )
 
     def Send(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket = sock
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(self.plugin.connectionTimeout)
         try:
-            sock.connect((self.host, self.port))
-            sock.settimeout(self.plugin.communicationTimeout)
-            # First wake up the server, for security reasons it does not
-            # respond by itself it needs this string, why this odd word ?
-            # well if someone is scanning ports "connect" would be very
-            # obvious this one you'd never guess :-)
-            serverType = "TCPEvents"
-            if (self.password != ""):
-                sock.sendall("quintessence\n\r")
-
-                # The server now returns a cookie, the protocol works like the
-                # APOP protocol. The server gives you a cookie you add :<password>
-                # calculate the MD5 digest out of this and send it back
-                # if the digests match you are in.
-                # We do this so that no one can listen in on our password exchange
-                # much safer than plain text.
+            return self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange)
+        except:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            self.PrintError("NetworkSender failed")
+            return None
 
-                cookie = sock.recv(128)
+    def SendHedged(self, replicas, hedgeDelay):
+        """
+        Ask the replicas in turn for the same data and return the first
+        answer. The next replica is asked as soon as one fails, or when none
+        answered within hedgeDelay seconds, so a slow or dead receiver costs
+        about hedgeDelay. Once there is an answer no further replica is
+        asked, the answers of the ones still busy are dropped.
+        """
+        health = self.plugin.replicas
+        health.Count("requests")
+        order = health.Order(replicas)
+        # the attempts put (answered, result) and the hedge timer the number of replicas asked
+        # when it was armed, a timed get would poll
+        answers = Queue.Queue()
+        asked = finished = 0
+        timer = None
+        askNext = True
+        while True:
+            if askNext:
+                # the action object is reused by the next call, each attempt needs its own copy
+                job = copy.copy(self)
+                job.host, job.port = order[asked]
+                thread = threading.Thread(target=job.Attempt, args=(answers,), name="TCPEventsRequest")
+                thread.setDaemon(True)
+                thread.start()
+                asked += 1
+                if asked < len(order):
+                    timer = self.plugin.timers.Schedule(hedgeDelay, answers.put, asked)
+                askNext = False
+            # the attempts end within the connection and communication timeouts
+            answer = answers.get()
+            if not isinstance(answer, tuple):
+                if answer == asked:
+                    health.Count("hedges")
+                    askNext = True
+                continue
+            finished += 1
+            answered, result = answer
+            if answered:
+                if timer is not None:
+                    self.plugin.timers.Cancel(timer)
+                return result
+            askNext = asked < len(order)
+            if askNext:
+                self.plugin.timers.Cancel(timer)
+                health.Count("failovers")
+            elif finished == asked:
+                self.PrintError("None of the receivers answered")
+                return None
+
+    def Attempt(self, answers):
+        """Ask one replica for SendHedged and put (answered, result) in the answers queue."""
+        self.answered = False
+        try:
+            result = self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange)
+        except:
+            if eg.debugLevel:
+                eg.PrintTraceback()
+            result = None
+        if self.answered:
+            self.plugin.replicas.Succeeded((self.host, self.port))
+        else:
+            self.plugin.replicas.Failed((self.host, self.port))
+        answers.put((self.answered, result))
 
-                # Trim all enters and whitespaces off
-                cookie = cookie.strip()
+    def Exchange(self, conn):
+        if conn.serverType == "TCPEvents":
+            conn.Send("dataRequest " + conn.codec.Encode(self.data) + "\n")
+            answer = ""
+            try:
+                answer = conn.ReadLine()
+            except socket.error:
+                if conn.reused:
+                    raise
+            answer = answer.strip()
+            if answer[:7] == "result ":
+                try:
+                    result = conn.codec.Decode(answer[7:])
+                    self.answered = True
+                except:
+                    eg.PrintError("Can not eval the response from the server: " + answer + ". Returning None.")
+                    result = None
+            else:
+                eg.PrintError("The server didn't send back a response. It might not be able to evaluate the request (" + self.data + "==>" + answer + ").")
+                return None, False
+            return result, "keepalive" in conn.capabilities
+        else:
+            eg.PrintError("The server isn't a TCPEvents server(is it a Network Event Receiver?). Your request will be sent in the Payload")
+            conn.Send("payload %s\n" % str(self.data).encode(eg.systemEncoding))
+            conn.Send("payload withoutRelease\n")
+            conn.Send("RequestData".encode(eg.systemEncoding) + "\n")
+            return None, False
+
+
+class RequestMultipleData(eg.ActionBase):
+    name = "Request Multiple Data"
+    description = (
+        "Evaluates a list of Python expressions on a remote host over a single connection "
+        "and returns a dict of each expression and its result. The result of an expression "
+        "the remote host can't evaluate is None."
+    )
+
+    def __call__(self, destIP, destPort, passwd, expressionsStr, expressions=None):
+        if destIP == "":
+            eg.PrintError("Destination address field is blank")
+        self.host = eg.ParseString(destIP)
+        self.port = destPort
+        self.password = eg.ParseString(passwd)
+        if (expressionsStr is not None) and (expressionsStr != ""):
+            try:
+                expressions = eval(expressionsStr)
+            except:
+                eg.PrintError("Unable to evaluate the expressions. They must be a list of strings(example: [\"eg.globals.temperature\", \"eg.globals.humidity\"]).")
+                return None
+        self.expressions = []
+        for expression in expressions or []:
+            if expression not in self.expressions:
+                self.expressions.append(expression)
+        return self.Send()
 
-                # Combine the token <cookie>:<password>
-                token = cookie + ":" + self.password
+    def Configure(self, destIP="", destPort=1024, passwd="", expressionsStr="", expressions=None):
+        text = Text
+        panel = eg.ConfigPanel()
 
-                # Calculate the digest
-                digest = md5(token).hexdigest()
+        addrCtrl = panel.TextCtrl(destIP)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        expressionsCtrl = panel.TextCtrl(expressionsStr)
 
-                # add the enters
-                digest = digest + "\n"
+        st1 = panel.StaticText(text.address)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.expressions)
+        eg.EqualizeWidths((st1, st2, st3, st4))
 
-                # Send it to the server
-                sock.sendall("TCPEvents" + digest)
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(text.dataBox, (st4, expressionsCtrl))
 
-                # Get the answer
-                answer = sock.recv(512)
+        panel.sizer.AddMany([
+            (box1, 0, wx.EXPAND),
+            (box2, 0, wx.EXPAND | wx.TOP, 10),
+            (box3, 0, wx.EXPAND | wx.TOP, 10),
+        ])
 
-                # If the password was correct and you are allowed to connect
-                # to the server, you'll get "accept"
-                if (answer.strip() != "accept"):
-                    sock.close()
-                    return False
-                elif (answer.strip("\n") == " accept"):
-                    serverType = "TCPEvents"
-                else:
-                    serverType = "Network Event Receiver"
+        while panel.Affirmed():
+            panel.SetResult(
+                addrCtrl.GetValue(),
+                portCtrl.GetValue(),
+                passwordCtrl.GetValue(),
+                expressionsCtrl.GetValue(),
+                None,
+            )
 
-            if serverType == "TCPEvents":
-                dataRequest = []
-                dataRequest.append(self.data)
-                sock.sendall("dataRequest %s\n" % str(dataRequest))
-                count = 0
-                answer = ""
-                try:
-                    close = False
-                    while (answer.find("\n") < 0) and count < 128:
-                        answer += sock.recv(512)
-                        count += 1
-                    close = (answer.find("close\n") >= 0)
-                    answer = answer[:answer.find("\n")]
-                except:
-                    pass
-                try:
-                    if not close:
-                        sock.sendall("close\n")
-                finally:
-                    sock.close()
-                answer = answer.strip()
-                if answer[:7] == "result ":
-                    try:
-                        result = eval(answer[7:])[0]
-                    except:
-                        eg.PrintError("Can not eval the response from the server: " + answer + ". Returning None.")
-                        result = None
-                else:
-                    eg.PrintError("The server didn't send back a response. It might not be able to evaluate the request (" + self.data + "==>" + answer + ").")
-                    result = None
-            else:
-                eg.PrintError("The server isn't a TCPEvents server(is it a Network Event Receiver?). Your request will be sent in the Payload")
-                sock.sendall("payload %s\n" % str(self.data).encode(eg.systemEncoding))
-                sock.sendall("payload withoutRelease\n")
-                sock.sendall("RequestData".encode(eg.systemEncoding) + "\n")
-                # tell the server that we are done nicely.
-                sock.sendall("close\n")
-                sock.close()
-                result = None
-            return result
+    def Send(self):
+        self.results = {}
+        try:
+            # receivers without keepalive answer one request per connection
+            while len(self.results) < len(self.expressions):
+                if not self.plugin.pool.Transact(self.host, self.port, self.password, self.Exchange):
+                    return None
+            return self.results
         except:
             if eg.debugLevel:
                 eg.PrintTraceback()
-            sock.close()
             self.PrintError("NetworkSender failed")
             return None
+
+    def Exchange(self, conn):
+        """Request the expressions that haven't been answered yet. A pooled session that dies is retried with the rest."""
+        if conn.serverType != "TCPEvents":
+            eg.PrintError("The server isn't a TCPEvents server(is it a Network Event Receiver?). It can't answer requests.")
+            return None, False
+        remaining = [expression for expression in self.expressions if expression not in self.results]
+        if "mux" not in conn.capabilities:
+            for expression in remaining:
+                conn.Send("dataRequest " + conn.codec.Encode(expression) + "\n")
+                answer = conn.ReadLine().strip()
+                if answer[:7] != "result ":
+                    # such a receiver closes the connection, the rest go over the next one
+                    eg.PrintError("The server didn't send back a response. It might not be able to evaluate the request (" + expression + "==>" + answer + "). Its result is None.")
+                    self.results[expression] = None
+                    return True, False
+                self.results[expression] = conn.codec.Decode(answer[7:])
+                if "keepalive" not in conn.capabilities:
+                    return True, False
+            return True, True
+        inFlight = {}
+        sent = 0
+        while sent < len(remaining) or inFlight:
+            lines = []
+            while sent < len(remaining) and len(inFlight) < conn.requestsInFlight:
+                inFlight[str(sent)] = remaining[sent]
+                lines.append("dataRequestId %d %s\n" % (sent, conn.codec.Encode(remaining[sent])))
+                sent += 1
+            if lines:
+                conn.Send("".join(lines))
+            answer = conn.ReadLine().strip()
+            verb, dummySeparator, rest = answer.partition(" ")
+            requestId, dummySeparator, value = rest.partition(" ")
+            expression = inFlight.pop(requestId, None)
+            if expression is None or verb not in ("resultId", "resultError"):
+                raise socket.error("Unexpected answer to a dataRequestId: " + answer)
+            if verb == "resultId":
+                self.results[expression] = conn.codec.Decode(value)
+            else:
+                eg.PrintError("The server couldn't evaluate " + expression + ". Its result is None.")
+                self.results[expression] = None
+        return True, "keepalive" in conn.capabilities
+
+
+class SubscribeData(eg.ActionBase):
+    name = "Subscribe to Data"
+    description = (
+        "Subscribes to data stored by Send Data on another TCPEvents plugin. Every value "
+        "stored under one of the names, which can be patterns like sensor.*, is sent over "
+        "right away and again whenever it changes. Such values are stored in the received "
+        "data of this plugin and trigger {prefix}.DataChanged.{name} with the value as payload. "
+        "An empty list of names ends the subscription to the address."
+    )
+
+    def __call__(self, destIP, destPort, passwd, dataNames):
+        if destIP == "":
+            eg.PrintError("Destination address field is blank")
+        names = [name.strip() for name in eg.ParseString(dataNames).split(",") if name.strip() != ""]
+        self.plugin.subscriptions.Subscribe(eg.ParseString(destIP), destPort, eg.ParseString(passwd), names)
+        return True
+
+    def Configure(self, destIP="", destPort=1024, passwd="", dataNames=""):
+        text = Text
+        panel = eg.ConfigPanel()
+
+        addrCtrl = panel.TextCtrl(destIP)
+        portCtrl = panel.SpinIntCtrl(destPort, max=65535)
+        passwordCtrl = panel.TextCtrl(passwd, style=wx.TE_PASSWORD)
+        dataNamesCtrl = panel.TextCtrl(dataNames)
+
+        st1 = panel.StaticText(text.address)
+        st2 = panel.StaticText(text.port)
+        st3 = panel.StaticText(text.password)
+        st4 = panel.StaticText(text.dataNames)
+        eg.EqualizeWidths((st1, st2, st3, st4))
+
+        box1 = panel.BoxedGroup(text.tcpBox, (st1, addrCtrl), (st2, portCtrl))
+        box2 = panel.BoxedGroup(text.securityBox, (st3, passwordCtrl))
+        box3 = panel.BoxedGroup(text.dataBox, (st4, dataNamesCtrl))
+
+        panel.sizer.AddMany([
+            (box1, 0, wx.EXPAND),
+            (box2, 0, wx.EXPAND | wx.TOP, 10),
+            (box3, 0, wx.EXPAND | wx.TOP, 10),
+        ])
+
+        while panel.Affirmed():
+            panel.SetResult(
+                addrCtrl.GetValue(),
+                portCtrl.GetValue(),
+                passwordCtrl.GetValue(),
+                dataNamesCtrl.GetValue(),
+            )
+
+
+class GetServerStatistics(eg.ActionBase):
+    name = "Get Server Statistics"
+    description = (
+        "Returns a dict with the statistics of the receiver, the connection pool, "
+        "the queues and the caches."
+    )
+
+    def __call__(self):
+        return self.plugin.GetStatistics()
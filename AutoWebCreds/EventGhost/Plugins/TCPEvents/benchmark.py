@@ -0,0 +1,966 @@
+# This file is part of EventGhost.
+# Copyright (C) 2005 Lars-Peter Voss <bitmonster@eventghost.org>
+#
+# EventGhost is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# EventGhost is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with EventGhost; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Benchmarks for the TCPEvents plugin. They load the plugin outside of
+# EventGhost, against small stand-ins for the eg and wx modules, so they run
+# with any Python 2.7 interpreter on any OS:
+#
+#     python benchmark.py receive
+#     python benchmark.py codec
+#     python benchmark.py load
+#     python benchmark.py protocol --output results.json
+#     python benchmark.py flood
+#     python benchmark.py burst
+
+
+import argparse
+import asyncore
+import datetime
+import imp
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+def StubModules():
+    """Install the eg and wx stand-ins the plugin needs to be imported."""
+    eg = types.ModuleType("eg")
+    eg.debugLevel = 0
+    eg.systemEncoding = "utf-8"
+    eg.triggered = []
+
+    def PrintError(*args):
+        sys.stderr.write(" ".join(str(arg) for arg in args) + "\n")
+
+    class Info(object):
+        eventPrefix = ""
+
+    class PluginBase(object):
+        Exception = Exception
+
+        def __init__(self):
+            pass
+
+        def __new__(cls, *args, **kwargs):
+            self = object.__new__(cls)
+            self.info = Info()
+            return self
+
+        def AddEvents(self):
+            pass
+
+        def AddAction(self, action):
+            pass
+
+        def TriggerEvent(self, suffix, payload=None, prefix=None):
+            eg.triggered.append((time.time(), prefix or self.info.eventPrefix, suffix, payload))
+
+        TriggerEnduringEvent = TriggerEvent
+
+        def EndLastEvent(self):
+            pass
+
+    class ActionBase(object):
+        def PrintError(self, *args):
+            PrintError(*args)
+
+    eg.RegisterPlugin = lambda **kwargs: None
+    eg.PluginBase = PluginBase
+    eg.ActionBase = ActionBase
+    eg.PrintError = PrintError
+    eg.Print = PrintError
+    eg.PrintTraceback = lambda *args: None
+    eg.ParseString = lambda string: string
+    eg.RestartAsyncore = lambda: None
+    wx = types.ModuleType("wx")
+    sys.modules["eg"] = eg
+    sys.modules["wx"] = wx
+    return eg
+
+
+eg = StubModules()
+TCPEvents = imp.load_source("TCPEvents", os.path.join(os.path.dirname(os.path.abspath(__file__)), "__init__.py"))
+
+
+class LegacyBuffer(object):
+    """The string concatenating receive buffer of TCPEvents 2.1, for comparison."""
+
+    def collect_incoming_data(self, data):
+        self.data = self.data + data
+
+    def found_terminator(self):
+        line = self.data
+        self.data = ''
+        self.state(line)
+
+
+def StartPlugin(password="", handler=None, *args, **kwargs):
+    """Start the plugin on a free loopback port and run its asyncore loop in a thread."""
+    if handler is not None:
+        TCPEvents.ServerHandler = handler
+    plugin = TCPEvents.TCPEvents()
+    plugin.__start__(0, password, "TCP", False, 5.0, 30.0, *args, **kwargs)
+    plugin.loopStop = threading.Event()
+    plugin.loopErrors = []
+    plugin.loopThread = threading.Thread(target=Loop, args=(plugin.loopStop, plugin.loopErrors))
+    plugin.loopThread.setDaemon(True)
+    plugin.loopThread.start()
+    return plugin, plugin.server.getsockname()[1]
+
+
+def Loop(stopEvent, errors):
+    """Stand-in for EventGhost's asyncore loop."""
+    while not stopEvent.isSet():
+        if not asyncore.socket_map:
+            # the plugin runs on its own server thread
+            stopEvent.wait(0.05)
+            continue
+        try:
+            asyncore.loop(timeout=0.05, count=1)
+        except Exception, exc:
+            errors.append(str(exc))
+            return
+
+
+def StopPlugin(plugin):
+    plugin.loopStop.set()
+    plugin.loopThread.join()
+    plugin.__stop__()
+    asyncore.close_all()
+
+
+def BenchmarkReceive(sizes, repeat):
+    """Time how long the receiver needs to take in payload lines of the given sizes."""
+    received = []
+    handler = TCPEvents.ServerHandler
+
+    class TimedHandler(handler):
+        def state3(self, line):
+            received.append((time.time(), len(line)))
+
+    class LegacyHandler(LegacyBuffer, TimedHandler):
+        def __init__(self, *args):
+            TimedHandler.__init__(self, *args)
+            self.data = ''
+
+    results = []
+    for name, cls in (("before", LegacyHandler), ("after", TimedHandler)):
+        plugin, port = StartPlugin("", cls, True, 4, 30.0, 2048)
+        for size in sizes:
+            line = "data ['" + "x" * (size - 10) + "']\n"
+            timings = []
+            for dummyRepeat in range(repeat):
+                del received[:]
+                sock = socket.create_connection(("127.0.0.1", port))
+                start = time.time()
+                sock.sendall(line)
+                while not received:
+                    time.sleep(0.0005)
+                timings.append(received[0][0] - start)
+                sock.close()
+            best = min(timings)
+            results.append((name, size, best, size / best / 1024 / 1024))
+        StopPlugin(plugin)
+    TCPEvents.ServerHandler = handler
+    print "%-8s %12s %10s %10s" % ("buffer", "line bytes", "seconds", "MB/s")
+    for name, size, seconds, throughput in results:
+        print "%-8s %12d %10.4f %10.1f" % (name, size, seconds, throughput)
+    return results
+
+
+def BenchmarkCodec(sizes, repeat):
+    """Time encoding and decoding of payloads of the given number of records with each codec."""
+
+    def Record(index):
+        return {
+            "name": "sensor %d" % index,
+            "value": index * 1.5,
+            "count": index,
+            "range": (index, index + 10),
+            "tags": ["a", "b", u"\xe9"],
+            "time": datetime.datetime(2020, 1, 1, 12, 0, index % 60),
+        }
+
+    results = []
+    for size in sizes:
+        payload = [Record(index) for index in range(size)]
+        for codec in (TCPEvents.ReprCodec, TCPEvents.JsonCodec):
+            encoded = codec.Encode(payload)
+            encodeTime = decodeTime = float("inf")
+            for dummyRepeat in range(repeat):
+                start = time.time()
+                codec.Encode(payload)
+                encodeTime = min(encodeTime, time.time() - start)
+                start = time.time()
+                codec.Decode(encoded)
+                decodeTime = min(decodeTime, time.time() - start)
+            results.append((codec.__name__, size, len(encoded), encodeTime, decodeTime))
+    print "%-10s %8s %10s %12s %12s" % ("codec", "records", "bytes", "encode ms", "decode ms")
+    for name, size, length, encodeTime, decodeTime in results:
+        print "%-10s %8d %10d %12.3f %12.3f" % (name, size, length, encodeTime * 1000, decodeTime * 1000)
+    return results
+
+
+def LoadSenders(port, senders, events, ready, done):
+    """Connect the senders one after the other, then let each of them send its events."""
+    if hasattr(os, "nice"):
+        os.nice(5)
+    sockets = []
+    start = time.time()
+    try:
+        for dummyIndex in range(senders):
+            sockets.append(socket.create_connection(("127.0.0.1", port), 60))
+        lines = "Load.Event\n" * events
+        ready.put((start, time.time()))
+        for sock in sockets:
+            sock.sendall(lines)
+        done.wait()
+    except Exception, exc:
+        ready.put(str(exc))
+    for sock in sockets:
+        sock.close()
+
+
+def BenchmarkLoad(engines, sendersList, events, timeout):
+    """Connections/sec and events/sec with many concurrent senders on each server engine."""
+    accepted = []
+    handler = TCPEvents.ServerHandler
+
+    class CountingHandler(handler):
+        def __init__(self, *args):
+            handler.__init__(self, *args)
+            accepted.append(time.time())
+
+    results = []
+    for engine in engines:
+        for senders in sendersList:
+            del accepted[:]
+            del eg.triggered[:]
+            plugin, port = StartPlugin("", CountingHandler, True, 4, 30.0, 64, engine)
+            ready = multiprocessing.Queue()
+            done = multiprocessing.Event()
+            process = multiprocessing.Process(target=LoadSenders, args=(port, senders, events, ready, done))
+            process.start()
+            times = ready.get(timeout=timeout)
+            result = dict(engine=engine, senders=senders, error=None)
+            if isinstance(times, str):
+                result["error"] = times
+            else:
+                deadline = time.time() + timeout
+                while len(eg.triggered) < senders * events and time.time() < deadline and not plugin.loopErrors:
+                    time.sleep(0.01)
+                if len(eg.triggered) < senders * events:
+                    result["error"] = (plugin.loopErrors or ["timed out"])[0]
+                else:
+                    start, connected = times
+                    result["connectionsPerSecond"] = senders / (max(accepted[-1], connected) - start)
+                    result["eventsPerSecond"] = senders * events / (eg.triggered[-1][0] - connected)
+            done.set()
+            process.join()
+            StopPlugin(plugin)
+            results.append(result)
+    TCPEvents.ServerHandler = handler
+    print "%-32s %8s %14s %14s" % ("engine", "senders", "connections/s", "events/s")
+    for result in results:
+        name = TCPEvents.Text.engines[result["engine"]]
+        if result["error"]:
+            print "%-32s %8d failed: %s" % (name, result["senders"], result["error"])
+        else:
+            print "%-32s %8d %14.0f %14.0f" % (name, result["senders"], result["connectionsPerSecond"], result["eventsPerSecond"])
+    return results
+
+
+def Percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def ProtocolSenders(port, password, action, threads, count, pool, ready, go, results):
+    """Send with the plugin's own actions from a number of threads and report what each of them saw."""
+    plugin = TCPEvents.TCPEvents()
+    plugin.__start__(0, "", "Sender", False, 10.0, 30.0, pool, threads)
+    actionClass = dict(event=TCPEvents.SendEvent, data=TCPEvents.SendData, request=TCPEvents.RequestData)[action]
+    outcomes = []
+
+    def Sender():
+        sender = actionClass()
+        sender.plugin = plugin
+        latencies = []
+        errors = 0
+        go.wait()
+        for dummyIndex in range(count):
+            start = time.time()
+            if action == "event":
+                # the receiver measures the latency from the time in the payload
+                result = sender("127.0.0.1", port, password, "Bench", "Event", "", start)
+            elif action == "data":
+                result = sender("127.0.0.1", port, password, "bench", "", start)
+            else:
+                result = sender("127.0.0.1", port, password, "1")
+            latencies.append(time.time() - start)
+            if result is None or result is False:
+                errors += 1
+        outcomes.append((latencies, errors, time.time()))
+
+    workers = [threading.Thread(target=Sender) for dummyIndex in range(threads)]
+    for worker in workers:
+        worker.start()
+    ready.put(True)
+    for worker in workers:
+        worker.join()
+    plugin.__stop__()
+    results.put(dict(
+        latencies=[latency for latencies, errors, end in outcomes for latency in latencies],
+        errors=sum(errors for latencies, errors, end in outcomes),
+        end=max(end for latencies, errors, end in outcomes),
+    ))
+
+
+def BenchmarkProtocol(passwords, actions, processes, threads, count, pool, timeout):
+    """
+    Events, data sends and requests per second, handshakes per second and
+    latency, sent with the real actions from other processes.
+    """
+    results = []
+    for password in passwords:
+        for action in actions:
+            del eg.triggered[:]
+            plugin, port = StartPlugin(password)
+            ready = multiprocessing.Queue()
+            done = multiprocessing.Queue()
+            go = multiprocessing.Event()
+            senders = [
+                multiprocessing.Process(target=ProtocolSenders, args=(port, password, action, threads, count, pool, ready, go, done))
+                for dummyIndex in range(processes)
+            ]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                ready.get(timeout=timeout)
+            start = time.time()
+            go.set()
+            outcomes = [done.get(timeout=timeout) for sender in senders]
+            for sender in senders:
+                sender.join()
+            total = processes * threads * count
+            end = max(outcome["end"] for outcome in outcomes)
+            if action == "event":
+                deadline = time.time() + timeout
+                while len(eg.triggered) < total and time.time() < deadline:
+                    time.sleep(0.01)
+                if eg.triggered:
+                    end = eg.triggered[-1][0]
+                latencies = [triggered - payload for triggered, prefix, suffix, payload in eg.triggered]
+            else:
+                latencies = [latency for outcome in outcomes for latency in outcome["latencies"]]
+            stats = plugin.stats.GetStats()
+            StopPlugin(plugin)
+            elapsed = end - start
+            results.append(dict(
+                action=action,
+                password=bool(password),
+                pool=pool,
+                senders=processes * threads,
+                sent=total,
+                errors=sum(outcome["errors"] for outcome in outcomes),
+                triggered=len(eg.triggered) if action == "event" else None,
+                seconds=elapsed,
+                perSecond=total / elapsed,
+                connectionsPerSecond=stats["connectionsOpened"] / elapsed,
+                handshakesPerSecond=stats["handshakes"] / elapsed,
+                p50=Percentile(latencies, 50),
+                p99=Percentile(latencies, 99),
+            ))
+    print "%-8s %-9s %8s %10s %12s %12s %10s %10s %7s" % ("action", "password", "senders", "per sec", "connects/s", "handshakes/s", "p50 ms", "p99 ms", "errors")
+    for result in results:
+        print "%-8s %-9s %8d %10.0f %12.0f %12.0f %10.2f %10.2f %7d" % (
+            result["action"], "yes" if result["password"] else "no", result["senders"], result["perSecond"],
+            result["connectionsPerSecond"], result["handshakesPerSecond"], (result["p50"] or 0) * 1000,
+            (result["p99"] or 0) * 1000, result["errors"],
+        )
+    return results
+
+
+def Flooder(port, stop):
+    """Send events as fast as the receiver takes them, reconnecting if it hangs up."""
+    lines = "Flood.Event\n" * 1000
+    while not stop.is_set():
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), 1.0)
+            while not stop.is_set():
+                try:
+                    sock.sendall(lines)
+                except socket.timeout:
+                    pass
+        except socket.error:
+            time.sleep(0.01)
+
+
+def BenchmarkFlood(modes, flooders, rate, burst, count, interval, source):
+    """
+    Event latency of a well-behaved sender while other senders flood the
+    receiver, without limits and with each policy of the flood protection.
+    The well-behaved sender connects from another loopback address, so it
+    has a bucket of its own.
+    """
+    results = []
+    for mode in modes:
+        del eg.triggered[:]
+        if mode == "off":
+            plugin, port = StartPlugin()
+        else:
+            plugin, port = StartPlugin(eventRate=rate, eventBurst=burst, floodPolicy=1 if mode == "drop" else 0)
+        stop = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=Flooder, args=(port, stop)) for dummyIndex in range(flooders)]
+        for process in processes:
+            process.start()
+        time.sleep(1.0)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((source, 0))
+        sock.connect(("127.0.0.1", port))
+        start = time.time()
+        for dummyIndex in range(count):
+            sock.sendall("payload [%r]\nLegit.Event\n" % time.time())
+            time.sleep(interval)
+        time.sleep(0.5)
+        elapsed = time.time() - start
+        sock.close()
+        stop.set()
+        for process in processes:
+            process.join()
+        stats = plugin.stats.GetStats()
+        StopPlugin(plugin)
+        latencies = [triggered - payload for triggered, prefix, suffix, payload in eg.triggered if prefix == "Legit"]
+        flooded = sum(1 for triggered, prefix, suffix, payload in eg.triggered if start <= triggered and prefix == "Flood")
+        results.append(dict(
+            mode=mode,
+            flooders=flooders,
+            received=len(latencies),
+            sent=count,
+            p50=Percentile(latencies, 50),
+            p99=Percentile(latencies, 99),
+            max=max(latencies) if latencies else None,
+            floodEventsPerSecond=flooded / elapsed,
+            eventsDropped=stats["eventsDropped"],
+            throttled=stats["throttled"],
+        ))
+    print "%-6s %9s %9s %9s %9s %16s %10s %10s" % ("mode", "received", "p50 ms", "p99 ms", "max ms", "flood events/s", "dropped", "throttled")
+    for result in results:
+        print "%-6s %9s %9.2f %9.2f %9.2f %16.0f %10d %10d" % (
+            result["mode"], "%d/%d" % (result["received"], result["sent"]), (result["p50"] or 0) * 1000,
+            (result["p99"] or 0) * 1000, (result["max"] or 0) * 1000, result["floodEventsPerSecond"],
+            result["eventsDropped"], result["throttled"],
+        )
+    return results
+
+
+def BurstSenders(port, senders, ready, go, finished, results):
+    """Connect all senders at the same moment, each of them sends one event."""
+    outcomes = []
+
+    def Sender():
+        go.wait()
+        start = time.time()
+        try:
+            sock = socket.create_connection(("127.0.0.1", port), 30)
+            connected = time.time()
+            sock.sendall("payload [%r]\nBurst.Event\n" % start)
+            outcomes.append((connected - start, sock))
+        except socket.error, exc:
+            outcomes.append((None, str(exc)))
+
+    threads = [threading.Thread(target=Sender) for dummyIndex in range(senders)]
+    for thread in threads:
+        thread.start()
+    ready.put(True)
+    for thread in threads:
+        thread.join()
+    results.put([latency for latency, dummySock in outcomes])
+    # connections the receiver hasn't accepted yet would be lost
+    finished.wait()
+    for latency, sock in outcomes:
+        if latency is not None:
+            sock.close()
+
+
+def BenchmarkBurst(backlogs, senders, timeout):
+    """
+    Connect and connect-to-TriggerEvent latency of a burst of senders that
+    all connect at the same moment, with the old single accept per
+    notification and with the accept loop, for each listen backlog.
+    """
+    server = TCPEvents.Server
+
+    class SingleAcceptServer(server):
+        """The accept of TCPEvents 2.1, one connection per readiness notification."""
+
+        def handle_accept(self):
+            accepted = self.accept()
+            if accepted is not None:
+                self.Accept(*accepted)
+
+    results = []
+    for accept in ("single", "loop"):
+        for backlog in backlogs:
+            if accept == "single":
+                TCPEvents.Server = SingleAcceptServer
+            del eg.triggered[:]
+            plugin, port = StartPlugin(listenBacklog=backlog)
+            TCPEvents.Server = server
+            ready = multiprocessing.Queue()
+            done = multiprocessing.Queue()
+            go = multiprocessing.Event()
+            finished = multiprocessing.Event()
+            process = multiprocessing.Process(target=BurstSenders, args=(port, senders, ready, go, finished, done))
+            process.start()
+            ready.get(timeout=timeout)
+            # let the threads get to the starting line
+            time.sleep(0.5)
+            go.set()
+            connects = done.get(timeout=timeout)
+            deadline = time.time() + timeout
+            while len(eg.triggered) < len([latency for latency in connects if latency is not None]) and time.time() < deadline:
+                time.sleep(0.01)
+            finished.set()
+            process.join()
+            StopPlugin(plugin)
+            latencies = [triggered - payload for triggered, prefix, suffix, payload in eg.triggered]
+            connected = [latency for latency in connects if latency is not None]
+            results.append(dict(
+                accept=accept,
+                backlog=backlog,
+                senders=senders,
+                failed=len(connects) - len(connected),
+                connectP50=Percentile(connected, 50),
+                connectP99=Percentile(connected, 99),
+                connectMax=max(connected) if connected else None,
+                triggered=len(latencies),
+                triggerP50=Percentile(latencies, 50),
+                triggerP99=Percentile(latencies, 99),
+                triggerMax=max(latencies) if latencies else None,
+            ))
+    print "%-7s %8s %7s %15s %15s %15s %15s %10s" % ("accept", "backlog", "failed", "connect p50 ms", "connect p99 ms", "trigger p50 ms", "trigger p99 ms", "triggered")
+    for result in results:
+        print "%-7s %8d %7d %15.1f %15.1f %15.1f %15.1f %10d" % (
+            result["accept"], result["backlog"], result["failed"], (result["connectP50"] or 0) * 1000,
+            (result["connectP99"] or 0) * 1000, (result["triggerP50"] or 0) * 1000,
+            (result["triggerP99"] or 0) * 1000, result["triggered"],
+        )
+    return results
+
+
+def TransportSender(port, password, transport, count, ready, go, results):
+    """Send events with Send an Event, over a pooled TCP connection or as datagrams."""
+    plugin = TCPEvents.TCPEvents()
+    plugin.__start__(0, "", "Sender", False, 10.0, 30.0, True)
+    sender = TCPEvents.SendEvent()
+    sender.plugin = plugin
+    errors = 0
+    ready.put(True)
+    go.wait()
+    for dummyIndex in range(count):
+        result = sender("127.0.0.1", port, password, "Bench", "Event", "", time.time(), False, transport == "udp")
+        if result is None or result is False:
+            errors += 1
+    plugin.__stop__()
+    results.put(dict(errors=errors, end=time.time()))
+
+
+def BenchmarkUdp(transports, processes, count, password, timeout):
+    """
+    Events per second, loss and latency of events sent over TCP and as UDP
+    datagrams, to a receiver with the UDP listener on.
+    """
+    results = []
+    for transport in transports:
+        del eg.triggered[:]
+        plugin, port = StartPlugin(password, udpEnabled=True)
+        ready = multiprocessing.Queue()
+        done = multiprocessing.Queue()
+        go = multiprocessing.Event()
+        senders = [
+            multiprocessing.Process(target=TransportSender, args=(port, password, transport, count, ready, go, done))
+            for dummyIndex in range(processes)
+        ]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            ready.get(timeout=timeout)
+        start = time.time()
+        go.set()
+        outcomes = [done.get(timeout=timeout) for sender in senders]
+        for sender in senders:
+            sender.join()
+        total = processes * count
+        # datagrams that were lost never arrive, wait until the events stop coming
+        received = -1
+        deadline = time.time() + timeout
+        while received != len(eg.triggered) and len(eg.triggered) < total and time.time() < deadline:
+            received = len(eg.triggered)
+            time.sleep(0.5)
+        end = eg.triggered[-1][0] if eg.triggered else time.time()
+        latencies = [triggered - payload for triggered, prefix, suffix, payload in eg.triggered]
+        stats = plugin.stats.GetStats()
+        StopPlugin(plugin)
+        results.append(dict(
+            transport=transport,
+            senders=processes,
+            sent=total,
+            errors=sum(outcome["errors"] for outcome in outcomes),
+            received=len(latencies),
+            lost=total - len(latencies),
+            perSecond=len(latencies) / (end - start),
+            p50=Percentile(latencies, 50),
+            p99=Percentile(latencies, 99),
+            datagramsRejected=stats["datagramsRejected"],
+        ))
+    print "%-9s %8s %10s %10s %8s %10s %10s %7s" % ("transport", "senders", "received", "per sec", "lost", "p50 ms", "p99 ms", "errors")
+    for result in results:
+        print "%-9s %8d %10d %10.0f %8d %10.2f %10.2f %7d" % (
+            result["transport"], result["senders"], result["received"], result["perSecond"], result["lost"],
+            (result["p50"] or 0) * 1000, (result["p99"] or 0) * 1000, result["errors"],
+        )
+    return results
+
+
+def BenchmarkMulti(counts, repeat, password):
+    """
+    Time to poll a number of expressions with a Request Data action each,
+    connecting for each of them or over pooled connections, and with one
+    Request Multiple Data action.
+    """
+    results = []
+    plugin, port = StartPlugin(password)
+    for count in counts:
+        expressions = ["%d * 2" % index for index in range(count)]
+        for mode in ("connect", "pool", "multiple"):
+            sender = TCPEvents.TCPEvents()
+            sender.__start__(0, "", "Sender", False, 10.0, 30.0, mode != "connect")
+            opened = plugin.stats.GetStats()["connectionsOpened"]
+            times = []
+            for dummyIndex in range(repeat):
+                start = time.time()
+                if mode == "multiple":
+                    action = TCPEvents.RequestMultipleData()
+                    action.plugin = sender
+                    answers = action("127.0.0.1", port, password, "", expressions)
+                    answers = [answers[expression] for expression in expressions]
+                else:
+                    action = TCPEvents.RequestData()
+                    action.plugin = sender
+                    answers = [action("127.0.0.1", port, password, expression) for expression in expressions]
+                times.append(time.time() - start)
+                assert answers == [index * 2 for index in range(count)], answers
+            sender.__stop__()
+            results.append(dict(
+                mode=mode,
+                expressions=count,
+                p50=Percentile(times, 50),
+                max=max(times),
+                connections=(plugin.stats.GetStats()["connectionsOpened"] - opened) / float(repeat),
+            ))
+    StopPlugin(plugin)
+    print "%-9s %12s %10s %10s %12s" % ("mode", "expressions", "p50 ms", "max ms", "connections")
+    for result in results:
+        print "%-9s %12d %10.2f %10.2f %12.1f" % (
+            result["mode"], result["expressions"], result["p50"] * 1000, result["max"] * 1000, result["connections"],
+        )
+    return results
+
+
+def BenchmarkResolve(delays, count, host):
+    """
+    Latency of Send an Event to a host name, connecting for every send, with
+    and without the resolver cache. The name lookups are slowed down by the
+    given number of seconds, like a slow DNS server would.
+    """
+    lookup = socket.getaddrinfo
+
+    def SlowLookup(*args, **kwargs):
+        time.sleep(delay)
+        return lookup(*args, **kwargs)
+
+    results = []
+    plugin, port = StartPlugin()
+    socket.getaddrinfo = SlowLookup
+    try:
+        for delay in delays:
+            for cache in (False, True):
+                sender = TCPEvents.TCPEvents()
+                sender.__start__(0, "", "Sender", False, 10.0, 30.0, False)
+                if not cache:
+                    # without a resolver the lookup happens inside connect(), out of reach of SlowLookup
+                    sender.resolver = TCPEvents.Resolver(1e-9, 1e-9)
+                action = TCPEvents.SendEvent()
+                action.plugin = sender
+                latencies = []
+                errors = 0
+                for index in range(count):
+                    start = time.time()
+                    if action(host, port, "", "Bench", "Event", "", index) is None:
+                        errors += 1
+                    latencies.append(time.time() - start)
+                stats = sender.GetStatistics()["resolver"]
+                sender.__stop__()
+                results.append(dict(
+                    delay=delay,
+                    cache=cache,
+                    p50=Percentile(latencies, 50),
+                    p99=Percentile(latencies, 99),
+                    hitRate=stats["hitRate"] if cache else 0.0,
+                    errors=errors,
+                ))
+    finally:
+        socket.getaddrinfo = lookup
+        StopPlugin(plugin)
+    print "%-9s %6s %10s %10s %9s %7s" % ("delay ms", "cache", "p50 ms", "p99 ms", "hit rate", "errors")
+    for result in results:
+        print "%-9.0f %6s %10.2f %10.2f %9.3f %7d" % (
+            result["delay"] * 1000, "yes" if result["cache"] else "no", result["p50"] * 1000, result["p99"] * 1000,
+            result["hitRate"], result["errors"],
+        )
+    return results
+
+
+def BenchmarkHedge(delays, count, slow, stall, password):
+    """
+    Request Data latency from receivers that stall for a while on a share of
+    the requests, asking one of them or two replicas with each hedge delay,
+    and with the first replica down.
+    """
+    # each receiver stalls on its own share of the requests, like a busy host or a GC pause
+    expression = "__import__('time').sleep(%r) or 1 if __import__('random').random() < %r else 1" % (stall, slow)
+    first, firstPort = StartPlugin(password, engine=1)
+    second, secondPort = StartPlugin(password, engine=1)
+    down = socket.socket()
+    down.bind(("127.0.0.1", 0))
+    downPort = down.getsockname()[1]
+    down.close()
+    setups = [("single", "127.0.0.1:%d" % firstPort, delays[0])]
+    setups += [("hedged", "127.0.0.1:%d, 127.0.0.1:%d" % (firstPort, secondPort), delay) for delay in delays]
+    setups += [("first down", "127.0.0.1:%d, 127.0.0.1:%d" % (downPort, secondPort), delays[0])]
+    results = []
+    for replicas, hosts, delay in setups:
+        sender = TCPEvents.TCPEvents()
+        sender.__start__(0, "", "Sender", False, 5.0, 30.0)
+        action = TCPEvents.RequestData()
+        action.plugin = sender
+        latencies = []
+        errors = 0
+        for dummyIndex in range(count):
+            start = time.time()
+            if action(hosts, firstPort, password, expression, delay) != 1:
+                errors += 1
+            latencies.append(time.time() - start)
+        stats = sender.GetStatistics()["replicas"]
+        sender.__stop__()
+        results.append(dict(
+            replicas=replicas,
+            hedgeDelay=delay,
+            p50=Percentile(latencies, 50),
+            p99=Percentile(latencies, 99),
+            max=max(latencies),
+            hedges=stats["hedges"],
+            failovers=stats["failovers"],
+            errors=errors,
+        ))
+    StopPlugin(first)
+    StopPlugin(second)
+    print "%-11s %9s %10s %10s %10s %7s %10s %7s" % ("replicas", "hedge ms", "p50 ms", "p99 ms", "max ms", "hedges", "failovers", "errors")
+    for result in results:
+        print "%-11s %9.0f %10.2f %10.2f %10.2f %7d %10d %7d" % (
+            result["replicas"], result["hedgeDelay"] * 1000, result["p50"] * 1000, result["p99"] * 1000, result["max"] * 1000,
+            result["hedges"], result["failovers"], result["errors"],
+        )
+    return results
+
+
+def BenchmarkOutbox(counts, password, timeout):
+    """
+    Send an Event latency while the receiver is down, with and without the
+    outbox, and how long the outbox takes to deliver the kept events once
+    the receiver is back.
+    """
+    eg.configDir = tempfile.mkdtemp()
+    free = socket.socket()
+    free.bind(("127.0.0.1", 0))
+    port = free.getsockname()[1]
+    free.close()
+    results = []
+    try:
+        for count in counts:
+            for outboxSize in (0, 64):
+                sender = TCPEvents.TCPEvents()
+                sender.__start__(0, "", "Sender", False, 5.0, 30.0, outboxSize=outboxSize)
+                action = TCPEvents.SendEvent()
+                action.plugin = sender
+                stderr = sys.stderr
+                # one error message per event
+                sys.stderr = open(os.devnull, "w")
+                latencies = []
+                try:
+                    for index in range(count):
+                        start = time.time()
+                        action("127.0.0.1", port, password, "Bench", "Event%d" % index, "", index)
+                        latencies.append(time.time() - start)
+                finally:
+                    sys.stderr.close()
+                    sys.stderr = stderr
+                del eg.triggered[:]
+                receiver = TCPEvents.TCPEvents()
+                receiver.__start__(port, password, "TCP", False, 5.0, 30.0, engine=1)
+                start = time.time()
+                deadline = start + (timeout if outboxSize else 2.0)
+                while len(eg.triggered) < count and time.time() < deadline:
+                    time.sleep(0.01)
+                delivered = [event[3] for event in eg.triggered]
+                result = dict(
+                    outbox=outboxSize > 0,
+                    events=count,
+                    p50=Percentile(latencies, 50),
+                    p99=Percentile(latencies, 99),
+                    delivered=len(delivered),
+                    inOrder=delivered == range(len(delivered)),
+                    replaySeconds=None,
+                    eventsPerSecond=None,
+                )
+                if delivered:
+                    # the outbox waits OUTBOX_RETRY_MIN seconds before it tries a receiver again
+                    result["replaySeconds"] = eg.triggered[-1][0] - start
+                    result["eventsPerSecond"] = len(delivered) / (eg.triggered[-1][0] - eg.triggered[0][0] or 1e-9)
+                results.append(result)
+                sender.__stop__()
+                receiver.__stop__()
+    finally:
+        shutil.rmtree(eg.configDir, True)
+    print "%-7s %8s %10s %10s %10s %9s %10s %12s" % ("outbox", "events", "p50 ms", "p99 ms", "delivered", "in order", "replay s", "events/s")
+    for result in results:
+        print "%-7s %8d %10.3f %10.3f %10d %9s %10s %12s" % (
+            "yes" if result["outbox"] else "no", result["events"], result["p50"] * 1000, result["p99"] * 1000,
+            result["delivered"], "yes" if result["inOrder"] else "no",
+            "-" if result["replaySeconds"] is None else "%.2f" % result["replaySeconds"],
+            "-" if result["eventsPerSecond"] is None else "%.0f" % result["eventsPerSecond"],
+        )
+    return results
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the TCPEvents plugin.")
+    parser.add_argument("--output", help="also save the results to this JSON file, to compare runs")
+    commands = parser.add_subparsers(dest="command")
+    receive = commands.add_parser("receive", help="receive throughput for large payload lines")
+    receive.add_argument("--sizes", type=int, nargs="+", default=[1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024, 50 * 1024 * 1024])
+    receive.add_argument("--repeat", type=int, default=3)
+    codec = commands.add_parser("codec", help="payload encode/decode cost of each codec")
+    codec.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    codec.add_argument("--repeat", type=int, default=5)
+    load = commands.add_parser("load", help="connections/sec and events/sec with many concurrent senders")
+    load.add_argument("--engines", type=int, nargs="+", default=[0, 1], help="0: EventGhost asyncore loop, 1: dedicated thread")
+    load.add_argument("--senders", type=int, nargs="+", default=[1000, 10000])
+    load.add_argument("--events", type=int, default=10, help="events per sender")
+    load.add_argument("--timeout", type=float, default=120.0)
+    protocol = commands.add_parser("protocol", help="throughput, handshake rate and latency of the send actions")
+    protocol.add_argument("--passwords", nargs="+", default=["", "benchmark"], help='"" for no authentication')
+    protocol.add_argument("--actions", nargs="+", choices=["event", "data", "request"], default=["event", "data", "request"])
+    protocol.add_argument("--processes", type=int, default=4, help="sender processes")
+    protocol.add_argument("--threads", type=int, default=4, help="sender threads per process")
+    protocol.add_argument("--count", type=int, default=500, help="sends per thread")
+    protocol.add_argument("--no-pool", dest="pool", action="store_false", help="connect and authenticate for every send")
+    protocol.add_argument("--timeout", type=float, default=120.0)
+    flood = commands.add_parser("flood", help="latency of a well-behaved sender while others flood the receiver")
+    flood.add_argument("--modes", nargs="+", choices=["off", "defer", "drop"], default=["off", "defer", "drop"])
+    flood.add_argument("--flooders", type=int, default=4, help="flooding sender processes")
+    flood.add_argument("--rate", type=float, default=1000.0, help="events per second per sender address")
+    flood.add_argument("--burst", type=int, default=100)
+    flood.add_argument("--count", type=int, default=500, help="events of the well-behaved sender")
+    flood.add_argument("--interval", type=float, default=0.01, help="seconds between them")
+    flood.add_argument("--source", default="127.0.0.2", help="loopback address of the well-behaved sender")
+    burst = commands.add_parser("burst", help="connect latency of many senders connecting at the same moment")
+    burst.add_argument("--backlogs", type=int, nargs="+", default=[5, 128, 1024], help="listen backlogs")
+    burst.add_argument("--senders", type=int, default=500)
+    burst.add_argument("--timeout", type=float, default=60.0)
+    udp = commands.add_parser("udp", help="events per second and loss over TCP and UDP")
+    udp.add_argument("--transports", nargs="+", choices=["tcp", "udp"], default=["tcp", "udp"])
+    udp.add_argument("--processes", type=int, default=4, help="sender processes")
+    udp.add_argument("--count", type=int, default=20000, help="events per process")
+    udp.add_argument("--password", default="benchmark", help='"" for no authentication')
+    udp.add_argument("--timeout", type=float, default=120.0)
+    multi = commands.add_parser("multi", help="time to poll many expressions from one receiver")
+    multi.add_argument("--counts", type=int, nargs="+", default=[10, 40, 200], help="expressions per poll")
+    multi.add_argument("--repeat", type=int, default=20)
+    multi.add_argument("--password", default="benchmark", help='"" for no authentication')
+    resolve = commands.add_parser("resolve", help="send latency to a host name with slow name lookups")
+    resolve.add_argument("--delays", type=float, nargs="+", default=[0.0, 0.05, 0.2], help="seconds added to each lookup")
+    resolve.add_argument("--count", type=int, default=100, help="sends per setting")
+    resolve.add_argument("--host", default="localhost")
+    hedge = commands.add_parser("hedge", help="request latency from replicas that stall now and then")
+    hedge.add_argument("--delays", type=float, nargs="+", default=[0.01, 0.05, 0.1], help="hedge delays in seconds")
+    hedge.add_argument("--count", type=int, default=500, help="requests per setting")
+    hedge.add_argument("--slow", type=float, default=0.02, help="share of the requests a receiver stalls on")
+    hedge.add_argument("--stall", type=float, default=0.5, help="seconds a stall lasts")
+    hedge.add_argument("--password", default="benchmark", help='"" for no authentication')
+    outbox = commands.add_parser("outbox", help="send latency to a receiver that is down and replay of the kept events")
+    outbox.add_argument("--counts", type=int, nargs="+", default=[1000, 20000], help="events sent while the receiver is down")
+    outbox.add_argument("--password", default="benchmark", help='"" for no authentication')
+    outbox.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+    if args.command == "receive":
+        results = BenchmarkReceive(args.sizes, args.repeat)
+    elif args.command == "codec":
+        results = BenchmarkCodec(args.sizes, args.repeat)
+    elif args.command == "load":
+        results = BenchmarkLoad(args.engines, args.senders, args.events, args.timeout)
+    elif args.command == "protocol":
+        results = BenchmarkProtocol(args.passwords, args.actions, args.processes, args.threads, args.count, args.pool, args.timeout)
+    elif args.command == "flood":
+        results = BenchmarkFlood(args.modes, args.flooders, args.rate, args.burst, args.count, args.interval, args.source)
+    elif args.command == "burst":
+        results = BenchmarkBurst(args.backlogs, args.senders, args.timeout)
+    elif args.command == "udp":
+        results = BenchmarkUdp(args.transports, args.processes, args.count, args.password, args.timeout)
+    elif args.command == "multi":
+        results = BenchmarkMulti(args.counts, args.repeat, args.password)
+    elif args.command == "resolve":
+        results = BenchmarkResolve(args.delays, args.count, args.host)
+    elif args.command == "hedge":
+        results = BenchmarkHedge(args.delays, args.count, args.slow, args.stall, args.password)
+    elif args.command == "outbox":
+        results = BenchmarkOutbox(args.counts, args.password, args.timeout)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(dict(
+                command=args.command,
+                arguments=vars(args),
+                time=datetime.datetime.now().isoformat(),
+                python=sys.version,
+                platform=platform.platform(),
+                results=results,
+            ), output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    Main()